@@ -10,7 +10,9 @@
 # under the MIT License:
 #   https://github.com/mlox/mlox/blob/master/License.txt
 import argparse
+import json
 import logging
+import multiprocessing
 import os
 import pprint
 import re
@@ -21,8 +23,11 @@ import colorama
 from colorama import Fore, Style
 
 from mlox import version
-from mlox.loadOrder import Loadorder
+from mlox.loadOrder import Loadorder, read_batch, update_batch
 from mlox.resources import UPDATE_URL_USER, UPDATE_URL_BASE, set_user_path, get_user_path, get_base_file, get_user_file
+from mlox.ruleParser import ParseTrace, TRACE_SIZE
+from mlox.server import DEFAULT_PORT, serve
+from mlox.timings import Timings, phase
 from mlox.translations import dump_translations, _
 from mlox.update import update_file
 
@@ -39,6 +44,15 @@ def single_spaced(in_string):
     return tmp_string.strip()
 
 
+def line_range(in_string):
+    """Convert "FIRST-LAST" (or a single line number) into a (first, last) tuple"""
+    match = re.match(r'^(\d+)(?:-(\d+))?$', in_string)
+    if not match:
+        raise argparse.ArgumentTypeError("expected FIRST-LAST or a line number, not: {0}".format(in_string))
+    first = int(match.group(1))
+    return first, int(match.group(2) or first)
+
+
 class ColorFormatConsole(logging.Formatter):
     """Color code the logging information on Unix terminals"""
     levels = {
@@ -112,8 +126,9 @@ def add_verbosity_group(parser):
                                                 'Select one of these to set how much output to receive.') \
         .add_mutually_exclusive_group()
     verbosity_group.add_argument("-p", "--parsedebug",
-                                 help="Turn on debugging for the rules parser. "
-                                      "(This can generate a fair amount of output).\nImplies --debug.",
+                                 help="Turn on debugging for the rules parser, tracing every rule "
+                                      "(or the ones chosen with --trace-lines and --trace-plugin)."
+                                      "\nImplies --debug.",
                                  action="store_true")
     verbosity_group.add_argument("-d", "--debug", help="Turn on debug output.", action="store_true")
     verbosity_group.add_argument("-q", "--quiet",
@@ -129,14 +144,45 @@ def add_developer_options(parser):
     developer_group = parser.add_argument_group('Developer Options', 'Options useful only to mlox developers.')
     developer_group.add_argument("-l", "--listversions", action=ListVersions)
     developer_group.add_argument("--translations", action=ShowTranslations)
-    try:
-        # Only show the profile option if hotshot is installed
-        import hotshot
-        developer_group.add_argument("--profile",
-                                     help="Use hotshot to profile the application.",
-                                     action="store_true")
-    except ImportError:
-        pass
+    developer_group.add_argument("--trace-lines",
+                                 help=single_spaced("""
+                Trace what the rules parser does with the rules on lines FIRST to LAST of the rules files,
+                and print the trace at the end. Can be given more than once.
+                """),
+                                 metavar='FIRST-LAST',
+                                 action="append",
+                                 type=line_range)
+    developer_group.add_argument("--trace-plugin",
+                                 help=single_spaced("""
+                Trace what the rules parser does with the rules that mention plugin,
+                and print the trace at the end. Can be given more than once.
+                """),
+                                 metavar='plugin',
+                                 action="append",
+                                 type=str)
+    developer_group.add_argument("--trace-size",
+                                 help="Keep only the last N records of a trace. Default is {0}.".format(TRACE_SIZE),
+                                 metavar='N',
+                                 type=int)
+    developer_group.add_argument("--timings",
+                                 help=single_spaced("""
+                Print how long each phase of the run took (discovery, rules read, graph build,
+                current order merge, sort, write), and the slowest rules.
+                """),
+                                 action="store_true")
+    developer_group.add_argument("--timings-json",
+                                 help="Write the timings of each phase and every rule to FILE, as JSON.",
+                                 metavar='FILE',
+                                 type=str)
+    developer_group.add_argument("--profile",
+                                 help=single_spaced("""
+                Use cProfile to profile the application, saving the statistics to FILE (default mlox.prof),
+                and printing the functions that took the most time.
+                """),
+                                 metavar='FILE',
+                                 nargs='?',
+                                 const="mlox.prof",
+                                 type=str)
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -175,6 +221,13 @@ def build_parser() -> argparse.ArgumentParser:
                         metavar='file',
                         nargs='+',
                         type=str)
+    parser.add_argument("-j", "--jobs",
+                        help=single_spaced("""
+                Use this with the --fromfile option to sort N load orders at the same time, in N processes.
+                Default is 1.
+                """),
+                        metavar='N',
+                        type=int)
     parser.add_argument("-e", "--explain",
                         help=single_spaced("""
                 Print an explanation of the dependency graph for plugin.
@@ -187,6 +240,26 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--base-only",
                         help="Use this with the --explain option to exclude the current load order from the graph explanation.",
                         action="store_true")
+    parser.add_argument("--priority-sort",
+                        help=single_spaced("""
+                Keep the current load order by sorting plugins by their current position,
+                instead of adding pseudo-rules between neighbouring plugins.
+                Plugins are only moved when the rules require it.
+                """),
+                        action="store_true")
+    parser.add_argument("mode",
+                        help=single_spaced("""
+                serve: Keep the rules in memory, and answer load order requests sent as JSON,
+                over HTTP to localhost, or over a Unix socket with --socket.
+                """),
+                        nargs="?",
+                        choices=["serve"])
+    parser.add_argument("--port",
+                        help="Use this with serve to listen on localhost:PORT. Default is {0}.".format(DEFAULT_PORT),
+                        type=int)
+    parser.add_argument("--socket",
+                        help="Use this with serve to listen on a Unix socket at PATH, instead of over HTTP.",
+                        metavar='PATH')
     parser.add_argument("--gui",
                         help="Run the GUI.\nDefault action if no arguments are given.",
                         action="store_true")
@@ -201,40 +274,86 @@ def build_parser() -> argparse.ArgumentParser:
     return parser
 
 
+def get_trace(args):
+    """The ruleParser.ParseTrace asked for on the command line, or None"""
+    if not (args.parsedebug or args.trace_lines or args.trace_plugin):
+        return None
+    return ParseTrace(args.trace_lines or (), args.trace_plugin or (), args.trace_size or TRACE_SIZE,
+                      args.parsedebug)
+
+
+def print_trace(trace):
+    """Print a trace that was not already given to the debug log as it was made"""
+    if trace is None or trace.echo:
+        return
+    print("{0:-^80}".format('[Parse Trace]'))
+    for line in trace.format():
+        print(line)
+
+
+def report_timings(timings, args):
+    """Print the timings, and/or write them to a JSON file, as asked for on the command line"""
+    if timings is None:
+        return
+    if args.timings:
+        print("{0:-^80}".format('[Timings]'))
+        print(timings.report())
+    if args.timings_json:
+        try:
+            with open(args.timings_json, 'w', encoding="utf-8") as timings_file:
+                json.dump(timings.to_json(), timings_file, indent=2)
+        except IOError:
+            logging.error("Unable to write timings to: %s", args.timings_json)
+
+
 def command_line_mode(args):
     """Run in command line mode.  This assumes log levels were properly set up beforehand"""
     logging.info("%s %s", version.full_version(), _["Hello!"])
+    trace = get_trace(args)
+    # A profile is timed too, so it is of a real sort in this process (not a cached result, or one in a worker)
+    timings = Timings() if args.timings or args.timings_json or args.profile else None
     if args.fromfile:
-        for fromfile in args.fromfile:
-            my_loadorder = Loadorder()
-            my_loadorder.read_from_file(fromfile)
-            process_load_order(my_loadorder, args)
-        return
-    my_loadorder = Loadorder()
-    if not args.warningsonly:
-        if args.all:
-            my_loadorder.get_data_files()
+        # The rules are only read once (in each process), and shared by all the load orders
+        if args.explain:
+            results = ((my_loadorder, None) for my_loadorder in read_batch(args.fromfile, trace, timings))
         else:
-            my_loadorder.get_active_plugins()
+            results = update_batch(args.fromfile, args.warningsonly, args.priority_sort, args.jobs or 1, trace,
+                                   timings)
+        error_code = 0
+        for (my_loadorder, log) in results:
+            error_code = max(error_code, process_load_order(my_loadorder, args, log))
+        print_trace(trace)
+        report_timings(timings, args)
+        return error_code
+    my_loadorder = Loadorder(trace=trace, timings=timings)
+    if not args.warningsonly:
+        with phase(timings, "discovery"):
+            if args.all:
+                my_loadorder.get_data_files()
+            else:
+                my_loadorder.get_active_plugins()
     error_code = process_load_order(my_loadorder, args)
+    print_trace(trace)
+    report_timings(timings, args)
     return error_code
 
 
-def process_load_order(a_loadorder, args):
+def process_load_order(a_loadorder, args, update_log=None):
     """
     Process a load order.
     These are things users can do or see with a load order.
     No matter how the list of plugins is obtained, what's done here stays the same.
+    update_log is the output of a_loadorder.update, if it has already been updated.
     """
     log = ""
     if args.explain:
         log = a_loadorder.explain(args.explain[0], args.base_only)
         print(log)
         return 0
-    if args.quiet:
-        a_loadorder.update(None, args.warningsonly)
-    else:
-        log = a_loadorder.update(None, args.warningsonly)
+    if update_log is None:
+        update_log = a_loadorder.update(None, args.warningsonly, args.priority_sort)
+    if not args.quiet:
+        log = update_log
         print(log)
 
     if args.warningsonly:
@@ -258,15 +377,21 @@ def process_load_order(a_loadorder, args):
     print("{0:-^80}".format('[New Load Order]'))
     for plugin in a_loadorder.get_new_order():
         print(plugin)
-    if args.update:
-        a_loadorder.write_new_order()
-        print("{0:-^80}".format('[LOAD ORDER SAVED]'))
-        return 0
+    # An empty new order means the load order couldn't be sorted, and why was logged
+    error_code = 0 if a_loadorder.new_order else 1
+    if args.update and not error_code:
+        if a_loadorder.write_new_order():
+            print("{0:-^80}".format('[LOAD ORDER SAVED]'))
+            return 0
+        error_code = 1
     print("{0:-^80}".format('[END PROPOSED LOAD ORDER]'))
-    return 0
+    return error_code
 
 
 def main():
+    # The --jobs worker processes start here too in a frozen executable
+    multiprocessing.freeze_support()
+
     # Configure logging from python module
     logging.getLogger('').setLevel(logging.DEBUG)
     color_formatter = ColorFormatConsole('%(levelname)s (%(name)s): %(message)s')
@@ -274,8 +399,6 @@ def main():
     console_log_stream.setLevel(logging.INFO)
     console_log_stream.setFormatter(color_formatter)
     logging.getLogger('').addHandler(console_log_stream)
-    # Disable parse debug logging unless the user asks for it (It's so much it actually slows the program down)
-    logging.getLogger('mlox.parser').setLevel(logging.INFO)
 
     parser = build_parser()
 
@@ -287,7 +410,7 @@ def main():
     # Handle verbosity_group
     # Want to do this as early as possible so nothing is missed.
     if args.parsedebug:
-        logging.getLogger('mlox.parser').setLevel(logging.DEBUG)
+        # The rules parser is traced (see get_trace), instead of logging everything it does
         args.debug = True
     if args.debug:
         console_log_stream.setLevel(logging.DEBUG)
@@ -327,17 +450,20 @@ def main():
         MloxGui().start(args)
         return
 
-    # if vars(args).get('profile', False):
-    #     import hotshot
-    #     import hotshot.stats
-    #     prof = hotshot.Profile("mlox.prof")
-    #     time = prof.runcall(command_line_mode, args=args)
-    #     prof.close()
-    #     stats = hotshot.stats.load("mlox.prof")
-    #     stats.strip_dirs()
-    #     stats.sort_stats('time', 'calls')
-    #     stats.print_stats(20)
-    #     return
+    if args.mode == "serve":
+        sys.exit(serve(args.port or DEFAULT_PORT, args.socket))
+
+    if args.profile:
+        import cProfile
+        import pstats
+        prof = cProfile.Profile()
+        error_code = prof.runcall(command_line_mode, args)
+        prof.dump_stats(args.profile)
+        stats = pstats.Stats(args.profile)
+        stats.strip_dirs()
+        stats.sort_stats('time', 'calls')
+        stats.print_stats(20)
+        sys.exit(error_code)
 
     error_code = command_line_mode(args)
     sys.exit(error_code)
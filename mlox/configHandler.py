@@ -1,8 +1,12 @@
 import logging
+import math
 import os
 import re
+from bisect import bisect_left
 from functools import reduce
 
+from mlox import fileFinder
+
 config_logger = logging.getLogger('mlox.configHandler')
 
 MIN_SAFE_TIMESTAMP = 315529200  # safe file timestamp for both NTFS and FAT32 fs
@@ -13,7 +17,7 @@ def caseless_uniq(un_uniqed_files):
     Given a list, return a list of unique strings, and a list of duplicates.
     This is a caseless comparison, so 'Test' and 'test' are considered duplicates.
     """
-    lower_files = []  # Use this to allow for easy use of the 'in' keyword
+    lower_files = set()  # Use this to allow for easy use of the 'in' keyword
     unique_files = []  # Guaranteed case insensitive unique
     filtered = []  # any duplicates from the input
 
@@ -22,10 +26,36 @@ def caseless_uniq(un_uniqed_files):
             filtered.append(aFile)
         else:
             unique_files.append(aFile)
-            lower_files.append(aFile.lower())
+            lower_files.add(aFile.lower())
     return (unique_files, filtered)
 
 
+def longest_increasing(keys):
+    """
+    Find a longest strictly increasing subsequence of keys.
+
+    :return: The set of positions in keys that make up the subsequence
+    """
+    tails = []  # tails[n] is the smallest key ending an increasing subsequence of length n + 1
+    tail_positions = []
+    previous = [None] * len(keys)  # the position before each key, in the subsequence ending at it
+    for (i, key) in enumerate(keys):
+        n = bisect_left(tails, key)
+        if n == len(tails):
+            tails.append(key)
+            tail_positions.append(i)
+        else:
+            tails[n] = key
+            tail_positions[n] = i
+        previous[i] = tail_positions[n - 1] if n > 0 else None
+    kept = set()
+    i = tail_positions[-1] if tail_positions else None
+    while i is not None:
+        kept.add(i)
+        i = previous[i]
+    return kept
+
+
 def partition_esps_and_esms(filelist):
     """Split filelist into separate lists for esms and esps, retaining order."""
     esm_files = []
@@ -87,27 +117,34 @@ class configHandler():
 
         :return: An ordered list of plugins
         """
-        files = []
-        regex = self.read_regexes[self.fileType]
         try:
-            file_handle = open(self.configFile, 'r')
-            for line in file_handle:
-                gamefile = regex.match(line.strip())
-                if gamefile:
-                    f = gamefile.group(1).strip()
-                    files.append(f)
-            file_handle.close()
+            return list(self.iter_plugins())
         except IOError:
             config_logger.error("Unable to open configuration file: {0}".format(self.configFile))
             return []
         except UnicodeDecodeError:
             config_logger.error("Bad Characters in configuration file: {0}".format(self.configFile))
             return []
-        # Deal with duplicates
-        (files, dups) = caseless_uniq(files)
-        for f in dups:
-            config_logger.debug("Duplicate plugin found in config file: {0}".format(f))
-        return files
+
+    def iter_plugins(self):
+        """
+        Read a configuration file one line at a time, giving each plugin as soon as it's found.
+
+        Duplicates are skipped.  Unlike read(), errors reading the file (IOError, UnicodeDecodeError) are raised.
+        :return: An iterator over the plugins, in order
+        """
+        regex = self.read_regexes[self.fileType]
+        lower_files = set()
+        with open(self.configFile, 'r') as file_handle:
+            for line in file_handle:
+                gamefile = regex.match(line.strip())
+                if gamefile:
+                    f = gamefile.group(1).strip()
+                    if f.lower() in lower_files:
+                        config_logger.debug("Duplicate plugin found in config file: {0}".format(f))
+                        continue
+                    lower_files.add(f.lower())
+                    yield f
 
     def clear(self):
         """
@@ -164,6 +201,9 @@ class configHandler():
         except IndexError:
             config_logger.error("Configuration file does not have a '[Game Files]' section!")
             return False
+        if sections[config_index + 1] == out_str:
+            config_logger.debug("Plugins already in this order, not writing: {0}".format(self.configFile))
+            return True
         sections[config_index + 1] = out_str
         file_buffer = reduce(lambda x, y: x + y, sections)
 
@@ -209,8 +249,9 @@ class dataDirHandler:
     """
     path = None
 
-    def __init__(self, data_files_path):
+    def __init__(self, data_files_path, snapshot=None):
         self.path = data_files_path
+        self.snapshot = snapshot  # a fileFinder.dir_snapshot of the directory, read when first needed
 
     # Get the directory name in a printable form
     def getDir(self):
@@ -220,9 +261,21 @@ class dataDirHandler:
         """Convenience function to return the full path to a file."""
         return os.path.join(self.path, a_file)
 
+    def _snapshot(self):
+        if self.snapshot is None:
+            self.snapshot = fileFinder.dir_snapshot(self.path)
+        return self.snapshot
+
+    def _mtime(self, a_file):
+        """The modification time of a file, from the snapshot if possible"""
+        entry = self._snapshot().entry(a_file)
+        if entry is not None and entry.name == a_file:
+            return entry.st_mtime
+        return os.path.getmtime(self._full_path(a_file))
+
     def _sort_by_date(self, list_of_plugins):
         """Sort a list of plugin files by modification date"""
-        dated_plugins = [(os.path.getmtime(self._full_path(a_plugin)), a_plugin) for a_plugin in list_of_plugins]
+        dated_plugins = [(self._mtime(a_plugin), a_plugin) for a_plugin in list_of_plugins]
         dated_plugins.sort()
         return ([x[1] for x in dated_plugins])
 
@@ -233,7 +286,7 @@ class dataDirHandler:
         Note:  Unlike configHandler.read(), ESM files will always be at the front of the returned list.
         :return: An ordered list of plugins
         """
-        files = [f for f in os.listdir(self.path) if os.path.isfile(self._full_path(f))]
+        files = [entry.name for entry in self._snapshot().listing if entry.is_file]
         (files, dups) = caseless_uniq(files)
         # Deal with duplicates
         for f in dups:
@@ -244,33 +297,95 @@ class dataDirHandler:
         files += self._sort_by_date(esp_files)
         return files
 
+    # There are six files with fixed times, the bsa files depend on the esm files being present.
+    # These files are fixed to be compatible with `tes3cmd resetdates`.
+    fixed_mtimes = {
+        "morrowind.esm": (1024695106, "Morrowind.bsa"),  # Fri Jun 21 17:31:46 2002
+        "tribunal.esm": (1035940926, "Tribunal.bsa"),  # Tue Oct 29 20:22:06 2002
+        "bloodmoon.esm": (1051807050, "Bloodmoon.bsa")  # Thu May  1 12:37:30 2003
+    }
+
+    def _set_mtime(self, a_file, mtime):
+        os.utime(self._full_path(a_file), (MIN_SAFE_TIMESTAMP, mtime))
+        self._snapshot().set_mtime(a_file, mtime)
+
+    def _new_mtimes(self, list_of_plugins):
+        """
+        Work out which plugins in list_of_plugins have to be given new times, so they are read in that order.
+
+        The longest run of plugins that are already in order keeps its times,
+        and every other plugin gets a time between the plugins around it, a minute apart if there's room.
+        Masters and plugins are read separately, so they are ordered separately.
+        :return: A dict of plugin: new modification time, or None if there's no room between the times already there
+        """
+        new_mtimes = {}
+        for part in partition_esps_and_esms(list_of_plugins):
+            # The masters with fixed times split the masters into segments, that are ordered separately
+            segments = [[MIN_SAFE_TIMESTAMP, []]]
+            for a_plugin in part:
+                if a_plugin.lower() in self.fixed_mtimes:
+                    fixed_mtime = self.fixed_mtimes[a_plugin.lower()][0]
+                    if self._mtime(a_plugin) != fixed_mtime:
+                        new_mtimes[a_plugin] = fixed_mtime
+                    segments.append([fixed_mtime, []])
+                else:
+                    segments[-1][1].append(a_plugin)
+            for (n, (lowest, plugins)) in enumerate(segments):
+                highest = segments[n + 1][0] if n + 1 < len(segments) else None
+                keys = [(self._mtime(a_plugin), a_plugin) for a_plugin in plugins]
+                # Plugins outside of the segment's time range always move
+                in_range = [i for (i, key) in enumerate(keys) if key[0] > lowest and (highest is None or key[0] < highest)]
+                kept = {in_range[i] for i in longest_increasing([keys[i] for i in in_range])}
+                before = lowest
+                moved = []
+                for (i, a_plugin) in enumerate(plugins + [None]):
+                    if a_plugin is not None and i not in kept:
+                        moved.append(a_plugin)
+                        continue
+                    after = keys[i][0] if a_plugin is not None else highest
+                    if moved:
+                        step = 60 if after is None else min(60, (math.ceil(after) - math.floor(before)) // (len(moved) + 1))
+                        if step < 1:
+                            return None
+                        for (j, moved_plugin) in enumerate(moved):
+                            if before == lowest and after is not None:
+                                # Nothing before them stays, so keep them close to what follows
+                                new_mtimes[moved_plugin] = math.ceil(after) - step * (len(moved) - j)
+                            else:
+                                new_mtimes[moved_plugin] = math.floor(before) + step * (j + 1)
+                        moved = []
+                    before = after
+        return new_mtimes
+
     def write(self, list_of_plugins):
         """
         Change the modification times of plugin files to be in order of file list, oldest to newest
 
-        There are six files with fixed times, the bsa files depend on the esm files being present.
-        These files are fixed to be compatible with `tes3cmd resetdates`.
+        Only the plugins that have to move are touched, when there's room for them between the plugins that stay.
+        Otherwise every plugin is given a new time.
         :return: True on success, or False on failure
         """
-        tes3cmd_resetdates_morrowind_mtime = 1024695106  # Fri Jun 21 17:31:46 2002
-        tes3cmd_resetdates_tribunal_mtime = 1035940926  # Tue Oct 29 20:22:06 2002
-        tes3cmd_resetdates_bloodmoon_mtime = 1051807050  # Thu May  1 12:37:30 2003
-
-        mtime = tes3cmd_resetdates_morrowind_mtime
         try:
+            new_mtimes = self._new_mtimes(list_of_plugins)
+            if new_mtimes is not None:
+                config_logger.debug("Moving {0} of {1} plugins".format(len(new_mtimes), len(list_of_plugins)))
+                for a_plugin in list_of_plugins:
+                    if a_plugin.lower() in self.fixed_mtimes:
+                        (fixed_mtime, bsa) = self.fixed_mtimes[a_plugin.lower()]
+                        if self._mtime(bsa) != fixed_mtime:
+                            self._set_mtime(bsa, fixed_mtime)
+                    if a_plugin in new_mtimes:
+                        self._set_mtime(a_plugin, new_mtimes[a_plugin])
+                return True
+
+            mtime = self.fixed_mtimes["morrowind.esm"][0]
             for a_plugin in list_of_plugins:
-                if a_plugin.lower() == "morrowind.esm":
-                    mtime = tes3cmd_resetdates_morrowind_mtime
-                    os.utime(self._full_path("Morrowind.bsa"), (MIN_SAFE_TIMESTAMP, mtime))
-                elif a_plugin.lower() == "tribunal.esm":
-                    mtime = tes3cmd_resetdates_tribunal_mtime
-                    os.utime(self._full_path("Tribunal.bsa"), (MIN_SAFE_TIMESTAMP, mtime))
-                elif a_plugin.lower() == "bloodmoon.esm":
-                    mtime = tes3cmd_resetdates_bloodmoon_mtime
-                    os.utime(self._full_path("Bloodmoon.bsa"), (MIN_SAFE_TIMESTAMP, mtime))
+                if a_plugin.lower() in self.fixed_mtimes:
+                    (mtime, bsa) = self.fixed_mtimes[a_plugin.lower()]
+                    self._set_mtime(bsa, mtime)
                 else:
                     mtime += 60  # standard 1 minute Mash step
-                os.utime(self._full_path(a_plugin), (MIN_SAFE_TIMESTAMP, mtime))
+                self._set_mtime(a_plugin, mtime)
         except TypeError:
             config_logger.error(
                 """
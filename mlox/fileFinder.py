@@ -13,6 +13,7 @@
 import logging
 import os
 import re
+from collections import namedtuple
 from typing import Optional
 
 file_logger = logging.getLogger('mlox.fileFinder')
@@ -87,6 +88,59 @@ class caseless_dirlist:
         return self.files.values()
 
 
+# What a dir_snapshot knows about a file.  The st_ names match os.stat() results, so an entry can be used as one.
+dir_entry = namedtuple("dir_entry", "name cname st_size st_mtime st_mtime_ns is_file")
+
+
+class dir_snapshot(caseless_dirlist):
+    """
+    A caseless_dirlist that also remembers the size, modification time, and type of everything in the directory.
+
+    It is read in one pass with os.scandir, so a directory full of plugins only has to be looked at once.
+    """
+
+    def __init__(self, dir):
+        self.files = {}
+        self.entries = {}  # cname: dir_entry (the first one found, if several names only differ by case)
+        self.listing = []  # every dir_entry, in the order os.scandir found them
+        self.dir = os.path.normpath(os.path.abspath(dir))
+        with os.scandir(self.dir) as scan:
+            for found in scan:
+                try:
+                    stat = found.stat()
+                    is_file = found.is_file()
+                except OSError:
+                    continue
+                entry = dir_entry(found.name, found.name.lower(), stat.st_size, stat.st_mtime, stat.st_mtime_ns, is_file)
+                self.files[entry.cname] = entry.name
+                self.entries.setdefault(entry.cname, entry)
+                self.listing.append(entry)
+
+    def entry(self, file_name) -> Optional[dir_entry]:
+        """
+        :param file_name: A case insensitive file name
+        :returns: What's known about the file, or None
+        """
+        return self.entries.get(file_name.lower(), None)
+
+    def path_entry(self, path) -> Optional[dir_entry]:
+        """
+        :param path: The path to a file
+        :returns: What's known about the file, or None if it's not in this directory
+        """
+        (dir, file_name) = os.path.split(os.path.normpath(os.path.abspath(path)))
+        if dir != self.dir:
+            return None
+        entry = self.entries.get(file_name.lower(), None)
+        return entry if entry is not None and entry.name == file_name else None
+
+    def set_mtime(self, file_name, mtime):
+        """Record that a file's modification time was changed"""
+        entry = self.entry(file_name)
+        if entry is not None:
+            self.entries[entry.cname] = entry._replace(st_mtime=mtime, st_mtime_ns=int(mtime * 1000000000))
+
+
 def _find_appdata():
     """a somewhat hacky function for finding where Oblivion's Application Data lives.
     Hopefully works under Windows, Wine, and native Linux."""
@@ -1,31 +1,150 @@
+import hashlib
+import json
 import logging
 import os
 import io
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
 from mlox import configHandler, ruleParser, fileFinder
-from mlox.resources import get_base_file, get_user_file, get_my_user_file
+from mlox.resources import get_base_file, get_user_file, get_my_user_file, get_user_path, set_user_path, \
+    get_header_cache_file, get_result_cache_file
+from mlox.timings import phase
+from mlox.utils import sha256sum
 
 old_loadorder_output = "current_loadorder.out"
 new_loadorder_output = "mlox_new_loadorder.out"
 
 order_logger = logging.getLogger('mlox.loadOrder')
 
+# Change this whenever what goes into a result, or its key, changes
+RESULT_CACHE_FORMAT = 3
+
+# How many results the result cache keeps
+RESULT_CACHE_SIZE = 16
+
+# The loggers whose messages are part of the result of a sort, and are given again when the result is reused
+RESULT_LOGGERS = ["mlox.parser", "mlox.pluggraph"]
+
+
+class _LogRecorder(logging.Handler):
+    """Records the messages sent to RESULT_LOGGERS, as [logger name, level, message]"""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append([record.name, record.levelno, record.getMessage()])
+
+
+@contextmanager
+def _recording_logs():
+    """Record the messages sent to RESULT_LOGGERS in the with block"""
+    recorder = _LogRecorder()
+    for name in RESULT_LOGGERS:
+        logging.getLogger(name).addHandler(recorder)
+    try:
+        yield recorder
+    finally:
+        for name in RESULT_LOGGERS:
+            logging.getLogger(name).removeHandler(recorder)
+
+
+class ResultCache:
+    """
+    The results of the last few sorts, so sorting the same plugins against the same rules again is instant.
+
+    Results are kept by a hash of everything they depend on (see Loadorder._result_key).
+    """
+
+    def __init__(self, cache_file=None, autosave=True):
+        self.cache_file = cache_file
+        self.autosave = autosave  # save the cache as each result is put, instead of when save is called
+        self.entries = None  # key: result, oldest first
+        self.added = {}  # key: result, put since the cache was last saved
+
+    def _load(self):
+        self.entries = {}
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding="utf-8") as cache:
+                entries = json.load(cache)
+            if entries.get("format") == RESULT_CACHE_FORMAT:
+                self.entries = entries["results"]
+        except (IOError, ValueError, KeyError, AttributeError):
+            order_logger.warning("Unable to read result cache:  {0}".format(self.cache_file))
+
+    def get(self, key):
+        """
+        Get the result kept for key.
+
+        A result that depended on [MWSE-LUA] mods being there (or not) is only used while they still are (or aren't).
+        """
+        if self.entries is None:
+            self._load()
+        result = self.entries.get(key)
+        if result is None:
+            return None
+        for (path, exists) in result.get("mwse_mods", {}).items():
+            if os.path.exists(path) != exists:
+                return None
+        return result
+
+    def put(self, key, result):
+        """Remember result, and save the cache to cache_file (when autosaving)"""
+        if self.entries is None:
+            self._load()
+        self.entries.pop(key, None)
+        self.entries[key] = result
+        while len(self.entries) > RESULT_CACHE_SIZE:
+            del self.entries[next(iter(self.entries))]
+        self.added[key] = result
+        if self.autosave:
+            self.save()
+
+    def save(self):
+        """Save the cache to cache_file, if any results were put since it was last saved"""
+        added = self.added
+        self.added = {}
+        if self.cache_file is None or not added:
+            return
+        # Write a new file and move it into place, so processes sharing the cache never read half a file
+        tmp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w', encoding="utf-8") as cache:
+                json.dump({"format": RESULT_CACHE_FORMAT, "results": self.entries}, cache)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            order_logger.warning("Unable to save result cache:  {0}".format(self.cache_file))
+
 
 class Loadorder:
     """Class for reading plugin mod times (load order), and updating them based on rules"""
 
-    def __init__(self):
+    def __init__(self, shared=None, trace=None, timings=None, results=None, find_dirs=True):
         # order is the list of plugins in Data Files, ordered by mtime
         self.order = []  # the load order
         self.new_order = []  # the new load order
         self.is_sorted = False
         self.caseless = fileFinder.caseless_filenames()
         self.hints = {}  # hints in the load order for highlighting
+        self.headers = ruleParser.HeaderCache(get_header_cache_file())  # what we know about the plugin headers
+        self.parsers = {}  # the parser that last read the rules, by the load order and rules files it read
+        self.shared = shared  # a ruleParser.RuleCache shared with other load orders, or None
+        self.results = ResultCache(get_result_cache_file()) if results is None else results  # of earlier sorts
+        self.snapshot = None  # a fileFinder.dir_snapshot of the data directory, shared by everything that looks at it
+        self.trace = trace  # a ruleParser.ParseTrace for the rules parser, or None
+        self.timings = timings  # a timings.Timings to add the time spent in each phase to, or None
 
         # self.datadir = None                # where plugins live
         # self.plugin_file = None            # Path to the file containing the plugin list
         # self.game_type = None              # 'Morrowind', 'Oblivion', or None for unknown
-        self.game_type, self.plugin_file, self.datadir = fileFinder.find_game_dirs()
+        if find_dirs:
+            self.game_type, self.plugin_file, self.datadir = fileFinder.find_game_dirs()
+        else:
+            self.game_type, self.plugin_file, self.datadir = None, None, None
 
     def get_active_plugins(self):
         """
@@ -42,7 +161,8 @@ class Loadorder:
 
         # Get all the plugins
         config_files = configHandler.configHandler(self.plugin_file, self.game_type).read()
-        dir_files = configHandler.dataDirHandler(self.datadir).read()
+        self.snapshot = None
+        dir_files = configHandler.dataDirHandler(self.datadir, self._data_snapshot()).read()
 
         # Remove plugins not in the data directory (and correct capitalization)
         config_files = list(map(str.lower, config_files))
@@ -63,13 +183,27 @@ class Loadorder:
         Updates self.order
         """
         self.is_sorted = False
-        self.order = configHandler.dataDirHandler(self.datadir).read()
+        self.snapshot = None
+        self.order = configHandler.dataDirHandler(self.datadir, self._data_snapshot()).read()
 
         # Convert the files to lowercase, while storing them in a dict
         self.order = list(map(self.caseless.cname, self.order))
 
         order_logger.info("Found {0} plugins in: \"{1}\"".format(len(self.order), self.datadir))
 
+    def _data_snapshot(self):
+        """
+        Get the snapshot of the data directory, reading it if it hasn't been read yet.
+
+        :returns: The fileFinder.dir_snapshot, or None when there is no data directory
+        """
+        if not self.datadir:
+            return None
+        if self.snapshot is None:
+            self.snapshot = fileFinder.dir_snapshot(self.datadir)
+            self.headers.snapshot = self.snapshot
+        return self.snapshot
+
     def read_from_file(self, fromfile):
         """
         Get the load order by reading an input file.
@@ -94,15 +228,49 @@ class Loadorder:
         order_logger.info(
             "(Note: When the load order input is from an external source, the [SIZE] predicate cannot check the plugin filesizes, so it defaults to True).")
 
+    def read_from_list(self, plugins):
+        """
+        Get the load order from a list of plugin names, like one sent to the server.
+
+        Plugins listed more than once (ignoring case) are only kept the first time.
+        Clears self.game_type, self.datadir and self.plugin_file.
+        Updates self.order
+        """
+        self.is_sorted = False
+        self.game_type = None
+        self.datadir = None
+        self.plugin_file = None
+        (plugins, dups) = configHandler.caseless_uniq(plugins)
+        for f in dups:
+            order_logger.debug("Duplicate plugin found in the request: {0}".format(f))
+        self.order = list(map(self.caseless.cname, plugins))
+        order_logger.info("Found {0} plugins in the request".format(len(self.order)))
+
     def listversions(self):
         """List the versions of all plugins in the current load order"""
         out = "{0:20} {1:20} {2}\n".format("Name", "Description", "Plugin Name")
         for p in self.order:
-            (file_ver, desc_ver) = ruleParser.get_version(p, self.datadir)
+            (file_ver, desc_ver) = ruleParser.get_version(p, self._data_snapshot(), self.headers)
             out += "{0:20} {1:20} {2}\n".format(str(file_ver), str(desc_ver), self.caseless.truename(p))
+        self.headers.save()
         return out
 
-    def add_current_order(self, graph, out_stream=None):
+    def get_masters(self):
+        """
+        Get the masters of each plugin in the current load order, from the plugins' headers.
+
+        :returns: {plugin: [master, ...]}, which is empty when there is no data directory to read the plugins from
+        """
+        snapshot = self._data_snapshot()
+        if snapshot is None:
+            return {}
+        paths = {p: snapshot.find_path(p) for p in self.order}
+        self.headers.prefetch(paths.values())
+        masters = {p: self.headers.masters(path) for (p, path) in paths.items() if path is not None}
+        self.headers.save()
+        return masters
+
+    def add_current_order(self, graph, out_stream=None, order_edges=True):
         """
         Add the current load order as a pseudo rule set.
 
@@ -116,7 +284,9 @@ class Loadorder:
         This allows us to move unconnected nodes to the top or bottom of
         the roots calculated in the topo_sort routine, depending on
         whether they show up in [NEARSTART] or [NEAREND] rules,
-        respectively"""
+        respectively.
+        When order_edges is False, no edges are added between neighbouring
+        plugins, for sorting with pluggraph.priority_sort instead."""
         if len(self.order) < 2:
             return
         order_logger.debug("adding edges from CURRENT ORDER")
@@ -132,15 +302,15 @@ class Loadorder:
                         graph.add_edge("", "bloodmoon.esm", p, out_stream)
 
         # make ordering pseudo-rules from nearend info
-        kingyo_fun = [x for x in graph.nearend if x in self.order]
-        for p_end in kingyo_fun:
-            for p in [x for x in self.order if x != p_end]:
-                graph.add_edge("", p, p_end, out_stream)
+        # (the graph handles these itself, instead of an edge from every plugin to each nearend plugin)
+        graph.add_nearend_constraints(self.order)
         # make ordering pseudo-rules from current load order.
         prev_i = 0
         graph.nodes.setdefault(self.order[prev_i], [])
         for curr_i in range(1, len(self.order)):
             graph.nodes.setdefault(self.order[curr_i], [])
+            if not order_edges:
+                continue
             if self.order[curr_i] not in graph.nearstart and self.order[curr_i] not in graph.nearend:
                 # add an edge, on any failure due to cycle detection, we try
                 # to make an edge between the current plugin and the first
@@ -151,6 +321,14 @@ class Loadorder:
                             break
             prev_i = curr_i
 
+    def get_hints(self):
+        """
+        Get the plugin names in the hints for highlighting.
+
+        (The hints can also hold rule expressions, which are never highlighted.)
+        """
+        return {kind: [hint for hint in hints if isinstance(hint, str)] for (kind, hints) in self.hints.items()}
+
     def get_original_order(self):
         """Get the original plugin order in a nice printable format"""
         formatted = []
@@ -190,23 +368,62 @@ class Loadorder:
                     highlight = "_"
         return formatted
 
+    def _read_rules(self, rule_files, progress=None):
+        """
+        Get a parser that has read rule_files (and a progress bar value and label for each) for the current load order.
+
+        Only the last file has to exist. The parser is kept, and reused for as long as the load order and
+        the rules files stay the same, so sorting more than once doesn't mean reading the rules again.
+        :returns: The parser, or None if the last rules file could not be read
+        """
+        stats = []
+        for (rule_file, value, label) in rule_files:
+            try:
+                stat = os.stat(rule_file)
+                stats.append((rule_file, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                stats.append((rule_file, None, None))
+        key = (tuple(self.order), self.datadir, tuple(stats))
+        if key in self.parsers and self.trace is None:
+            return self.parsers[key]
+
+        parser = ruleParser.RuleParser(self.order, self._data_snapshot(), self.caseless, get_user_path(), self.headers,
+                                       self.shared, self.trace, self.timings)
+        reads = self.headers.reads
+        for (i, (rule_file, value, label)) in enumerate(rule_files):
+            if progress is not None:
+                progress.update_value_and_label(value, label)
+            if i == len(rule_files) - 1:
+                if not parser.read_rules(rule_file, None):
+                    return None
+            elif os.path.exists(rule_file):
+                parser.read_rules(rule_file, None)
+        if self.timings is not None:
+            self.timings.count("plugin headers read", self.headers.reads - reads)
+            self.timings.count("predicate checks", parser.context.predicate_checks)
+        self.headers.save()
+        self.parsers = {key: parser}
+        return parser
+
     def explain(self, plugin_name, base_only=False):
         """Explain why a mod is in its current position"""
-        parser = ruleParser.RuleParser(self.order, self.datadir, self.caseless)
-        if os.path.exists(get_user_file()):
-            parser.read_rules(get_user_file())
-        parser.read_rules(get_base_file())
-        plugin_graph = parser.get_graph()
+        parser = self._read_rules([(get_user_file(), 25, "Loading user file ..."),
+                                   (get_base_file(), 50, "Loading base file ...")])
+        if parser is None:
+            return ""
+        plugin_graph = parser.get_graph().copy()
 
         if not base_only:
             self.add_current_order(plugin_graph)  # tertiary order "pseudo-rules" from current load order
 
-        output = plugin_graph.explain(plugin_name, self.order)
+        output = plugin_graph.compact().explain(plugin_name, self.order)
         return output
 
-    def update(self, progress=None, warningsonly=False):
+    def update(self, progress=None, warningsonly=False, priority_sort=False):
         """
         Update the load order based on input rules.
+
+        With priority_sort, the current load order is kept by a priority based sort, instead of pseudo-rules.
         """
         self.is_sorted = False
         if not warningsonly:
@@ -218,45 +435,66 @@ class Loadorder:
             for p in self.get_original_order():
                 order_logger.debug("  " + p)
 
+        rule_files = [(get_my_user_file(), 1, "Loading my rules file ..."),
+                      (get_user_file(), 25, "Loading user file ..."),
+                      (get_base_file(), 50, "Loading base file ...")]
+        result_key = self._result_key([rule_file for (rule_file, value, label) in rule_files],
+                                      warningsonly, priority_sort)
+        # A trace, or timings, are of the sort itself, so they always sort again
+        result = self.results.get(result_key) if self.trace is None and self.timings is None else None
+        if result is not None:
+            order_logger.debug("Using the result of an earlier sort")
+            return self._use_result(result, warningsonly)
+
+        with _recording_logs() as logs:
+            (messages, result) = self._sort(rule_files, progress, warningsonly, priority_sort)
+        if result is not None:
+            result["logs"] = logs.messages
+            self.results.put(result_key, result)
+            if not warningsonly:
+                self._save_orders()
+        return messages
+
+    def _sort(self, rule_files, progress, warningsonly, priority_sort):
+        """
+        The part of update that isn't done when the result of an earlier sort is used.
+
+        :returns: The messages for the user, and the result to keep for sorting these plugins again (or None)
+        """
         out_stream = io.StringIO()
 
         # read rules from various sources, and add orderings to graph
         # if any subsequent rule causes a cycle in the current graph, it is discarded
-        parser = ruleParser.RuleParser(self.order, self.datadir, self.caseless)
-
-        # read my user file
-        if progress is not None:
-            progress.update_value_and_label(1, "Loading my rules file ...")
-        if os.path.exists(get_my_user_file()):
-            parser.read_rules(get_my_user_file(), None)
-
-        # read user file
-        if progress is not None:
-            progress.update_value_and_label(25, "Loading user file ...")
-        if os.path.exists(get_user_file()):
-            parser.read_rules(get_user_file(), None)
-
-        # read base file
-        if progress is not None:
-            progress.update_value_and_label(50, "Loading base file ...")
-        if not parser.read_rules(get_base_file(), None):
+        parser = self._read_rules(rule_files, progress)
+        if parser is None:
             err = "Unable to parse 'mlox_base.txt', load order NOT sorted!"
             order_logger.error(err)
             self.new_order = []
-            return f"ERROR {err}"
+            return f"ERROR {err}", None
         if progress is not None:
             progress.update_value_and_label(90, "Parsing rules ...")
 
         # Convert the graph into a sorted list of all plugins (rules + load order)
         self.hints = parser.hints
-        plugin_graph = parser.get_graph()
+        plugin_graph = parser.get_graph().copy()
         print(parser.get_messages(), file=out_stream)
 
-        self.add_current_order(plugin_graph, out_stream)  # tertiary order "pseudo-rules" from current load order
-        sorted_plugins = plugin_graph.topo_sort()
-
+        if priority_sort:
+            with phase(self.timings, "current order"):
+                self.add_current_order(plugin_graph, out_stream, False)
+            with phase(self.timings, "sort"):
+                sorted_plugins = plugin_graph.compact().priority_sort(self.order)
+        else:
+            with phase(self.timings, "current order"):
+                # tertiary order "pseudo-rules" from current load order
+                self.add_current_order(plugin_graph, out_stream)
+            with phase(self.timings, "sort"):
+                sorted_plugins = plugin_graph.compact().topo_sort()
+
+        mwse_mods = dict(parser.context.mwse_mods)
         if warningsonly:
-            return out_stream.getvalue()
+            return out_stream.getvalue(), {"messages": out_stream.getvalue(), "hints": self.get_hints(),
+                                           "mwse_mods": mwse_mods}
 
         # The "sorted" list will be a superset of all known plugin files,
         # but we only care about active plugins.
@@ -274,33 +512,162 @@ class Loadorder:
             order_logger.error("sanity check: len(self.new_order %d) != len(self.order %d)", len(self.new_order),
                                len(self.order))
             self.new_order = []
-            return f"ERROR {err}"
+            return f"ERROR {err}", None
 
         if self.order == new_order_cname:
             order_logger.info("[Plugins already in sorted order. No sorting needed!]")
             self.is_sorted = True
+        return out_stream.getvalue(), {"messages": out_stream.getvalue(), "hints": self.get_hints(),
+                                       "new_order": self.new_order, "is_sorted": self.is_sorted,
+                                       "mwse_mods": mwse_mods}
 
+    def _save_orders(self):
         if self.datadir:
             # these are things we do not want to do if just testing a load order from a file
             # save the load orders to file for future reference
             configHandler.configHandler(old_loadorder_output, "raw").write(self.order)
             configHandler.configHandler(new_loadorder_output, "raw").write(self.new_order)
 
-        return out_stream.getvalue()
+    def _result_key(self, rule_files, warningsonly, priority_sort):
+        """
+        A hash of everything the result of update depends on.
+
+        That is the rules files' hashes, the load order, and the size and modification time of each plugin.
+        (The [MWSE-LUA] mods a result depends on are checked by ResultCache.get.)
+        The levels of RESULT_LOGGERS are included too, as they decide which messages the result can give again.
+        """
+        rules = []
+        for rule_file in rule_files:
+            try:
+                rules.append(sha256sum(rule_file) if self.shared is None else self.shared.digest(rule_file))
+            except OSError:
+                rules.append(None)
+        plugins = []
+        snapshot = self._data_snapshot()
+        for plugin in self.order:
+            plugin = self.caseless.truename(plugin)
+            if snapshot is None:
+                plugins.append([plugin])
+                continue
+            stat = snapshot.entry(plugin)
+            plugins.append([plugin, stat.st_size, stat.st_mtime_ns] if stat else [plugin, None])
+        levels = [logging.getLogger(name).getEffectiveLevel() for name in RESULT_LOGGERS]
+        key = [RESULT_CACHE_FORMAT, rule_files, rules, self.datadir, plugins, levels, warningsonly, priority_sort]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def _use_result(self, result, warningsonly):
+        """Use the result of an earlier update, giving the messages it logged again"""
+        for (name, level, message) in result["logs"]:
+            logging.getLogger(name).log(level, message)
+        self.hints = result["hints"]
+        if warningsonly:
+            return result["messages"]
+        self.new_order = result["new_order"]
+        self.is_sorted = result["is_sorted"]
+        if self.is_sorted:
+            order_logger.info("[Plugins already in sorted order. No sorting needed!]")
+        self._save_orders()
+        return result["messages"]
 
     def write_new_order(self):
         """Write/save the new order to the directory and config file."""
         if not isinstance(self.new_order, list) or self.new_order == []:
             order_logger.error("Not saving blank load order.")
             return False
-        if self.datadir:
-            if configHandler.dataDirHandler(self.datadir).write(self.new_order):
-                self.is_sorted = True
-        if isinstance(self.plugin_file, str):
-            if configHandler.configHandler(self.plugin_file, self.game_type).write(self.new_order):
-                self.is_sorted = True
+        with phase(self.timings, "write"):
+            if self.datadir:
+                if configHandler.dataDirHandler(self.datadir).write(self.new_order):
+                    self.is_sorted = True
+            if isinstance(self.plugin_file, str):
+                if configHandler.configHandler(self.plugin_file, self.game_type).write(self.new_order):
+                    self.is_sorted = True
 
         if not self.is_sorted:
             order_logger.error("Unable to save new load order.")
             return False
         return True
+
+
+def read_batch(fromfiles, trace=None, timings=None, results=None):
+    """
+    Read a load order from each of fromfiles (see Loadorder.read_from_file).
+
+    The load orders share one ruleParser.RuleCache, so the rules files are only read once for all of them.
+    They share one ResultCache too (results, or one of their own), so the result cache is only read once.
+    :returns: An iterator over the Loadorders, in the same order as fromfiles
+    """
+    shared = ruleParser.RuleCache()
+    if results is None:
+        results = ResultCache(get_result_cache_file())
+    for fromfile in fromfiles:
+        a_loadorder = Loadorder(shared, trace, timings, results)
+        with phase(timings, "discovery"):
+            a_loadorder.read_from_file(fromfile)
+        yield a_loadorder
+
+
+_worker_rules = None  # the ruleParser.RuleCache of a process started by update_batch
+_worker_results = None  # its ResultCache, which is saved by the process that started it
+
+
+def _start_worker(user_path, level):
+    """
+    Set up a process started by update_batch like the one that started it.
+
+    A spawned process doesn't inherit the user path (see resources.set_user_path) or the logging level.
+    """
+    global _worker_rules, _worker_results
+    set_user_path(user_path)
+    logging.getLogger().setLevel(level)
+    _worker_rules = ruleParser.RuleCache()
+    _worker_results = ResultCache(get_result_cache_file(), autosave=False)
+
+
+def _update_file(fromfile, warningsonly, priority_sort):
+    """Sort the load order in fromfile in a worker process, and return what the process that started it shows"""
+    a_loadorder = Loadorder(_worker_rules, results=_worker_results)
+    a_loadorder.read_from_file(fromfile)
+    messages = a_loadorder.update(None, warningsonly, priority_sort)
+    results = _worker_results.added
+    _worker_results.added = {}
+    # The expressions in the hints don't all pickle
+    return {"messages": messages, "order": a_loadorder.order, "new_order": a_loadorder.new_order,
+            "is_sorted": a_loadorder.is_sorted, "hints": a_loadorder.get_hints(), "results": results}
+
+
+def _updated_loadorder(fromfile, updated):
+    """A Loadorder for fromfile, sorted as _update_file returned"""
+    a_loadorder = Loadorder(find_dirs=False)
+    a_loadorder.plugin_file = fromfile
+    a_loadorder.order = updated["order"]
+    a_loadorder.new_order = updated["new_order"]
+    a_loadorder.is_sorted = updated["is_sorted"]
+    a_loadorder.hints = updated["hints"]
+    return a_loadorder
+
+
+def update_batch(fromfiles, warningsonly=False, priority_sort=False, jobs=1, trace=None, timings=None):
+    """
+    Sort the load order in each of fromfiles, against rules that are only read once.
+
+    With more than one job, the load orders are sorted by that many processes, that each read the rules once.
+    (A ruleParser.ParseTrace or timings.Timings can't be shared with other processes,
+    so tracing or timing sorts them all in this one.)
+    The results of the sorts are saved to the result cache once, when they are all done.
+    :returns: An iterator over (Loadorder, output of Loadorder.update) for each file, in the same order as fromfiles
+    """
+    results = ResultCache(get_result_cache_file(), autosave=False)
+    if jobs <= 1 or len(fromfiles) <= 1 or trace is not None or timings is not None:
+        for a_loadorder in read_batch(fromfiles, trace, timings, results):
+            yield a_loadorder, a_loadorder.update(None, warningsonly, priority_sort)
+        results.save()
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_start_worker,
+                             initargs=(get_user_path(), logging.getLogger().getEffectiveLevel())) as pool:
+        n = len(fromfiles)
+        for (fromfile, updated) in zip(fromfiles, pool.map(_update_file, fromfiles, [warningsonly] * n,
+                                                            [priority_sort] * n)):
+            for (key, result) in updated["results"].items():
+                results.put(key, result)
+            yield _updated_loadorder(fromfile, updated), updated["messages"]
+    results.save()
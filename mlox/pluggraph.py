@@ -1,10 +1,32 @@
 import logging
-import json
-from pprint import PrettyPrinter
+import heapq
+from array import array
 
 pluggraph_logger = logging.getLogger('mlox.pluggraph')
 
 
+def report_cycle(where, plug1, plug2, out_stream=None):
+    """Let the user know that an edge from plug1 to plug2 was not added, because it would make a cycle."""
+    # (where == "") when adding edges from psuedo-rules we
+    # create from our current plugin list, We ignore cycles in
+    # this case because they do not matter.
+    # (where != "") when it is an edge from a rules file, and in
+    # that case we do want to see cycle errors.
+    cycle_detected = "%s: Cycle detected, not adding: \"%s\" -> \"%s\"" % (where, plug1, plug2)
+
+    if where == "":
+        pluggraph_logger.debug(cycle_detected)
+    else:
+        pluggraph_logger.warning(cycle_detected)
+        if out_stream is not None:
+            print(f"WARNING {cycle_detected}", file=out_stream)
+
+
+def _sink(end):
+    """The virtual node that the end edges to the end plugin end lead to (see pluggraph.end_plugins)"""
+    return ("nearend", end)
+
+
 class pluggraph:
     """A graph structure built from ordering rules which specify plugin load (partial) order"""
 
@@ -26,6 +48,33 @@ class pluggraph:
         # nodes (plugins) that should be pushed nearest to bottom of load order,
         # if possible.
         self.nearend = []
+        # parents is the reverse of nodes, each key is a plugin, and each value
+        # is a list of the plugins that have an edge to it.
+        # For the example above: {"bar.esp": ["foo.esp"], "baz.esp": ["foo.esp"]}
+        self.parents = {}
+        # topo_index is a topological order of every plugin that has an edge,
+        # kept up to date as edges are added (Pearce-Kelly), so that every
+        # edge u -> v satisfies topo_index[u] < topo_index[v].
+        # This lets add_edge accept most edges without searching the graph.
+        self.topo_index = {}
+        self._next_index = 0
+        # where is the provenance of every edge, each key is a plugin, and each
+        # value is a dictionary of where the edge to each of its children came from.
+        # For the example above: {"foo.esp": {"bar.esp": "mlox_base.txt:12", "baz.esp": ""}}
+        # ("" is an edge from a pseudo-rule)
+        self.where = {}
+        # The active [NearEnd] plugins, in the order add_nearend_constraints handled them.
+        # Each one has to follow every active plugin that doesn't already have to follow it.
+        # Instead of an edge from each of those plugins to it, each end plugin has a sink:
+        # a virtual node, with its own place in topo_index, that those plugins have "end edges" to,
+        # and that has an edge to the end plugin. The cycle checks follow end edges like any other,
+        # but they are never added to nodes.
+        self.end_plugins = []
+        self.end_active = set()  # the active plugins, which have end edges
+        self.end_excluded = {}  # end plugin: the plugins without an end edge to it
+        self.end_split = {}  # plugin: the position in its children that its end edges sit at
+        self.end_children = {}  # plugin: the sinks it has end edges to, and sink: [its end plugin]
+        self.end_parents = {}  # sink: the plugins with end edges to it, and end plugin: [its sink]
 
     def can_reach(self, startnode, plugin):
         """Return True if startnode can reach plugin in the graph, False otherwise."""
@@ -40,42 +89,168 @@ class pluggraph:
                 stack.extend([child for child in self.nodes[p] if child not in seen])
         return False, stack
 
+    def _index_of(self, plugin):
+        """Return the topological index of plugin, giving new plugins the next free index."""
+        index = self.topo_index.get(plugin)
+        if index is None:
+            index = self.topo_index[plugin] = self._next_index
+            self._next_index += 1
+        return index
+
+    def _all_children(self, node):
+        """The children of node, including the sinks of its end edges"""
+        children = self.nodes.get(node, [])
+        return children + self.end_children[node] if node in self.end_children else children
+
+    def _forward_region(self, startnode, plugin, upper):
+        """
+        Find every node reachable from startnode whose topological index is below upper.
+
+        Nodes at or above upper can not lead to plugin (whose index is upper),
+        so the search never leaves the affected region of the order.
+        :returns: The list of nodes found, or None if plugin is reachable (a cycle)
+        """
+        (nodes, end_children, topo_index) = (self.nodes, self.end_children, self.topo_index)
+        found = [startnode]
+        seen = {startnode}
+        stack = [startnode]
+        while stack:
+            node = stack.pop()
+            children = nodes.get(node, [])
+            if node in end_children:
+                children = children + end_children[node]
+            for child in children:
+                if child == plugin:
+                    return None
+                if child not in seen and topo_index[child] < upper:
+                    seen.add(child)
+                    found.append(child)
+                    stack.append(child)
+        return found
+
+    def _backward_region(self, startnode, lower):
+        """Find every node that can reach startnode whose topological index is above lower."""
+        (parents, end_parents, topo_index) = (self.parents, self.end_parents, self.topo_index)
+        found = [startnode]
+        seen = {startnode}
+        stack = [startnode]
+        while stack:
+            node = stack.pop()
+            node_parents = parents.get(node, [])
+            if node in end_parents:
+                node_parents = node_parents + end_parents[node]
+            for parent in node_parents:
+                if parent not in seen and topo_index[parent] > lower:
+                    seen.add(parent)
+                    found.append(parent)
+                    stack.append(parent)
+        return found
+
+    def _reorder(self, backward, forward):
+        """
+        Shift the nodes of backward ahead of the nodes of forward in the topological order.
+
+        Only the indexes already used by those nodes are reassigned, the rest of the order is untouched.
+        """
+        backward.sort(key=self.topo_index.__getitem__)
+        forward.sort(key=self.topo_index.__getitem__)
+        moved = backward + forward
+        for node, index in zip(moved, sorted(self.topo_index[node] for node in moved)):
+            self.topo_index[node] = index
+
+    def _creates_cycle(self, plug1, plug2):
+        """
+        Return True if an edge from plug1 to plug2 would create a cycle.
+
+        Otherwise, update the topological order so that the new edge is consistent with it.
+        End edges are part of the order too (through the sinks), so they need no checks of their own.
+        """
+        if plug1 == plug2:
+            return True
+        upper = self._index_of(plug1)
+        lower = self._index_of(plug2)
+        # if plug1 already comes first, plug2 can not reach it
+        if upper > lower:
+            forward = self._forward_region(plug2, plug1, upper)
+            if forward is None:
+                return True
+            self._reorder(self._backward_region(plug1, lower), forward)
+        return False
+
+    def _reach(self, startnode):
+        """Every node startnode can reach, including through end edges (and startnode itself)"""
+        seen = {startnode}
+        stack = [startnode]
+        while stack:
+            for child in self._all_children(stack.pop()):
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    def _place_sink(self, sink, reach):
+        """
+        Give sink a place in the topological order, after every node outside reach, and before every node in it.
+
+        Nothing in reach (what the sink's end plugin can reach) has an edge to a node outside it,
+        so the sink and reach can be moved to the end of the order, leaving every other node where it is.
+        """
+        moved = [sink] + sorted(reach, key=self.topo_index.__getitem__)
+        for (index, node) in enumerate(moved, self._next_index):
+            self.topo_index[node] = index
+        self._next_index += len(moved)
+
+    def add_nearend_constraints(self, active):
+        """
+        Make the [NearEnd] plugins that are active follow every other active plugin, as long as that doesn't
+        make a cycle. The graph is sorted exactly as if there were an edge from each active plugin to each
+        of them, but those edges aren't added, and don't each need checking for cycles.
+        Each end plugin costs one search of what it can reach, and one pass over the topological order.
+        """
+        self.end_active = set(active)
+        for p in active:
+            self._index_of(p)
+        for end in self.nearend:
+            if end not in self.end_active or end in self.end_excluded:
+                continue
+            # Plugins that end can reach would make a cycle, and those that already have an edge to it don't need one
+            reach = self._reach(end)
+            excluded = reach | set(self.parents.get(end, []))
+            sink = _sink(end)
+            self._place_sink(sink, reach)
+            self.end_parents[sink] = []
+            for p in active:
+                if p not in excluded:
+                    self.end_split.setdefault(p, len(self.nodes.setdefault(p, [])))
+                    self.end_children.setdefault(p, []).append(sink)
+                    self.end_parents[sink].append(p)
+            self.end_children[sink] = [end]
+            self.end_parents[end] = [sink]
+            self.end_plugins.append(end)
+            self.end_excluded[end] = excluded
+
     def add_edge(self, where, plug1, plug2, out_stream=None):
         """Add an edge to our graph connecting plug1 to plug2, which means
-        that plug2 follows plug1 in the load order. Since we check every new
-        edge to see if it will make a cycle, the process of adding all edges
-        will be O(square(n)/2) in the worst case of a totally ordered
-        set. This could mean a long run-time for the Oblivion data, which
-        is currently a total order of a set of about 5000 plugins."""
+        that plug2 follows plug1 in the load order. We check every new
+        edge to see if it will make a cycle, using an incrementally
+        maintained topological order (Pearce-Kelly). An edge that agrees
+        with the current order is accepted immediately, otherwise only
+        the part of the graph between plug2 and plug1 in the order is
+        searched, instead of everything reachable from plug2."""
         # before adding edge from plug1 to plug2 (meaning plug1 is parent of plug2),
         # we look to see if plug2 is already a parent of plug1, if so, we have
         # detected a cycle, which we disallow.
-        can_reach, stack = self.can_reach(plug2, plug1)
-        if can_reach:
-            # (where == "") when adding edges from psuedo-rules we
-            # create from our current plugin list, We ignore cycles in
-            # this case because they do not matter.
-            # (where != "") when it is an edge from a rules file, and in
-            # that case we do want to see cycle errors.
-            cycle_detected = "%s: Cycle detected, not adding: \"%s\" -> \"%s\"" % (where, plug1, plug2)
-
-            # cycle_detected += f"\nStack:\n"
-            # for node in stack:
-            #     cycle_detected += f">   {node}\n"
-
-            if where == "":
-                pluggraph_logger.debug(cycle_detected)
-            else:
-                pluggraph_logger.warning(cycle_detected)
-                if out_stream is not None:
-                    print(f"WARNING {cycle_detected}", file=out_stream)
+        if self._creates_cycle(plug1, plug2):
+            report_cycle(where, plug1, plug2, out_stream)
             return False
         self.nodes.setdefault(plug1, [])
-        if plug2 in self.nodes[plug1]:  # edge already exists
+        if plug2 in self.nodes[plug1] or _sink(plug2) in self.end_children.get(plug1, []):  # edge already exists
             pluggraph_logger.debug("%s: Not adding duplicate Edge: \"%s\" -> \"%s\"", where, plug1, plug2)
             return True
         # add plug2 to the graph as a child of plug1
         self.nodes[plug1].append(plug2)
+        self.parents.setdefault(plug2, []).append(plug1)
+        self.where.setdefault(plug1, {})[plug2] = where
         self.incoming_count[plug2] = self.incoming_count.setdefault(plug2, 0) + 1
         pluggraph_logger.debug("adding edge: %s -> %s" % (plug1, plug2))
         return (True)
@@ -97,7 +272,199 @@ class pluggraph:
         """
         Tell the user all the plugins mlox thinks should follow <what>
         """
-        seen = {}
+        return self.compact().explain(what, active_plugins)
+
+    def topo_sort(self):
+        """topological sort, of a compact copy of the graph (so the graph can be sorted again)"""
+        return self.compact().topo_sort()
+
+    def copy(self):
+        """
+        Get a copy of this graph, that edges can be added to without changing this one.
+
+        This lets the graph built from the rules be kept, and reused for sorting more than once.
+        """
+        graph = pluggraph()
+        graph.nodes = {node: list(children) for (node, children) in self.nodes.items()}
+        graph.parents = {node: list(parents) for (node, parents) in self.parents.items()}
+        graph.incoming_count = dict(self.incoming_count)
+        graph.nearstart = list(self.nearstart)
+        graph.nearend = list(self.nearend)
+        graph.where = {node: dict(where) for (node, where) in self.where.items()}
+        graph.topo_index = dict(self.topo_index)
+        graph._next_index = self._next_index
+        graph.end_plugins = list(self.end_plugins)
+        graph.end_active = set(self.end_active)
+        graph.end_excluded = {end: set(excluded) for (end, excluded) in self.end_excluded.items()}
+        graph.end_split = dict(self.end_split)
+        graph.end_children = {node: list(sinks) for (node, sinks) in self.end_children.items()}
+        graph.end_parents = {node: list(parents) for (node, parents) in self.end_parents.items()}
+        return graph
+
+    def compact(self):
+        """Get a compact, read only, copy of this graph, for sorting and searching it."""
+        return compactgraph(self)
+
+    def to_map(self):
+        """The counterpart of from_map, a dictionary of the graph that can be saved as JSON."""
+        return {'nodes': self.nodes, 'incoming_count': self.incoming_count, 'nearstart': self.nearstart,
+                'nearend': self.nearend, 'where': self.where}
+
+    def from_map(self, mapper: dict):
+        self.nodes = mapper['nodes']
+        self.incoming_count = mapper['incoming_count']
+        self.nearstart = mapper['nearstart']
+        self.nearend = mapper['nearend']
+        self.where = mapper.get('where', {})
+        self._rebuild_index()
+        return self
+
+    def _rebuild_index(self):
+        """Recompute parents and topo_index from nodes, for a graph that was not built with add_edge."""
+        self.parents = {}
+        for (node, children) in self.nodes.items():
+            for child in children:
+                self.parents.setdefault(child, []).append(node)
+        # Depth first post-order, reversed, is a topological order
+        self.topo_index = {}
+        post_order = []
+        for start in self.nodes:
+            if start in self.topo_index:
+                continue
+            self.topo_index[start] = None
+            stack = [(start, iter(self.nodes.get(start, [])))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if child not in self.topo_index:
+                        self.topo_index[child] = None
+                        stack.append((child, iter(self.nodes.get(child, []))))
+                        break
+                else:
+                    stack.pop()
+                    post_order.append(node)
+        post_order.reverse()
+        self.topo_index = {node: index for (index, node) in enumerate(post_order)}
+        self._next_index = len(post_order)
+
+
+class compactgraph:
+    """
+    A read only copy of a pluggraph, with plugin names interned as integer ids, and children stored in arrays.
+
+    The children of the plugin with id i are children[offsets[i]:offsets[i + 1]], in the same order as in the
+    pluggraph, so sorting gives exactly the same results. Sorting does not modify the graph, so it can be repeated.
+    End edges (see pluggraph.end_plugins) are not stored with the other children, but kept per plugin, and put in
+    among them where they belong when needed.
+    """
+
+    def __init__(self, graph):
+        # Plugins with a node come first, in the order of graph.nodes, since that is the order roots are found in
+        self.names = list(graph.nodes)
+        self.n_nodes = len(self.names)
+        self.ids = {name: i for (i, name) in enumerate(self.names)}
+        self.offsets = array('l', [0])
+        self.children = array('l')
+        for children in graph.nodes.values():
+            self.children.extend(self._intern(child) for child in children)
+            self.offsets.append(len(self.children))
+        self.nearstart = array('l', map(self._intern, graph.nearstart))
+        self.nearend = array('l', map(self._intern, graph.nearend))
+        self.end_plugins = array('l', map(self._intern, graph.end_plugins))
+        # end plugin id: the ids of the plugins with an end edge to it
+        self.end_parents = {self.ids[end]: [self._intern(p) for p in graph.end_parents[_sink(end)]]
+                            for end in graph.end_plugins}
+        # plugin id: the ids of the end plugins it has an end edge to, in the order of end_plugins
+        self.end_children = {self._intern(p): array('l', [self.ids[end] for (kind, end) in sinks])
+                             for (p, sinks) in graph.end_children.items() if isinstance(p, str)}
+        # Plugins without a node have no children
+        self.offsets.extend([len(self.children)] * (len(self.names) - self.n_nodes))
+        self.incoming_count = array('l', [0]) * len(self.names)
+        for child in self.children:
+            self.incoming_count[child] += 1
+        # The parents of the plugin with id i are parents[parent_offsets[i]:parent_offsets[i + 1]]
+        self.parent_offsets = array('l', [0])
+        for count in self.incoming_count:
+            self.parent_offsets.append(self.parent_offsets[-1] + count)
+        self.parents = array('l', [0]) * len(self.children)
+        fill = array('l', self.parent_offsets[:-1])
+        for parent in range(len(self.names)):
+            for child in self.children[self.offsets[parent]:self.offsets[parent + 1]]:
+                self.parents[fill[child]] = parent
+                fill[child] += 1
+        # The end edges of the plugin with id i sit at children[end_split[i]]
+        self.end_split = array('l', self.offsets[1:])
+        for (plugin, split) in graph.end_split.items():
+            self.end_split[self.ids[plugin]] = self.offsets[self.ids[plugin]] + split
+        for (end, parents) in self.end_parents.items():
+            self.incoming_count[end] += len(parents)
+
+    def _intern(self, name):
+        """Get the id of a plugin name, giving it a new one if needed"""
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def _children(self, i):
+        """The ids of the children of the plugin with id i, including the end plugins it has an end edge to"""
+        children = self.children[self.offsets[i]:self.offsets[i + 1]]
+        ends = self.end_children.get(i)
+        if ends:
+            split = self.end_split[i] - self.offsets[i]
+            return children[:split] + ends + children[split:]
+        return children
+
+    def _can_reach(self, start, target):
+        """Return True if the plugin with id start can reach the one with id target"""
+        seen = {start}
+        stack = [start]
+        while stack:
+            p = stack.pop()
+            if p == target:
+                return True
+            for child in self._children(p):
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return False
+
+    def can_reach(self, startnode, plugin):
+        """Return True if startnode can reach plugin in the graph, False otherwise."""
+        if startnode not in self.ids or plugin not in self.ids:
+            return startnode == plugin
+        return self._can_reach(self.ids[startnode], self.ids[plugin])
+
+    def _reaching(self, target, wanted):
+        """
+        Find the members of wanted (a set of ids) that can reach the plugin with id target (including itself).
+
+        This searches backwards from target, and stops as soon as every member of wanted has been found.
+        """
+        (parents, offsets) = (self.parents, self.parent_offsets)
+        found = {target} & wanted
+        seen = {target}
+        stack = [target]
+        while stack and len(found) < len(wanted):
+            p = stack.pop()
+            p_parents = parents[offsets[p]:offsets[p + 1]]
+            if p in self.end_parents:
+                p_parents = p_parents.tolist() + self.end_parents[p]
+            for parent in p_parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+                    if parent in wanted:
+                        found.add(parent)
+        return found
+
+    def explain(self, what, active_plugins):
+        """
+        Tell the user all the plugins mlox thinks should follow <what>
+        """
+        active_plugins = set(active_plugins)
+        seen = bytearray(len(self.names))
         output = ""
         output += "This is a picture of all the plugins mlox thinks should follow {0}\n".format(what)
         output += "Child plugins are indented with respect to their parents\n"
@@ -106,17 +473,17 @@ class pluggraph:
 
         def explain_rec(indent, n):
             output = ""
-            if n in seen:
+            if seen[n]:
                 return
-            seen[n] = True
-            if n in self.nodes:
-                for child in self.nodes[n]:
-                    prefix = indent.replace(" ", "+") if child in active_plugins else indent.replace(" ", "=")
-                    output += "%s%s\n" % (prefix, child)
-                    explain_rec(" " + indent, child)
+            seen[n] = 1
+            for child in self._children(n):
+                prefix = indent.replace(" ", "+") if self.names[child] in active_plugins else indent.replace(" ", "=")
+                output += "%s%s\n" % (prefix, self.names[child])
+                explain_rec(" " + indent, child)
             return output
 
-        output += explain_rec(" ", what.lower())
+        if what.lower() in self.ids:
+            output += explain_rec(" ", self.ids[what.lower()])
         return output
 
     def topo_sort(self):
@@ -124,60 +491,86 @@ class pluggraph:
 
         def remove_roots(roots, which):
             """This function is used to yank roots out of the main list of graph roots to
-            support the NearStart and NearEnd rules."""
+            support the NearStart and NearEnd rules.
+            Instead of checking if each root can reach each plugin in which, the roots that
+            can reach a plugin are found with one search backwards from it."""
             removed = []
             for p in which:
-                leftover = []
-                while len(roots) > 0:
-                    r = roots.pop(0)
-                    can_reach, stack = self.can_reach(r, p)
-                    if can_reach:
-                        removed.append(r)
-                    else:
-                        leftover.append(r)
-                roots = leftover
+                if len(roots) == 0:
+                    break
+                reaching = self._reaching(p, set(roots))
+                removed += [r for r in roots if r in reaching]
+                roots = [r for r in roots if r not in reaching]
             return (removed, roots)
 
         # find the roots of the graph
-        roots = [node for node in self.nodes if self.incoming_count.get(node, 0) == 0]
+        roots = [i for i in range(self.n_nodes) if self.incoming_count[i] == 0]
         pluggraph_logger.debug("========== BEGIN TOPOLOGICAL SORT DEBUG INFO ==========")
-        pluggraph_logger.debug("graph before sort (node: children)")
-        pluggraph_logger.debug(PrettyPrinter(indent=4).pformat(self.nodes))
-        pluggraph_logger.debug("roots:\n  %s" % ("\n  ".join(roots)))
+        pluggraph_logger.debug("roots:\n  %s" % ("\n  ".join(self.names[i] for i in roots)))
         if len(roots) > 0:
             # use the nearstart information to pull preferred plugins to top of load order
-            (top_roots, roots) = remove_roots(roots, self.nearstart)
-            bottom_roots = roots  # any leftovers go at the end
-            roots = top_roots + bottom_roots
-            pluggraph_logger.debug("nearstart:\n  %s" % ("\n  ".join(self.nearstart)))
-            pluggraph_logger.debug("top roots:\n  %s" % ("\n  ".join(top_roots)))
-            pluggraph_logger.debug("nearend:\n  %s" % ("\n  ".join(self.nearend)))
-            pluggraph_logger.debug("bottom roots:\n  %s" % ("\n  ".join(bottom_roots)))
-            pluggraph_logger.debug("newroots:\n  %s" % ("\n  ".join(roots)))
+            (top_roots, bottom_roots) = remove_roots(roots, self.nearstart)
+            roots = top_roots + bottom_roots  # any leftovers go at the end
+            pluggraph_logger.debug("top roots:\n  %s" % ("\n  ".join(self.names[i] for i in top_roots)))
+            pluggraph_logger.debug("bottom roots:\n  %s" % ("\n  ".join(self.names[i] for i in bottom_roots)))
         pluggraph_logger.debug("========== END TOPOLOGICAL SORT DEBUG INFO ==========\n")
-        # now do the actual topological sort
-        # based on http://www.bitformation.com/art/python_toposort.html
+        # now do the actual topological sort, on a copy of the incoming counts
+        incoming_count = array('l', self.incoming_count)
         roots.reverse()
         sorted_items = []
         while len(roots) != 0:
             root = roots.pop()
             sorted_items.append(root)
-            if not root in self.nodes:
-                continue
-            for child in self.nodes[root]:
-                self.incoming_count[child] -= 1
-                if self.incoming_count[child] == 0:
+            for child in self._children(root):
+                incoming_count[child] -= 1
+                if incoming_count[child] == 0:
                     roots.append(child)
-            del self.nodes[root]
-        if len(self.nodes.items()) != 0:
+        if any(incoming_count[i] > 0 for i in range(self.n_nodes)):
             pluggraph_logger.error("Topological Sort Failed!")
-            pluggraph_logger.debug(PrettyPrinter(indent=4).pformat(self.nodes.items()))
             return None
-        return sorted_items
+        return [self.names[i] for i in sorted_items]
 
-    def from_map(self, mapper: dict):
-        self.nodes = mapper['nodes']
-        self.incoming_count = mapper['incoming_count']
-        self.nearstart = mapper['nearstart']
-        self.nearend = mapper['nearend']
-        return self
+    def priority_sort(self, order):
+        """
+        Topological sort that keeps as close to order (the current load order) as the graph allows.
+
+        Each plugin's priority is the lowest of its own position, and the priorities of everything that
+        has to follow it, with [NearStart] plugins ahead of everything else. The ready plugin with the lowest
+        priority is always taken next, so a plugin only moves when the rules make it. This replaces
+        the edges add_current_order adds between neighbouring plugins.
+        """
+        unranked = (2, 0)
+        own = [unranked] * len(self.names)
+        for (i, plugin) in enumerate(order):
+            if plugin in self.ids:
+                own[self.ids[plugin]] = (1, i)
+        for (i, plugin) in enumerate(self.nearstart):
+            own[plugin] = min(own[plugin], (0, i))
+        # Work out the priorities from the last plugins backwards, in any topological order
+        incoming_count = array('l', self.incoming_count)
+        plain_order = [i for i in range(self.n_nodes) if incoming_count[i] == 0]
+        for i in plain_order:
+            for child in self._children(i):
+                incoming_count[child] -= 1
+                if incoming_count[child] == 0:
+                    plain_order.append(child)
+        if any(incoming_count):
+            pluggraph_logger.error("Topological Sort Failed!")
+            return None
+        priority = list(own)
+        for i in reversed(plain_order):
+            for child in self._children(i):
+                if priority[child] < priority[i]:
+                    priority[i] = priority[child]
+        incoming_count = array('l', self.incoming_count)
+        ready = [(priority[i], own[i], i) for i in range(self.n_nodes) if incoming_count[i] == 0]
+        heapq.heapify(ready)
+        sorted_items = []
+        while ready:
+            root = heapq.heappop(ready)[2]
+            sorted_items.append(root)
+            for child in self._children(root):
+                incoming_count[child] -= 1
+                if incoming_count[child] == 0:
+                    heapq.heappush(ready, (priority[child], own[child], child))
+        return [self.names[i] for i in sorted_items]
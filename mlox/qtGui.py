@@ -14,7 +14,7 @@ from PyQt5.QtQml import QQmlApplicationEngine
 from PyQt5.QtQuick import QQuickImageProvider
 from PyQt5.QtWidgets import QApplication, QDialog, QPlainTextEdit, QMessageBox, QProgressDialog
 
-from mlox import version
+from mlox import version, ruleParser
 from mlox.loadOrder import Loadorder
 from mlox.resources import resource_manager
 
@@ -143,6 +143,7 @@ class MloxGui(QObject):
         self.Old = ""  # old original loadorder
         self.Msg = ""  # messages output
         self.can_update = True  # If the load order can be saved or not
+        self.rules = ruleParser.RuleCache()  # the rules read, shared by every analysis (reload) of a load order
 
         # Set up logging
         dbg_formatter = logging.Formatter('%(levelname)s (%(name)s): %(message)s')
@@ -236,7 +237,7 @@ class MloxGui(QObject):
         except Exception as e:
             gui_logger.warning('Unable to connect to {0}, skipping update check.'.format(url))
 
-        self.lo = Loadorder()
+        self.lo = Loadorder(self.rules)
         if fromfile is not None:
             self.lo.read_from_file(fromfile)
         else:
@@ -74,6 +74,14 @@ def get_my_user_file() -> str:
     return os.path.join(depot_path, UPDATE_MY_USER)
 
 
+def get_header_cache_file() -> str:
+    return os.path.join(depot_path, "mlox_header_cache.json")
+
+
+def get_result_cache_file() -> str:
+    return os.path.join(depot_path, "mlox_result_cache.json")
+
+
 def settings_save():
     with open(get_settings_file(), "w") as write:
         json.dump(settings, write, indent=4)
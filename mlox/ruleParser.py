@@ -1,29 +1,45 @@
+import hashlib
 import io
+import json
 import logging
+import mmap
 import os
 import re
+import struct
+import time
+from bisect import bisect_left
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pprint import PrettyPrinter
 
 from mlox import fileFinder, pluggraph
+from mlox.timings import phase
+from mlox.utils import sha256sum
 
 # comments start with ';'
 re_comment = re.compile(r'(?:^|\s);.*$')
+# The patterns used by the lexer are matched with Pattern.match(line, pos), so they don't start with ^
 # re_rule matches the start of a rule.
 # TBD: check end-bracket pattern
-re_rule = re.compile(r'^\[(version|order|nearend|nearstart|conflict|note|patch|requires)((?:\s+.[^]]*)?)](.*)$',
+re_rule = re.compile(r'\[(version|order|nearend|nearstart|conflict|note|patch|requires)((?:\s+.[^]]*)?)](.*)$',
                      re.IGNORECASE)
 
 # line for multiline messages
-re_message = re.compile(r'^\s')
+re_message = re.compile(r'\s')
 # pattern used to match a string that should only contain a plugin name, no slop
-re_plugin = re.compile(r'^(\S.*?\.es[mp]\b)([\s]*)', re.IGNORECASE)
+re_plugin = re.compile(r'(\S.*?\.es[mp]\b)([\s]*)', re.IGNORECASE)
 # metacharacters for filename expansion
 re_plugin_meta = re.compile(r'([*?])')
 re_plugin_metaver = re.compile(r'(<VER>)', re.IGNORECASE)
 re_escape_meta = re.compile(r'([()+.])')
+# the start of a filename that is matched literally, used to narrow down the plugins a filename can expand to
+re_literal_prefix = re.compile(r'[^*?<\[\]^$]*')
+# regular expression syntax (other than the characters above) that can make a filename match without its prefix
+re_unindexable = re.compile(r'[|{}\\]')
 # for recognizing our functions:
-re_fun = re.compile(r'^\[(ALL|ANY|NOT|DESC|VER|SIZE|MWSE-LUA)\s*', re.IGNORECASE)
-re_end_fun = re.compile(r'^]\s*')
+re_fun = re.compile(r'\[(ALL|ANY|NOT|DESC|VER|SIZE|MWSE-LUA)\s*', re.IGNORECASE)
+re_end_fun = re.compile(r']\s*')
 re_desc_fun = re.compile(r'\[DESC\s*(!?)/([^/]+)/\s+([^]]+)]', re.IGNORECASE)
 re_mwselua_fun = re.compile(r'\[MWSE-LUA\s*(!?)/([^/]+)/\s+([^]]+)]', re.IGNORECASE)
 # for parsing a size predicate
@@ -35,6 +51,7 @@ re_ver_delim = re.compile(ver_delim)
 plugin_version = r'(\d+(?:%s?\d+)*[a-zA-Z]?)' % ver_delim
 re_alpha_tail = re.compile(r'(\d+)([a-z])', re.IGNORECASE)
 re_ver_fun = re.compile(r'\[VER\s*([=<>])\s*%s\s*([^]]+)]' % plugin_version, re.IGNORECASE)
+predicate_patterns = {"DESC": re_desc_fun, "VER": re_ver_fun, "SIZE": re_size_fun, "MWSE-LUA": re_mwselua_fun}
 # for grabbing version numbers from filenames
 re_filename_version = re.compile(r'\D%s\D*\.es[mp]' % plugin_version, re.IGNORECASE)
 # for grabbing version numbers from plugin header description fields
@@ -52,15 +69,42 @@ re_plugin_illegal = re.compile(r'[\"\\/=+<>:;|^]')
 
 version_operators = {'=': True, '<': True, '>': True}
 
-tes3_min_plugin_size = 362
+# The parts of a plugin's header record, see read_header()
+tes3_record = struct.Struct("<4sIII")  # "TES3", size of the data, unused, flags
+tes3_subrecord = struct.Struct("<4sI")  # type, size
+tes3_hedr = struct.Struct("<fI32s256sI")  # version, file type, author, description, number of records
+tes4_record = struct.Struct("<4sIIII")  # "TES4", size of the data, flags, form id, version control info
+tes4_subrecord = struct.Struct("<4sH")  # type, size
+tes4_hedr = struct.Struct("<fII")  # version, number of records, next object id
+# The text in plugin headers is in the Windows code page the games use
+header_encoding = "cp1252"
+
+# Change this whenever the layout of compiled rules changes, so old caches are not used
+COMPILED_RULES_FORMAT = 2
+
+# Version of the graph snapshot format, for throwing away snapshots saved by older versions of mlox
+GRAPH_SNAPSHOT_FORMAT = 2
+
+# How many graph snapshots are kept in the cache directory for each rules file
+GRAPH_SNAPSHOTS = 4
+
+# How many plugin headers to read at the same time
+HEADER_PREFETCH_WORKERS = 8
+
+# How many graphs a RuleCache keeps (each is the whole graph built from mlox_base.txt)
+SHARED_GRAPHS = 8
+
+# How many records a ParseTrace keeps
+TRACE_SIZE = 5000
 
 parse_logger = logging.getLogger('mlox.parser')
 
 
-def get_version(plugin, data_dir=None):
+def get_version(plugin, data_dir=None, headers=None):
     """
     Get the version information from a plugin
 
+    :param headers: An optional HeaderCache to read the plugin's description through
     :return: A tuple containing the version extracted from the file name, and the version from the plugin's description.
     """
     match = re_filename_version.search(plugin)
@@ -69,14 +113,11 @@ def get_version(plugin, data_dir=None):
     if isinstance(data_dir, str):
         data_dir = fileFinder.caseless_dirlist(data_dir)
     if isinstance(data_dir, fileFinder.caseless_dirlist):
-        desc = plugin_description(data_dir.find_path(plugin))
-        if desc is not None:
-            match = re_header_version.search(desc)
-            desc_ver = match.group(1) if match else None
+        if headers is None:
+            headers = HeaderCache()
+        desc_ver = headers.version(data_dir.find_path(plugin))
     if file_ver is not None:
         file_ver = format_version(file_ver)
-    if desc_ver is not None:
-        desc_ver = format_version(desc_ver)
     return file_ver, desc_ver
 
 
@@ -95,108 +136,818 @@ def format_version(ver):
     return "%05d.%05d.%05d.%s" % (v[0], v[1], v[2], alpha)
 
 
-def plugin_description(plugin):
-    """Read the description field of a TES3/TES4 plugin file header"""
+PluginHeader = namedtuple("PluginHeader", "game author description records masters")
+
+
+def _header_string(mm, start, end):
+    """Decode a NUL terminated string from the plugin header in mm, that has to end by end"""
+    nul = mm.find(b"\x00", start, end)
+    return mm[start:end if nul == -1 else nul].decode(header_encoding, errors="replace")
+
+
+def _tes3_header(mm):
+    """Read the header of a Morrowind plugin"""
+    (name, size, unused, flags) = tes3_record.unpack_from(mm, 0)
+    end = min(len(mm), tes3_record.size + size)
+    pos = tes3_record.size
+    hedr = None
+    masters = []
+    while pos + tes3_subrecord.size <= end:
+        (sub, sub_size) = tes3_subrecord.unpack_from(mm, pos)
+        pos += tes3_subrecord.size
+        if sub == b"HEDR" and sub_size >= tes3_hedr.size:
+            hedr = tes3_hedr.unpack_from(mm, pos)
+        elif sub == b"MAST":
+            masters.append(_header_string(mm, pos, min(end, pos + sub_size)))
+        pos += sub_size
+    if hedr is None:
+        raise struct.error("no HEDR subrecord")
+    (version, file_type, author, description, records) = hedr
+    return PluginHeader("TES3", _header_string(author, 0, len(author)),
+                        _header_string(description, 0, len(description)), records, masters)
+
+
+def _tes4_header(mm):
+    """Read the header of an Oblivion (or later) plugin"""
+    (name, size, flags, form_id, vc_info) = tes4_record.unpack_from(mm, 0)
+    pos = tes4_record.size
+    if mm[pos:pos + 4] != b"HEDR" and mm[pos + 4:pos + 8] == b"HEDR":
+        pos += 4  # Skyrim and later have 4 more bytes of version control info
+    end = min(len(mm), pos + size)
+    records = None
+    (author, description, masters) = ("", "", [])
+    while pos + tes4_subrecord.size <= end:
+        (sub, sub_size) = tes4_subrecord.unpack_from(mm, pos)
+        pos += tes4_subrecord.size
+        if sub == b"HEDR" and sub_size >= tes4_hedr.size:
+            records = tes4_hedr.unpack_from(mm, pos)[1]
+        elif sub == b"CNAM":
+            author = _header_string(mm, pos, min(end, pos + sub_size))
+        elif sub == b"SNAM":
+            description = _header_string(mm, pos, min(end, pos + sub_size))
+        elif sub == b"MAST":
+            masters.append(_header_string(mm, pos, min(end, pos + sub_size)))
+        pos += sub_size
+    if records is None:
+        raise struct.error("no HEDR subrecord")
+    return PluginHeader("TES4", author, description, records, masters)
+
+
+def read_header(plugin):
+    """
+    Read the header record of a TES3 (Morrowind) or TES4 (Oblivion and later) plugin file.
+
+    The file is memory mapped, and only the fields of the header are copied out of it.
+    :returns: A PluginHeader, with the author, description, number of records and the plugin's masters,
+      or None if the file is not a plugin (or can't be read)
+    """
     try:
-        inp = open(plugin, 'rb')
+        with open(plugin, 'rb') as inp:
+            if os.fstat(inp.fileno()).st_size < 4:
+                return None
+            with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[0:4] == b"TES3":
+                    return _tes3_header(mm)
+                if mm[0:4] == b"TES4":
+                    return _tes4_header(mm)
+                return None
     except IOError:
         parse_logger.warning("Unable to open plugin file:  {0}".format(plugin))
-        return ""
-    block = inp.read(4096)
-    inp.close()
-    if block[0:4] == b"TES3":  # Morrowind
-        if len(block) < tes3_min_plugin_size:
-            parse_logger.warning("Cannot read plugin description(%s): file too short, returning NULL string", plugin)
-            return ""
-        desc = block[64:block.find(b"\x00", 64)]
-        return str(desc)
-    elif block[0:4] == b"TES4":  # Oblivion
-        # This is very cheesy.
-        pos = block.find(b"SNAM", 0)
-        if pos == -1:
-            return ""
-        desc_start = block.find(b"\x00", pos) + 1
-        if desc_start == -1:
-            return ""
-        desc_end = block.find(b"\x00", desc_start)
-        if desc_end == -1:
+    except struct.error as e:
+        parse_logger.warning("Cannot read plugin header(%s): %s", plugin, e)
+    return None
+
+
+def plugin_description(plugin):
+    """Read the description field of a TES3/TES4 plugin file header"""
+    header = read_header(plugin)
+    return "" if header is None else header.description
+
+
+class HeaderCache:
+    """
+    A cache of the information mlox reads from plugin headers.
+
+    Entries are keyed by the plugin's path, and are only used while the plugin's size and modification time match.
+    So each plugin's header is read at most once, and not at all if it hasn't changed since the cache was saved.
+    """
+
+    def __init__(self, cache_file=None, snapshot=None):
+        self.cache_file = cache_file
+        self.snapshot = snapshot  # a fileFinder.dir_snapshot to take plugin sizes and times from, instead of the disk
+        self.entries = None  # path: [size, mtime, description, version from the description, masters]
+        self.checked = set()  # paths whose entries were checked against the file system during this run
+        self.changed = False
+        self.reads = 0  # how many plugin headers were read from the disk
+
+    def _load(self):
+        self.entries = {}
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding="utf-8") as cache:
+                self.entries = json.load(cache)
+        except (IOError, ValueError):
+            parse_logger.warning("Unable to read plugin header cache:  {0}".format(self.cache_file))
+
+    def _check(self, path):
+        """
+        Check a plugin against its cache entry, reading its header if the entry is missing or out of date.
+
+        This doesn't modify the cache, so it's safe to run from several threads at once.
+        :returns: A tuple of the plugin's path, its os.stat() result or None,
+          and its (description, masters) if its header was read
+        """
+        stat = self.snapshot.path_entry(path) if self.snapshot is not None and path else None
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except (OSError, TypeError):
+                return path, None, None
+        entry = self.entries.get(path)
+        # Entries without masters are from before mlox read them, and get read again
+        if entry is not None and len(entry) == 5 and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return path, stat, None
+        return path, stat, self._read(path)
+
+    @staticmethod
+    def _read(path):
+        """:returns: The (description, masters) in a plugin's header"""
+        header = read_header(path)
+        return ("", []) if header is None else (header.description, header.masters)
+
+    def _store(self, path, stat, header):
+        """Record the result of _check()"""
+        if stat is None:
+            return
+        self.checked.add(path)
+        if header is None:
+            return
+        self.reads += 1
+        (desc, masters) = header
+        match = re_header_version.search(desc)
+        self.entries[path] = [stat.st_size, stat.st_mtime_ns, desc, match.group(1) if match else None, masters]
+        self.changed = True
+
+    def _lookup(self, path):
+        """Get the cache entry for a plugin, reading the plugin's header if needed"""
+        if self.entries is None:
+            self._load()
+        if path not in self.checked:
+            (path, stat, header) = self._check(path)
+            if stat is None:
+                self.reads += 1
+                (desc, masters) = self._read(path) if path else ("", [])
+                return [None, None, desc, None, masters]
+            self._store(path, stat, header)
+        return self.entries[path]
+
+    def prefetch(self, paths, workers=HEADER_PREFETCH_WORKERS):
+        """
+        Check and read the headers of many plugins at once, using a pool of threads.
+
+        Afterwards, looking up any of these plugins doesn't touch the disk.
+        """
+        if self.entries is None:
+            self._load()
+        paths = [path for path in set(paths) if path is not None and path not in self.checked]
+        if not paths:
+            return
+        parse_logger.debug("Prefetching {0} plugin headers".format(len(paths)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(self._check, paths):
+                self._store(*result)
+
+    def description(self, path):
+        """Read the description field of a plugin's header"""
+        return self._lookup(path)[2]
+
+    def version(self, path):
+        """The version number found in a plugin's description, in canonical form, or None"""
+        version = self._lookup(path)[3]
+        return None if version is None else format_version(version)
+
+    def size(self, path):
+        """The size of a plugin file"""
+        return self._lookup(path)[0]
+
+    def masters(self, path):
+        """The masters listed in a plugin's header"""
+        return self._lookup(path)[4]
+
+    def prune(self):
+        """Drop the entries of plugins that weren't checked during this run, and no longer exist"""
+        if self.entries is None:
+            return
+        stale = [path for path in self.entries if path not in self.checked and not os.path.isfile(path)]
+        for path in stale:
+            del self.entries[path]
+        if stale:
+            self.changed = True
+
+    def save(self):
+        """Save the cache to cache_file, if there's anything new to save"""
+        if self.cache_file is None:
+            return
+        self.prune()
+        if not self.changed:
+            return
+        try:
+            with open(self.cache_file, 'w', encoding="utf-8") as cache:
+                json.dump(self.entries, cache)
+            self.changed = False
+        except IOError:
+            parse_logger.warning("Unable to save plugin header cache:  {0}".format(self.cache_file))
+
+
+@lru_cache(maxsize=None)
+def filename_regex(plugin: str):
+    """
+    Get the compiled regular expression for a filename from the rules.
+
+    :returns: The compiled regular expression, or None if plugin doesn't use any of the filename expansions
+    """
+    pat = RuleParser._filename_to_regex(plugin)
+    if "^%s$" % re_escape_meta.sub(r'\\\1', plugin) == pat:
+        return None
+    return re.compile(pat, re.IGNORECASE)
+
+
+class ParseTrace:
+    """
+    A record of what the parser did with the rules chosen for tracing, kept in a ring buffer.
+
+    The rules traced are the ones on the chosen lines of the rules files, and the ones that mention one of
+    the chosen plugins (every rule, when nothing is chosen).
+    Tracing costs nothing for the rules that aren't traced: the parser only calls log() when active is set,
+    and a record's message is only formatted when the trace is shown.
+    Only the last size records are kept. A ParseTrace of size 0 never traces anything.
+    """
+
+    def __init__(self, lines=(), plugins=(), size=TRACE_SIZE, echo=False):
+        self.lines = list(lines)  # [(first line, last line), ...]
+        self.plugins = {plugin.lower() for plugin in plugins}
+        self.enabled = size > 0
+        self.echo = echo  # also give every record to parse_logger.debug
+        self.records = deque(maxlen=size)  # (rules file, line number, message, message arguments)
+        self.where = (None, 0)  # the rules file and line of the rule being traced
+        self.active = False  # True while a chosen rule is being parsed or evaluated
+
+    def chosen(self, line_nums, names):
+        """True if a rule on line_nums of the rules file, that mentions the plugins in names, is traced"""
+        if not self.lines and not self.plugins:
+            return True
+        for line_num in line_nums:
+            for (first, last) in self.lines:
+                if first <= line_num <= last:
+                    return True
+        return any(name.lower() in self.plugins for name in names)
+
+    def start(self, rule_file, line_nums, names=()):
+        """Start on a rule, tracing it if it was chosen. The rule is at the first of line_nums"""
+        self.active = self.enabled and self.chosen(line_nums, names)
+        self.where = (rule_file, line_nums[0] if line_nums else 0)
+
+    def stop(self):
+        self.active = False
+
+    def log(self, msg, *args):
+        """Add a record for the rule being traced. msg is formatted with args, when the trace is shown"""
+        self.records.append(self.where + (msg, args))
+        if self.echo:
+            parse_logger.debug("%s:%d: " + msg, *(self.where + args))
+
+    def format(self):
+        """The trace, one line per record"""
+        return ["%s:%d: %s" % (rule_file, line_num, msg % args) for (rule_file, line_num, msg, args) in self.records]
+
+
+class PluginIndex:
+    """
+    An index of a plugin list, for quickly finding the plugins that match a filename from the rules.
+
+    Plugin names are kept in a set for exact lookups, and in sorted order so that a pattern like "Foo *.esp"
+    only needs to be checked against the plugins starting with "foo ".
+    Expansions are remembered, since the same patterns show up in many rules.
+    """
+
+    def __init__(self, plugin_list):
+        self.names = frozenset(plugin_list)
+        # (lowercase name, position in plugin_list, name) in sorted order
+        self.sorted = sorted((p.lower(), i, p) for (i, p) in enumerate(plugin_list))
+        self.keys = [key for (key, i, p) in self.sorted]
+        self.expanded = {}
+
+    @staticmethod
+    def stem(plugin):
+        """The lowercase start of a filename pattern that every plugin it matches must start with"""
+        prefix = re_literal_prefix.match(plugin).group(0).lower()
+        if not prefix.isascii() or re_unindexable.search(plugin):
+            # Case insensitive matching of non ascii characters, or odd regular expressions, can defeat the prefix
             return ""
-        desc = block[desc_start:desc_end]
-        return str(desc)
-    else:
-        return ""
+        return prefix
 
+    def _with_prefix(self, prefix):
+        """The entries of self.sorted starting with prefix"""
+        return self.sorted[bisect_left(self.keys, prefix):bisect_left(self.keys, prefix + "\U0010ffff")]
 
-class RuleParser:
-    """A simple recursive descent rule parser, for evaluating rule statements containing nested boolean expressions."""
-    version = "Unknown"
+    def has_prefix(self, prefix):
+        """True if any plugin starts with prefix"""
+        return len(self._with_prefix(prefix)) > 0
+
+    def _candidates(self, plugin):
+        """The entries of self.sorted that could match a pattern"""
+        return self._with_prefix(self.stem(plugin))
+
+    def expand(self, plugin, re_namepat):
+        """Find the plugins that match re_namepat, the regular expression for the filename plugin"""
+        if plugin not in self.expanded:
+            matches = sorted((i, p) for (key, i, p) in self._candidates(plugin) if re_namepat.match(p))
+            self.expanded[plugin] = [p for (i, p) in matches]
+        return list(self.expanded[plugin])
 
-    def __init__(self, plugin_list, datadir, name_converter):
+
+# The nodes of a parsed expression tree.
+# They are immutable, so a tree can be shared by every load order the rules are evaluated against.
+PluginExpr = namedtuple("PluginExpr", "name")
+DescExpr = namedtuple("DescExpr", "bang pattern name")
+VerExpr = namedtuple("VerExpr", "op version name")
+SizeExpr = namedtuple("SizeExpr", "bang size name")
+MwseLuaExpr = namedtuple("MwseLuaExpr", "bang pattern name")
+AllExpr = namedtuple("AllExpr", "exprs")
+AnyExpr = namedtuple("AnyExpr", "exprs")
+NotExpr = namedtuple("NotExpr", "exprs")
+
+expression_types = {"PLUGIN": PluginExpr, "DESC": DescExpr, "VER": VerExpr, "SIZE": SizeExpr,
+                    "MWSE-LUA": MwseLuaExpr, "ALL": AllExpr, "ANY": AnyExpr, "NOT": NotExpr}
+
+
+def to_expression(expr):
+    """Convert an expression from the compiled rules (nested lists) into an expression tree"""
+    if expr[0] in ("ALL", "ANY", "NOT"):
+        return expression_types[expr[0]](tuple(map(to_expression, expr[1])))
+    return expression_types[expr[0]](*expr[1:])
+
+
+class RuleContext:
+    """
+    The plugins that expression trees are evaluated against.
+
+    [ALL], [ANY] and [NOT] stop evaluating as soon as their value is known, and the result of every predicate
+    is remembered, so [DESC], [SIZE] and [MWSE-LUA] only touch the disk when they have to, and only once.
+    """
+
+    def __init__(self, plugin_list, datadir, name_converter, headers=None, trace=None):
         self.plugin_list = plugin_list
-        if datadir:
-            self.datadir = fileFinder.caseless_dirlist(datadir)
-        else:
-            self.datadir = None
+        self.plugin_index = PluginIndex(plugin_list)
+        self.datadir = datadir  # a fileFinder.caseless_dirlist, or None when there are no plugin files to check
         self.name_converter = name_converter
-        self.graph = pluggraph.pluggraph()
+        self.headers = HeaderCache() if headers is None else headers
+        self.predicates = {}  # (node type, node): (truth, printable form)
+        self.trace = ParseTrace(size=0) if trace is None else trace
+        self.predicate_checks = 0  # how many times a predicate was checked against a plugin
+        self.mwse_mods = {}  # path of an [MWSE-LUA] mod's main.lua: whether it exists
+
+    def expand_filename(self, plugin: str):
+        """
+        Find all the files in self.plugin_list that match plugin.
+        """
+        if self.trace.active:
+            self.trace.log("expand_filename, plugin=%s", plugin)
+        re_namepat = filename_regex(plugin)
+        # Optimization to avoid performing regex checks if no expansions made
+        # TODO: Without this optimization, parsing breaks.
+        #  This is because there are unsupported lines in mlox_base.txt Like:
+        #    [ANY [DESC /LeFemm(TM) armor/ LeFemmArmor.esp]
+        #      [Official]LeFemm Armor.esp]
+        if re_namepat is None:
+            return [plugin] if plugin.lower() in self.plugin_index.names else []
+        matches = self.plugin_index.expand(plugin, re_namepat)
+        if self.trace.active:
+            self.trace.log("expand_filename: %s expands to: %s", plugin, matches)
+        return matches
+
+    def eval_plugin_name(self, name):
+        """
+        Find the plugins matching a plugin name from the rules.
+
+        :returns: True and the list of matches, or False and the plugin name, if there were no matches
+        """
+        plugin_name = self.name_converter.cname(name)
+        if self.trace.active:
+            self.trace.log("eval_plugin_name name=%s", plugin_name)
+        matches = self.expand_filename(plugin_name)
+        if matches:
+            return True, matches
+        return False, [plugin_name]
+
+    def _eval_ver(self, op, orig_ver, plugin_name):
+        ver = format_version(orig_ver)
+        expanded = self.expand_filename(plugin_name)
+        expr = "[VER %s %s %s]" % (op, orig_ver, plugin_name)
+        if self.trace.active:
+            self.trace.log("eval_ver, expr=%s ver=%s", expr, ver)
+        if len(expanded) == 1:
+            expr = "[VER %s %s %s]" % (op, orig_ver, expanded[0])
+        elif not expanded:
+            if self.trace.active:
+                self.trace.log("eval_ver [VER] \"%s\" not active", plugin_name)
+            return False, expr  # file does not exist
+        if self.datadir is None:
+            # this case is reached when doing fromfile checks
+            # and we do not have the actual plugin to check, so
+            # we assume that the plugin matches the given version
+            return op == '=', expr
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            self.predicate_checks += 1
+            p_ver = self.headers.version(self.datadir.find_path(plugin))
+            if p_ver is not None:
+                if self.trace.active:
+                    self.trace.log("eval_ver (header) version(%s) = %s", plugin_t, p_ver)
+            else:
+                match = re_filename_version.search(plugin)
+                if match:
+                    p_ver_orig = match.group(1)
+                    p_ver = format_version(p_ver_orig)
+                    if self.trace.active:
+                        self.trace.log("eval_ver (filename) version(%s) = %s (%s)", plugin_t, p_ver_orig, p_ver)
+                else:
+                    if self.trace.active:
+                        self.trace.log("eval_ver no version for %s", plugin_t)
+                    return False, expr
+            if self.trace.active:
+                self.trace.log("eval_ver compare  p_ver=%s %s ver=%s", p_ver, op, ver)
+            result = True
+            if op == '=':
+                result = (p_ver == ver)
+            elif op == '<':
+                result = (p_ver < ver)
+            elif op == '>':
+                result = (p_ver > ver)
+            if result:
+                return True, "[VER %s %s %s]" % (op, orig_ver, plugin)
+        return False, expr
+
+    def _eval_desc(self, bang, pat, plugin_name):
+        """match patterns against the description string in the plugin header."""
+        expr = "[DESC %s/%s/ %s]" % (bang, pat, plugin_name)
+        if self.trace.active:
+            self.trace.log("eval_desc, expr=%s", expr)
+        expanded = self.expand_filename(plugin_name)
+        if len(expanded) == 1:
+            expr = "[DESC %s/%s/ %s]" % (bang, pat, expanded[0])
+        elif not expanded:
+            if self.trace.active:
+                self.trace.log("eval_desc [DESC] \"%s\" not active", plugin_name)
+            return False, expr  # file does not exist
+        if self.datadir is None:
+            # this case is reached when doing fromfile checks,
+            # which do not have access to the actual plugin, so we
+            # always assume the test is merely for file existence,
+            # to err on the side of caution
+            return True, expr
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            re_pat = re.compile(pat)
+            self.predicate_checks += 1
+            desc = self.headers.description(self.datadir.find_path(plugin))
+            b = (re_pat.search(desc) is not None)
+            if bang == "!":
+                b = not b
+            if self.trace.active:
+                self.trace.log("eval_desc [DESC] returning: (%s, %s)", b, expr)
+            if b:
+                return True, "[DESC %s/%s/ %s]" % (bang, pat, plugin_t)
+        return False, expr
+
+    def _eval_size(self, bang, wanted_size, plugin_name):
+        """check the given size of the plugin."""
+        expr = "[SIZE %s%d %s]" % (bang, wanted_size, plugin_name)
+        if self.trace.active:
+            self.trace.log("eval_size, expr=%s", expr)
+        expanded = self.expand_filename(plugin_name)
+        if len(expanded) == 1:
+            expr = "[SIZE %s%d %s]" % (bang, wanted_size, expanded[0])
+        elif not expanded:
+            if self.trace.active:
+                self.trace.log("eval_size [SIZE] \"%s\" not active", plugin_name)
+            return False, expr  # file does not exist
+        if self.datadir is None:
+            # this case is reached when doing fromfile checks,
+            # which do not have access to the actual plugin, so we
+            # always assume the test is merely for file existence,
+            # to err on the side of caution
+            return True, expr
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            self.predicate_checks += 1
+            actual_size = self.headers.size(self.datadir.find_path(plugin))
+            b = (actual_size == wanted_size)
+            if bang == "!":
+                b = not b
+            if self.trace.active:
+                self.trace.log("eval_size [SIZE] returning: (%s, %s)", b, expr)
+            if b:
+                return True, "[SIZE %s%d %s]" % (bang, wanted_size, plugin_t)
+        return False, expr
+
+    def _eval_mwselua(self, bang, pat, plugin_name):
+        """check for a MWSE lua mod in the data directory."""
+        expr = "[MWSE-LUA %s/%s/ %s]" % (bang, pat, plugin_name)
+        if self.trace.active:
+            self.trace.log("eval_mwselua, expr=%s", expr)
+        expanded = self.expand_filename(plugin_name)
+        if len(expanded) == 1:
+            expr = "[MWSE-LUA %s/%s/ %s]" % (bang, pat, expanded[0])
+        elif not expanded:
+            if self.trace.active:
+                self.trace.log("eval_mwselua [MWSE-LUA] \"%s\" not active", plugin_name)
+            return False, expr  # file does not exist
+        if self.datadir is None:
+            # this case is reached when doing fromfile checks,
+            # which do not have access to the actual plugin, so we
+            # always assume the test is merely for file existence,
+            # to err on the side of caution
+            return True, expr
+        for xp in expanded:
+            plugin = self.name_converter.cname(xp)
+            plugin_t = self.name_converter.truename(plugin)
+            self.predicate_checks += 1
+            path = "%s\\MWSE\\mods\\%s\\main.lua" % (self.datadir.dir, pat)
+            if path not in self.mwse_mods:
+                self.mwse_mods[path] = os.path.exists(path)
+            b = self.mwse_mods[path]
+            if bang == "!":
+                b = not b
+            if self.trace.active:
+                self.trace.log("eval_mwselua [MWSE-LUA] returning: (%s, %s)", b, expr)
+            if b:
+                return True, "[MWSE-LUA %s/%s/ %s]" % (bang, pat, plugin_t)
+        return False, expr
+
+    def _predicate(self, expr):
+        """The truth value and printable form of a predicate (anything but [ALL], [ANY] and [NOT])"""
+        key = (type(expr), expr)
+        if key not in self.predicates:
+            if isinstance(expr, PluginExpr):
+                (exists, p) = self.eval_plugin_name(expr.name)
+                truename = self.name_converter.truename(p[0])
+                self.predicates[key] = (exists, truename if exists else ("MISSING(%s)" % truename))
+            elif isinstance(expr, DescExpr):
+                self.predicates[key] = self._eval_desc(*expr)
+            elif isinstance(expr, VerExpr):
+                self.predicates[key] = self._eval_ver(*expr)
+            elif isinstance(expr, SizeExpr):
+                self.predicates[key] = self._eval_size(*expr)
+            else:
+                self.predicates[key] = self._eval_mwselua(*expr)
+        if self.trace.active:
+            self.trace.log("%s is %s", self.predicates[key][1], self.predicates[key][0])
+        return self.predicates[key]
+
+    def truth(self, expr):
+        """The truth value of an expression, evaluating only as much of it as needed"""
+        if isinstance(expr, AllExpr):
+            return all(map(self.truth, expr.exprs))
+        if isinstance(expr, AnyExpr):
+            return any(map(self.truth, expr.exprs))
+        if isinstance(expr, NotExpr):
+            return not all(map(self.truth, expr.exprs))
+        return self._predicate(expr)[0]
+
+    def evaluate(self, expr, prune=False):
+        """
+        Fully evaluate an expression, for printing it.
+
+        :returns: The truth value of the expression, and a printable form of it
+        """
+        if not isinstance(expr, (AllExpr, AnyExpr, NotExpr)):
+            return self._predicate(expr)
+        vals = []
+        exprs = []
+        for sub_expr in expr.exprs:
+            (b, e) = self.evaluate(sub_expr, prune)
+            vals.append(b)
+            exprs.append(e)
+        if isinstance(expr, AllExpr):
+            # prune out uninteresting expressions from ANY results
+            exprs = [e for e in exprs if not (isinstance(e, list) and e == [])]
+            return all(vals), exprs[0] if len(exprs) == 1 else ["ALL"] + exprs
+        if isinstance(expr, AnyExpr):
+            # prune out uninteresting expressions from ANY results
+            if prune:
+                exprs = [e for e in exprs if not (isinstance(e, str) and e[0:8] == "MISSING(")]
+            return any(vals), exprs[0] if len(exprs) == 1 else ["ANY"] + exprs
+        # NotExpr
+        return not (all(vals)), ["NOT"] + exprs
+
+
+Token = namedtuple("Token", "kind line_num start end groups")
+
+
+class RuleLexer:
+    """
+    Splits a rules file into tokens, reading it once from start to end.
+
+    The lexer keeps the current line and a position in it, and each token is matched where the last one ended,
+    so nothing is copied out of the line until it is part of a token.
+    What a piece of text is depends on where the parser is (a "]" only closes a function inside one),
+    so the parser asks for the kind of token it expects next:
+    RULE (a rule header), MESSAGE (a line of a message block), OPEN ([ALL, [ANY or [NOT), CLOSE (the "]" ending one),
+    PREDICATE ([DESC], [VER], [SIZE] or [MWSE-LUA], with its patterns), PLUGIN (a plugin name),
+    and ERROR (text that isn't what the parser expected).
+    """
+
+    def __init__(self, input_handle):
+        self.input_handle = input_handle
+        self.line = ""
+        self.pos = 0
         self.line_num = 0
-        self.rule_file = None
         self.bytesread = 0
-        self.input_handle = None
-        self.buffer = ""  # the parsing buffer
-        self.message = []  # the comment for the current rule
-        self.curr_rule = ""  # name of the current rule we are parsing
-        self.parse_dbg_indent = ""
-        self.out_stream = io.StringIO()
-        self.hints = {"conflicts": [], "patch": [], "requires": []}  # hints in the load order for highlighting
 
-    def _readline(self):
+    def next_line(self):
         """
-        Obtain the next line from the rules file.
+        Move to the next line in the rules file.
 
         This skips blank lines, and lines that are only comments.
         It also strips comments.
+        :returns: False at the end of the file
         """
         if self.input_handle is None:
             return False
-        try:
-            while True:
-                line = next(self.input_handle)
-                self.bytesread += len(line)
-                self.line_num += 1
+        for line in self.input_handle:
+            self.bytesread += len(line)
+            self.line_num += 1
+            if ';' in line:
                 line = re_comment.sub('', line)  # remove comments
-                line = line.rstrip()  # strip whitespace from end of line, include CRLF
-                if line != "":
-                    self.buffer = line
-                    parse_logger.debug("readline returns: %s" % line)
-                    return True
+            line = line.rstrip()  # strip whitespace from end of line, include CRLF
+            if line != "":
+                self.line = line
+                self.pos = 0
+                return True
+        self.clear()
+        self.input_handle.close()
+        self.input_handle = None
+        return False
+
+    def rest(self):
+        """The rest of the current line"""
+        return self.line[self.pos:]
+
+    def clear(self):
+        """Skip the rest of the current line"""
+        self.line = ""
+        self.pos = 0
+
+    def at_end(self):
+        return self.pos >= len(self.line)
+
+    def skip_space(self):
+        while self.pos < len(self.line) and self.line[self.pos].isspace():
+            self.pos += 1
+
+    def _token(self, kind, match, groups, end=None):
+        self.pos = match.end() if end is None else end
+        return Token(kind, self.line_num, match.start(), self.pos, groups)
+
+    def rule(self, consume=True):
+        """A rule header ([NAME message]expression) at the current position, or None"""
+        match = re_rule.match(self.line, self.pos)
+        if match is None or not consume:
+            return match and Token("RULE", self.line_num, match.start(), match.end(), match.groups())
+        return self._token("RULE", match, match.groups(), match.start(3))
+
+    def message(self):
+        """The current line as part of a message block (it starts with white space), or None"""
+        if self.pos != 0 or not re_message.match(self.line):
+            return None
+        self.pos = len(self.line)
+        return Token("MESSAGE", self.line_num, 0, self.pos, (self.line,))
+
+    def close(self):
+        """The end of a boolean function, or None"""
+        match = re_end_fun.match(self.line, self.pos)
+        return match and self._token("CLOSE", match, ())
+
+    def plugin(self):
+        """A plugin name, and the white space around it"""
+        start = self.pos
+        self.skip_space()
+        match = re_plugin.match(self.line, self.pos)
+        if match is None:
+            self.pos = start
+            return Token("ERROR", self.line_num, start, start, ("expected a plugin name",))
+        token = self._token("PLUGIN", match, (match.group(1),))
+        self.skip_space()
+        return token
+
+    def expression(self):
+        """The start of an expression: a boolean function, a predicate, or a plugin name"""
+        match = re_fun.match(self.line, self.pos)
+        if match is None:
+            return self.plugin()
+        fun = match.group(1).upper()
+        if fun in ("ALL", "ANY", "NOT"):
+            return self._token("OPEN", match, (fun,))
+        match = predicate_patterns[fun].match(self.line, self.pos)
+        if match is None:
+            return Token("ERROR", self.line_num, self.pos, self.pos, ("Invalid [%s] function" % fun,))
+        return self._token("PREDICATE", match, (fun,) + match.groups())
+
+
+class RuleCache:
+    """
+    Rules that have already been read, for sharing between the parsers of different load orders.
 
-        except StopIteration:
-            parse_logger.debug("EOF")
-            self.buffer = ""
-            self.input_handle.close()
-            self.input_handle = None
-            return False
+    The compiled rules (with their expression trees) are kept by rules file and hash, and never change once read.
+    The graphs built from the ordering rules are kept by the same key as graph snapshots, so a load order
+    whose plugins give the same graph as an earlier one gets a copy of it.
+    """
+
+    def __init__(self):
+        self.compiled = {}  # (rules file, sha256): compiled rules
+        self.graphs = {}  # graph key: (graph, warnings given by the ordering rules)
+        self.digests = {}  # rules file: ((size, mtime), sha256)
+
+    def digest(self, rule_file):
+        """The sha256 of a rules file, only hashed again when the file's size or modification time changes"""
+        stat = os.stat(rule_file)
+        (when, digest) = self.digests.get(rule_file, (None, None))
+        if when != (stat.st_size, stat.st_mtime_ns):
+            digest = sha256sum(rule_file)
+            self.digests[rule_file] = ((stat.st_size, stat.st_mtime_ns), digest)
+        return digest
+
+    def add_graph(self, key, graph, warnings):
+        if len(self.graphs) >= SHARED_GRAPHS:
+            del self.graphs[next(iter(self.graphs))]
+        self.graphs[key] = (graph.copy(), list(warnings))
+
+
+class RuleParser:
+    """
+    A simple recursive descent rule parser, for evaluating rule statements containing nested boolean expressions.
+
+    Reading a rules file happens in two steps:
+    First the text is compiled into a list of rules that does not depend on the plugins a user has.
+    (Order rules become lists of plugin names, and statements become expression trees.)
+    Then the compiled rules are evaluated against the plugin list, adding edges to the graph and printing messages.
+    When a cache directory is given, the compiled rules are saved there, and reused for as long as the
+    rules file's hash stays the same.
+    When a RuleCache is given, rules files are only compiled and loaded once for all the parsers sharing it,
+    and graph snapshots are kept there instead of in the cache directory.
+    When a ParseTrace is given, the rules are always compiled and evaluated (not taken from a cache),
+    so the trace shows what happened to every rule chosen.
+    When a timings.Timings is given, the time spent reading the rules and building the graph is added to it,
+    along with the time spent on each rule.
+    """
+    version = "Unknown"
+
+    def __init__(self, plugin_list, datadir, name_converter, cache_dir=None, headers=None, shared=None, trace=None,
+                 timings=None):
+        if datadir and not isinstance(datadir, fileFinder.caseless_dirlist):
+            datadir = fileFinder.caseless_dirlist(datadir)
+        self.context = RuleContext(plugin_list, datadir or None, name_converter, headers, trace)
+        self.plugin_list = plugin_list
+        self.plugin_index = self.context.plugin_index
+        self.datadir = self.context.datadir
+        self.name_converter = name_converter
+        self.cache_dir = cache_dir
+        self.shared = shared  # a RuleCache, or None
+        self.headers = self.context.headers
+        self.trace = self.context.trace
+        self.timings = timings  # a timings.Timings, or None
+        self.graph = pluggraph.pluggraph()
+        self.graph_key = ""  # the graph key of self.graph ("" while it is empty), or None if it has no key
+        self.rule_file = None
+        self.lexer = RuleLexer(None)  # the lexer for the rules file being parsed
+        self.message = []  # the comment for the current rule
+        self.curr_rule = ""  # name of the current rule we are parsing
+        self.compiled = []  # the compiled form of the rules file being parsed
+        self.ordering_warnings = []  # [rule position, kind, ...] for the warnings given by the ordering rules
+        self.out_stream = io.StringIO()
+        self.hints = {"conflicts": [], "patch": [], "requires": []}  # hints in the load order for highlighting
 
-    def _where(self):
+    def _where(self, line_num=None):
         """Convenience function letting the caller know at what point in the rule file something happened."""
-        return "%s:%d" % (self.rule_file, self.line_num)
+        return "%s:%d" % (self.rule_file, self.lexer.line_num if line_num is None else line_num)
 
     def _parse_error(self, what):
-        """print a message about current parsing error, and blow away the
-        current parse buffer so next parse starts on next input line."""
-        msg = "%s: Parse Error(%s), %s [Buffer=%s]" % (self._where(), self.curr_rule, what, self.buffer)
-        parse_logger.error(msg)
-        print(f"[ERROR] {msg}", file=self.out_stream)
-        self.buffer = ""
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+        """record a message about current parsing error, and skip the rest of
+        the current line so next parse starts on next input line."""
+        self.compiled.append(["ERROR", self.lexer.line_num, self.curr_rule, what, self.lexer.rest()])
+        self.lexer.clear()
 
     def _parse_message_block(self):
-        while self._readline():
-            if re_message.match(self.buffer):
-                self.message.append(self.buffer)
-            else:
+        while self.lexer.next_line():
+            token = self.lexer.message()
+            if token is None:
                 return
+            self.message.append(token.groups[0])
 
     @staticmethod
     def _filename_to_regex(plugin: str):
@@ -220,392 +971,367 @@ class RuleParser:
         """
         Find all the files in self.plugin_list that match plugin.
         """
-        parse_logger.debug("expand_filename, plugin=%s" % plugin)
-        pat = self._filename_to_regex(plugin)
-        # Optimization to avoid performing regex checks if no expansions made
-        # TODO: Without this optimization, parsing breaks.
-        #  This is because there are unsupported lines in mlox_base.txt Like:
-        #    [ANY [DESC /LeFemm(TM) armor/ LeFemmArmor.esp]
-        #      [Official]LeFemm Armor.esp]
-        if "^%s$" % re_escape_meta.sub(r'\\\1', plugin) == pat:
-            return [plugin] if plugin.lower() in self.plugin_list else []
-        matches = []
-        re_namepat = re.compile(pat, re.IGNORECASE)
-        for p in self.plugin_list:
-            if re_namepat.match(p):
-                matches.append(p)
-                parse_logger.debug("expand_filename: %s expands to: %s" % (plugin, p))
-        return matches
+        return self.context.expand_filename(plugin)
 
     def _parse_plugin_name(self):
-        self.parse_dbg_indent += "  "
-        buff = self.buffer.strip()
-        parse_logger.debug("parse_plugin_name buff=%s" % buff)
-        plugin_match = re_plugin.match(buff)
-        if plugin_match:
-            plugin_name = self.name_converter.cname(plugin_match.group(1))
-            parse_logger.debug("parse_plugin_name name=%s" % plugin_name)
-            pos = plugin_match.span(2)[1]
-            self.buffer = buff[pos:].lstrip()
-            matches = self._expand_filename(plugin_name)
-            if matches:
-                
-                if len(matches) > 1:
-                    parse_logger.debug("parse_plugin_name new name=%s" % plugin_name)
-
-                # plugin_name = matches.pop(0)
-                # parse_logger.debug("parse_plugin_name new name=%s" % plugin_name)
-                # if len(matches) > 0:
-                #     self.buffer = " ".join(matches) + " " + self.buffer
-                # return True, plugin_name
-                return True, matches
-                    
-
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return False, [plugin_name]
-        else:
-            self._parse_error("expected a plugin name")
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return None, None
+        """Parse a plugin name, returning its expression node, or None if there isn't one"""
+        token = self.lexer.plugin()
+        if token.kind == "ERROR":
+            self._parse_error(token.groups[0])
+            return None
+        return ["PLUGIN", token.groups[0]]
 
     def _parse_ordering(self, rule):
-        self.parse_dbg_indent += "  "
-        prev = []
-        n_order = 0
-        
+        lexer = self.lexer
+        entries = []  # [line number, plugin name] for every line in the rule
         # read all lines in the rule
-        while self._readline():
-            
-            if re_rule.match(self.buffer):
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+        while lexer.next_line():
+            if lexer.rule(consume=False):
+                # The rule was ended by the start of another rule, not the end of the file
+                self.compiled.append([rule, entries, None])
                 return
-            
-            matches = self._parse_plugin_name()[1]
-            
-            # go through all matches of the current line
-            for pnam in matches:
-                if pnam is None:
-                    continue
-                n_order += 1
-                
-                if rule == "ORDER":
-                    if len(prev) > 0:
-                        for _prev in prev:
-                            self.graph.add_edge(self._where(), _prev, pnam, self.out_stream)
-                
-                elif rule == "NEARSTART":
-                    self.graph.nearstart.append(pnam)
-                    self.graph.nodes.setdefault(pnam, [])
-                
-                elif rule == "NEAREND":
-                    self.graph.nearend.append(pnam)
-                    self.graph.nodes.setdefault(pnam, [])
-
-            prev = matches
-
-        if rule == "ORDER":
-            if n_order == 0:
-                parse_logger.warning("%s: ORDER rule has no entries" % (self._where()))
-            elif n_order == 1:
-                parse_logger.warning("%s: ORDER rule skipped because it only has one entry: %s" % (
-                    self._where(), self.name_converter.truename(prev)))
-
-    def _parse_ver(self):
-        self.parse_dbg_indent += "  "
-        match = re_ver_fun.match(self.buffer)
-        if match:
-            p = match.span(0)[1]
-            self.buffer = self.buffer[p:]
-            parse_logger.debug("parse_ver new buffer = %s" % self.buffer)
-            op = match.group(1)
+            plugin = self._parse_plugin_name()
+            if plugin is not None:
+                entries.append([lexer.line_num, plugin[1]])
+        self.compiled.append([rule, entries, lexer.line_num])
+
+    def _parse_predicate(self, token):
+        """Turn a predicate token into its expression node"""
+        fun = token.groups[0]
+        if fun == "VER":
+            op = token.groups[1]
             if op not in version_operators:
                 self._parse_error("Invalid [VER] operator")
-                return None, None
-            orig_ver = match.group(2)
-            ver = format_version(orig_ver)
-            plugin_name = match.group(3)
-            expanded = self._expand_filename(plugin_name)
-            expr = "[VER %s %s %s]" % (op, orig_ver, plugin_name)
-            parse_logger.debug("parse_ver, expr=%s ver=%s" % (expr, ver))
-            if len(expanded) == 1:
-                expr = "[VER %s %s %s]" % (op, orig_ver, expanded[0])
-            elif not expanded:
-                parse_logger.debug("parse_ver [VER] \"%s\" not active" % plugin_name)
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return False, expr  # file does not exist
-            if self.datadir is None:
-                # this case is reached when doing fromfile checks
-                # and we do not have the actual plugin to check, so
-                # we assume that the plugin matches the given version
-                if op == '=':
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return True, expr
-                else:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return False, expr
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                desc = plugin_description(self.datadir.find_path(plugin))
-                match = re_header_version.search(desc)
-                if match:
-                    p_ver_orig = match.group(1)
-                    p_ver = format_version(p_ver_orig)
-                    parse_logger.debug("parse_ver (header) version(%s) = %s (%s)" % (plugin_t, p_ver_orig, p_ver))
+                return None
+            return ["VER", op, token.groups[2], token.groups[3]]
+        if fun == "SIZE":
+            return ["SIZE", token.groups[1], int(token.groups[2]), token.groups[3]]
+        return [fun, token.groups[1], token.groups[2], token.groups[3]]
+
+    def _parse_expression(self):
+        """
+        Parse the next expression into a tree of nested lists.
+
+        :returns: The expression, or None at the end of the statement (or on a parse error)
+        """
+        lexer = self.lexer
+        lexer.skip_space()
+        if lexer.at_end():
+            if not lexer.next_line():
+                return None
+            if lexer.rule(consume=False):
+                return None
+            lexer.skip_space()
+        token = lexer.expression()
+        if token.kind == "PLUGIN":
+            return ["PLUGIN", token.groups[0]]
+        if token.kind == "PREDICATE":
+            return self._parse_predicate(token)
+        if token.kind == "ERROR":
+            self._parse_error(token.groups[0])
+            return None
+        # otherwise it's a boolean function ...
+        fun = token.groups[0]
+        exprs = []
+        while lexer.close() is None:
+            expr = self._parse_expression()
+            if expr is None:
+                self._parse_error("[%s] Invalid boolean arguments" % fun)
+                return None
+            exprs.append(expr)
+        return [fun, exprs]
+
+    def _parse_statement(self, rule, msg, expr):
+        if msg == "":
+            if expr.strip() == "":
+                self._parse_message_block()
+        else:
+            self.message = [msg]
+        if self.lexer.at_end():
+            if not self.lexer.next_line():
+                return
+
+        exprs = []
+        if rule in ("CONFLICT", "NOTE"):  # takes any number of exprs
+            expr = self._parse_expression()
+            while expr is not None:
+                exprs.append(expr)
+                expr = self._parse_expression()
+        elif rule in ("PATCH", "REQUIRES"):  # takes 2 exprs
+            while len(exprs) < 2:
+                expr = self._parse_expression()
+                if expr is None:
+                    break
+                exprs.append(expr)
+        self.compiled.append([rule, self.lexer.line_num, self.message, exprs])
+
+    def _compile_rules(self, progress=None):
+        """
+        Compile self.rule_file into a list of rules.
+
+        Each rule is a list starting with the rule's name:
+        ["VERSION", version]
+        ["ORDER" | "NEARSTART" | "NEAREND", [[line number, plugin name], ...], line number of EOF or None]
+        ["CONFLICT" | "NOTE" | "PATCH" | "REQUIRES", line number, message lines, [expression, ...]]
+        ["ERROR", line number, rule, what went wrong, rest of the line]
+        Expressions are ["PLUGIN", name], ["DESC", bang, pattern, name], ["VER", operator, version, name],
+        ["SIZE", bang, size, name], ["MWSE-LUA", bang, pattern, name], or ["ALL" | "ANY" | "NOT", [expression, ...]]
+        :return: A dict containing the compiled rules and the number of rules read, or None on failure
+        """
+        try:
+            self.lexer = RuleLexer(open(self.rule_file, 'r', encoding="utf-8"))
+            inputsize = os.path.getsize(self.rule_file)
+        except IOError:
+            parse_logger.error("Unable to open rules file:  {0}".format(self.rule_file))
+            return None
+
+        lexer = self.lexer
+        n_rules = 0
+        self.compiled = []
+        while True:
+            if lexer.at_end():
+                if not lexer.next_line():
+                    break
+
+            # Update the GUI progress bar
+            if progress is not None and inputsize > 0:
+                pct = int(100 * lexer.bytesread / inputsize)
+                if pct < 100:
+                    progress.update_value_and_label(pct, "Loading: {0}".format(self.rule_file))
+
+            self.curr_rule = ""
+            first = len(self.compiled)
+            if self.timings is not None:
+                start = time.perf_counter()
+            new_rule = lexer.rule()
+
+            if new_rule:  # start a new rule
+                n_rules += 1
+                self.curr_rule = new_rule.groups[0].upper()
+                self.message = []
+
+                if self.curr_rule == "VERSION":
+                    lexer.clear()
+                    self.compiled.append(["VERSION", new_rule.groups[1]])
+                elif self.curr_rule in ("ORDER", "NEAREND", "NEARSTART"):
+                    self._parse_ordering(self.curr_rule)
+                elif self.curr_rule in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                    self._parse_statement(self.curr_rule, new_rule.groups[1], new_rule.groups[2])
                 else:
-                    match = re_filename_version.search(plugin)
-                    if match:
-                        p_ver_orig = match.group(1)
-                        p_ver = format_version(p_ver_orig)
-                        parse_logger.debug("parse_ver (filename) version(%s) = %s (%s)" % (plugin_t, p_ver_orig, p_ver))
-                    else:
-                        parse_logger.debug("parse_ver no version for %s" % plugin_t)
-                        return False, expr
-                parse_logger.debug("parse_ver compare  p_ver=%s %s ver=%s" % (p_ver, op, ver))
-                result = True
-                if op == '=':
-                    result = (p_ver == ver)
-                elif op == '<':
-                    result = (p_ver < ver)
-                elif op == '>':
-                    result = (p_ver > ver)
-                if result:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return True, "[VER %s %s %s]" % (op, orig_ver, plugin)
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return False, expr
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-        self._parse_error("Invalid [VER] function")
-        return None, None
-
-    def _parse_desc(self):
-        """match patterns against the description string in the plugin header."""
-        self.parse_dbg_indent += "  "
-        match = re_desc_fun.match(self.buffer)
-        if match:
-            p = match.span(0)[1]
-            self.buffer = self.buffer[p:]
-            parse_logger.debug("parse_desc new buffer = %s" % self.buffer)
-            bang = match.group(1)  # means to invert the meaning of the match
-            pat = match.group(2)
-            plugin_name = match.group(3)
-            expr = "[DESC %s/%s/ %s]" % (bang, pat, plugin_name)
-            parse_logger.debug("parse_desc, expr=%s" % expr)
-            expanded = self._expand_filename(plugin_name)
-            if len(expanded) == 1:
-                expr = "[DESC %s/%s/ %s]" % (bang, pat, expanded[0])
-            elif not expanded:
-                parse_logger.debug("parse_desc [DESC] \"%s\" not active" % plugin_name)
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return False, expr  # file does not exist
-            if self.datadir is None:
-                # this case is reached when doing fromfile checks,
-                # which do not have access to the actual plugin, so we
-                # always assume the test is merely for file existence,
-                # to err on the side of caution
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return True, expr
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                re_pat = re.compile(pat)
-                desc = plugin_description(self.datadir.find_path(plugin))
-                b = (re_pat.search(desc) is not None)
-                if bang == "!":
-                    b = not b
-                parse_logger.debug("parse_desc [DESC] returning: (%s, %s)" % (b, expr))
-                if b:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return True, "[DESC %s/%s/ %s]" % (bang, pat, plugin_t)
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return False, expr
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-        self._parse_error("Invalid [DESC] function")
-        return None, None
-
-    def _parse_size(self):
-        """check the given size of the plugin."""
-        self.parse_dbg_indent += "  "
-        match = re_size_fun.match(self.buffer)
-        if match:
-            p = match.span(0)[1]
-            self.buffer = self.buffer[p:]
-            parse_logger.debug("parse_size new buffer = %s" % self.buffer)
-            bang = match.group(1)  # means "is not this size"
-            wanted_size = int(match.group(2))
-            plugin_name = match.group(3)
-            expr = "[SIZE %s%d %s]" % (bang, wanted_size, plugin_name)
-            parse_logger.debug("parse_size, expr=%s" % expr)
-            expanded = self._expand_filename(plugin_name)
-            if len(expanded) == 1:
-                expr = "[SIZE %s%d %s]" % (bang, wanted_size, expanded[0])
-            elif not expanded:
-                parse_logger.debug("parse_size [SIZE] \"%s\" not active" % match.group(3))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return False, expr  # file does not exist
-            if self.datadir is None:
-                # this case is reached when doing fromfile checks,
-                # which do not have access to the actual plugin, so we
-                # always assume the test is merely for file existence,
-                # to err on the side of caution
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return True, expr
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                actual_size = os.path.getsize(self.datadir.find_path(plugin))
-                b = (actual_size == wanted_size)
-                if bang == "!":
-                    b = not b
-                parse_logger.debug("parse_size [SIZE] returning: (%s, %s)" % (b, expr))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                if b:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return True, "[SIZE %s%d %s]" % (bang, wanted_size, plugin_t)
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return False, expr
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-        self._parse_error("Invalid [SIZE] function")
-        return None, None
-
-    def _parse_mwselua(self):
-        """match patterns against the description string in the plugin header."""
-        self.parse_dbg_indent += "  "
-        match = re_mwselua_fun.match(self.buffer)
-        if match:
-            p = match.span(0)[1]
-            self.buffer = self.buffer[p:]
-            parse_logger.debug("parse_mwselua new buffer = %s" % self.buffer)
-            bang = match.group(1)  # means to invert the meaning of the match
-            pat = match.group(2)
-            plugin_name = match.group(3)
-            expr = "[MWSE-LUA %s/%s/ %s]" % (bang, pat, plugin_name)
-            parse_logger.debug("parse_mwselua, expr=%s" % expr)
-            expanded = self._expand_filename(plugin_name)
-            if len(expanded) == 1:
-                expr = "[MWSE-LUA %s/%s/ %s]" % (bang, pat, expanded[0])
-            elif not expanded:
-                parse_logger.debug("parse_mwselua [MWSE-LUA] \"%s\" not active" % plugin_name)
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return False, expr  # file does not exist
-            if self.datadir is None:
-                # this case is reached when doing fromfile checks,
-                # which do not have access to the actual plugin, so we
-                # always assume the test is merely for file existence,
-                # to err on the side of caution
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return True, expr
-            for xp in expanded:
-                plugin = self.name_converter.cname(xp)
-                plugin_t = self.name_converter.truename(plugin)
-                b = os.path.exists("%s\\MWSE\\mods\\%s\\main.lua" % (self.datadir.dir, pat))
-                if bang == "!":
-                    b = not b
-                parse_logger.debug("parse_mwselua [MWSE-LUA] returning: (%s, %s)" % (b, expr))
-                if b:
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return True, "[MWSE-LUA %s/%s/ %s]" % (bang, pat, plugin_t)
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return False, expr
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-        self._parse_error("Invalid [MWSE-LUA] function")
-        return None, None
-
-    def _parse_expression(self, prune=False):
-        self.parse_dbg_indent += "  "
-        self.buffer = self.buffer.strip()
-        if self.buffer == "":
-            if self._readline():
-                if re_rule.match(self.buffer):
-                    parse_logger.debug("parse_expression new line started new rule, returning None")
-                    self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                    return None, None
-                self.buffer = self.buffer.strip()
+                    # we should never reach here, since re_rule only matches known rules
+                    self._parse_error("read_rules failed sanity check, unknown rule")
+
             else:
-                parse_logger.debug("parse_expression EOF, returning None")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return None, None
-        parse_logger.debug("parse_expression, start buffer: \"%s\"" % self.buffer)
-        match = re_fun.match(self.buffer)
-        if match:
-            fun = match.group(1).upper()
-            if fun == "DESC":
-                parse_logger.debug("parse_expression calling parse_desc()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return self._parse_desc()
-            elif fun == "VER":
-                parse_logger.debug("parse_expression calling parse_ver()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return self._parse_ver()
-            elif fun == "SIZE":
-                parse_logger.debug("parse_expression calling parse_size()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return self._parse_size()
-            if fun == "MWSE-LUA":
-                parse_logger.debug("parse_expression calling parse_mwselua()")
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return self._parse_mwselua()
-            # otherwise it's a boolean function ...
-            parse_logger.debug("parse_expression parsing expression: \"%s\"" % self.buffer)
-            p = match.span(0)[1]
-            self.buffer = self.buffer[p:]
-            parse_logger.debug("fun = %s" % fun)
-            vals = []
-            exprs = []
-            bool_end = re_end_fun.match(self.buffer)
-            parse_logger.debug("self.buffer 1 =\"%s\"" % self.buffer)
-            while not bool_end:
-                (b, expr) = self._parse_expression(prune)
-                if b is None:
-                    self._parse_error("[%s] Invalid boolean arguments" % fun)
-                    return None, None
-                exprs.append(expr)
-                vals.append(b)
-                parse_logger.debug("self.buffer 2 =\"%s\"" % self.buffer)
-                bool_end = re_end_fun.match(self.buffer)
-            pos = bool_end.span(0)[1]
-            self.buffer = self.buffer[pos:]
-            parse_logger.debug("self.buffer 3 =\"%s\"" % self.buffer)
-            if fun == "ALL":
-                # prune out uninteresting expressions from ANY results
-                exprs = [e for e in exprs if not (isinstance(e, list) and e == [])]
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return all(vals), exprs[0] if len(exprs) == 1 else ["ALL"] + exprs
-            if fun == "ANY":
-                # prune out uninteresting expressions from ANY results
-                if prune:
-                    exprs = [e for e in exprs if not (isinstance(e, str) and e[0:8] == "MISSING(")]
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return any(vals), exprs[0] if len(exprs) == 1 else ["ANY"] + exprs
-            if fun == "NOT":
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-                return not (all(vals)), ["NOT"] + exprs
+                self._parse_error("expected start of rule")
+            if self.timings is not None:
+                seconds = time.perf_counter() - start
+                for rule in self.compiled[first:]:
+                    self._time_rule(rule, "parse", seconds)
+            if self.trace.enabled:
+                self._trace_compiled(self.compiled[first:])
+        self.trace.stop()
+
+        return {"format": COMPILED_RULES_FORMAT, "n_rules": n_rules, "rules": self.compiled,
+                "index": self._index_rules(self.compiled), "spellings": self._spellings(self.compiled)}
+
+    @staticmethod
+    def _trace_lines(rule):
+        """
+        The line numbers a compiled rule is traced by.
+
+        These are the line numbers given in the messages about the rule:
+        the entries of an ordering rule, and the line a statement or a parse error was found on.
+        """
+        if rule[0] in ("ORDER", "NEAREND", "NEARSTART"):
+            return [line_num for (line_num, name) in rule[1]] + ([rule[2]] if rule[2] is not None else [])
+        if rule[0] == "VERSION":
+            return []
+        return [rule[1]]
+
+    def _time_rule(self, rule, what, seconds, checks=0):
+        """Add the time spent on a compiled rule to self.timings"""
+        lines = self._trace_lines(rule)
+        if lines:
+            self.timings.add_rule(self._where(lines[0]), rule[0], what, seconds, checks)
+
+    def _trace_compiled(self, rules):
+        """Trace what was compiled from a rule"""
+        for rule in rules:
+            if rule[0] in ("ORDER", "NEAREND", "NEARSTART"):
+                names = [name for (line_num, name) in rule[1]]
+            elif rule[0] in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                names = list(self._mentioned(rule[3]))
             else:
-                # should not be reached due to match on re_fun
-                self._parse_error("Expected Boolean function (ALL, ANY, NOT)")
-                return None, None
-            # parse_logger.debug("parse_expression NOTREACHED")
-        else:
-            if re_fun.match(self.buffer):
-                self._parse_error("Invalid function expression")
-                return None, None
-            parse_logger.debug("parse_expression parsing plugin: \"%s\"" % self.buffer)
-            (exists, p) = self._parse_plugin_name()
-            if exists is not None and p is not None:
-
-                if len(p) > 1:
-                    p = p[0]
-                elif len(p) > 0:
-                    p = p[0]
-
-                #for pnam in p:
-                #p = p.pop()
-
-                p = self.name_converter.truename(p) if exists else ("MISSING(%s)" % self.name_converter.truename(p))
-            self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-            return exists, p
-        # parse_logger.debug("parse_expression NOTREACHED(2)")
+                names = []
+            self.trace.start(self.rule_file, self._trace_lines(rule), names)
+            if self.trace.active:
+                self.trace.log("compiled: %s", rule)
+
+    @staticmethod
+    def _mentioned(exprs):
+        """All the plugin names mentioned by a list of expressions"""
+        for expr in exprs:
+            if expr[0] in ("ALL", "ANY", "NOT"):
+                yield from RuleParser._mentioned(expr[1])
+            else:
+                yield expr[-1]
+
+    @staticmethod
+    def _tree_names(exprs):
+        """All the plugin names mentioned by a list of expression trees"""
+        for expr in exprs:
+            if isinstance(expr, (AllExpr, AnyExpr, NotExpr)):
+                yield from RuleParser._tree_names(expr.exprs)
+            else:
+                yield expr.name
+
+    @staticmethod
+    def _true_without_plugins(expr):
+        """The value of an expression when none of the plugins it mentions are active"""
+        if expr[0] == "ALL":
+            return all(map(RuleParser._true_without_plugins, expr[1]))
+        if expr[0] == "ANY":
+            return any(map(RuleParser._true_without_plugins, expr[1]))
+        if expr[0] == "NOT":
+            return not all(map(RuleParser._true_without_plugins, expr[1]))
+        return False
+
+    @staticmethod
+    def _fires_without_plugins(rule, exprs):
+        """True if a statement can print something (or warn) when none of the plugins it mentions are active"""
+        vals = list(map(RuleParser._true_without_plugins, exprs))
+        if rule == "CONFLICT":
+            return vals.count(True) > 1
+        if rule == "NOTE":
+            return True in vals
+        if len(vals) < 2:
+            return True  # PATCH and REQUIRES warn about missing expressions
+        if rule == "PATCH":
+            return vals[0] != vals[1]
+        # rule == "REQUIRES"
+        return vals[0] and not vals[1]
+
+    @staticmethod
+    def _index_rules(rules):
+        """
+        Index the statements in a list of compiled rules by the plugins they mention.
+
+        A statement only needs to be evaluated when one of the plugins it mentions is active,
+        unless it would fire without any of them (like "[NOTE] [NOT foo.esp]").
+        :return: A dict with the positions of the statements that always need evaluating,
+          of the statements by the lowercase plugin names they mention,
+          and of the statements by the stems of the filename patterns they mention
+        """
+        index = {"always": [], "names": {}, "stems": {}}
+        for (i, rule) in enumerate(rules):
+            if rule[0] not in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                continue
+            if RuleParser._fires_without_plugins(rule[0], rule[3]):
+                index["always"].append(i)
+                continue
+            for name in set(RuleParser._mentioned(rule[3])):
+                if filename_regex(name) is None:
+                    index["names"].setdefault(name.lower(), []).append(i)
+                else:
+                    index["stems"].setdefault(PluginIndex.stem(name), []).append(i)
+        return index
+
+    @staticmethod
+    def _spellings(rules):
+        """
+        The first spelling of every plugin name the rules always register with the name converter, in order.
+
+        Registering these up front means the name converter ends up the same, even when statements are skipped.
+        """
+        spellings = {}
+        for rule in rules:
+            if rule[0] in ("ORDER", "NEAREND", "NEARSTART"):
+                names = [name for (line_num, name) in rule[1]]
+            elif rule[0] in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                names = RuleParser._plugin_names(rule[3])
+            else:
+                continue
+            for name in names:
+                spellings.setdefault(name.lower(), name)
+        return list(spellings.values())
+
+    @staticmethod
+    def _plugin_names(exprs):
+        """The plugin names of the plain plugin expressions in a list of expressions"""
+        names = []
+        for expr in exprs:
+            if expr[0] == "PLUGIN":
+                names.append(expr[1])
+            elif expr[0] in ("ALL", "ANY", "NOT"):
+                names += RuleParser._plugin_names(expr[1])
+        return names
+
+    def _cache_file(self):
+        """The file the compiled form of self.rule_file is kept in"""
+        return os.path.join(self.cache_dir, os.path.basename(self.rule_file) + ".compiled.json")
+
+    def _load_rules(self, progress=None):
+        """
+        Get the compiled rules for self.rule_file, from the cache if the file has not changed since it was compiled.
+
+        :return: A dict containing the compiled rules, with the expressions of statements as expression trees,
+          or None on failure
+        """
+        try:
+            digest = sha256sum(self.rule_file) if self.shared is None else self.shared.digest(self.rule_file)
+        except IOError:
+            parse_logger.error("Unable to open rules file:  {0}".format(self.rule_file))
+            return None
+        if self.shared is not None and not self.trace.enabled:
+            compiled = self.shared.compiled.get((self.rule_file, digest))
+            if compiled is None:
+                compiled = self._load_compiled(digest, progress)
+                if compiled is not None:
+                    # The rules file changed, so forget what was compiled from it before
+                    for (rule_file, old_digest) in list(self.shared.compiled):
+                        if rule_file == self.rule_file:
+                            del self.shared.compiled[(rule_file, old_digest)]
+                    self.shared.compiled[(self.rule_file, digest)] = compiled
+            return compiled
+        return self._load_compiled(digest, progress)
+
+    def _load_compiled(self, digest, progress=None):
+        """Get the compiled rules for self.rule_file (which has the hash digest), from the cache directory if possible"""
+        if self.cache_dir and not self.trace.enabled:
+            try:
+                with open(self._cache_file(), 'r', encoding="utf-8") as cache:
+                    compiled = json.load(cache)
+                if compiled.get("sha256") == digest and compiled.get("format") == COMPILED_RULES_FORMAT:
+                    parse_logger.debug("Using compiled rules from: \"{0}\"".format(self._cache_file()))
+                    if self.timings is not None:
+                        self.timings.count("compiled rules loaded from the cache")
+                    return self._with_trees(compiled)
+            except (IOError, ValueError):
+                pass
+
+        compiled = self._compile_rules(progress)
+        if compiled is None:
+            return None
+        compiled["sha256"] = digest
+        if not self.cache_dir:
+            return self._with_trees(compiled)
+        try:
+            with open(self._cache_file(), 'w', encoding="utf-8") as cache:
+                json.dump(compiled, cache)
+        except IOError:
+            parse_logger.warning("Unable to save compiled rules to:  {0}".format(self._cache_file()))
+        return self._with_trees(compiled)
+
+    @staticmethod
+    def _with_trees(compiled):
+        """Replace the expressions of the statements in compiled rules with expression trees"""
+        rules = []
+        for rule in compiled["rules"]:
+            if rule[0] in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                rule = rule[:3] + [tuple(map(to_expression, rule[3]))]
+            rules.append(rule)
+        compiled["rules"] = rules
+        return compiled
 
     @staticmethod
     def _pprint(expr, prefix):
@@ -629,35 +1355,64 @@ class RuleParser:
             return filter(lambda x: x.find('MISSING(') == -1, item)
         return item
 
-    def _parse_statement(self, rule, msg, expr):
-        self.parse_dbg_indent += "  "
-        parse_logger.debug("parse_statement(%s, %s, %s)" % (rule, msg, expr))
-        expr = expr.strip()
-        if msg == "":
-            if expr == "":
-                self._parse_message_block()
-                expr = self.buffer
-        else:
-            self.message = [msg]
-        if expr == "":
-            if not self._readline():
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+    def _eval_ordering(self, i, rule, entries, eof_line):
+        """
+        Add an ordering rule (the i'th compiled rule) to the graph.
+
+        Any warnings are also recorded in self.ordering_warnings, so they can be given again for a graph snapshot.
+        """
+        prev = []
+        n_order = 0
+        for (line_num, name) in entries:
+            matches = self.context.eval_plugin_name(name)[1]
+
+            # go through all matches of the current line
+            for pnam in matches:
+                n_order += 1
+
+                if rule == "ORDER":
+                    for _prev in prev:
+                        if not self.graph.add_edge(self._where(line_num), _prev, pnam, self.out_stream):
+                            self.ordering_warnings.append([i, "cycle", self._where(line_num), _prev, pnam])
+                            if self.trace.active:
+                                self.trace.log("%s before %s would make a cycle, skipped", _prev, pnam)
+                        elif self.trace.active:
+                            self.trace.log("%s before %s", _prev, pnam)
+
+                elif rule == "NEARSTART":
+                    self.graph.nearstart.append(pnam)
+                    self.graph.nodes.setdefault(pnam, [])
+                    if self.trace.active:
+                        self.trace.log("%s near the start", pnam)
+
+                elif rule == "NEAREND":
+                    self.graph.nearend.append(pnam)
+                    self.graph.nodes.setdefault(pnam, [])
+                    if self.trace.active:
+                        self.trace.log("%s near the end", pnam)
+
+            prev = matches
+
+        if rule == "ORDER" and eof_line is not None:
+            if n_order == 0:
+                warning = "%s: ORDER rule has no entries" % (self._where(eof_line))
+            elif n_order == 1:
+                warning = "%s: ORDER rule skipped because it only has one entry: %s" % (
+                    self._where(eof_line), self.name_converter.truename(prev[0]))
+            else:
                 return
-        else:
-            self.buffer = expr
-        msg = "" if self.message == [] else " |" + "\n |".join(self.message)  # no ending LF
+            parse_logger.warning(warning)
+            self.ordering_warnings.append([i, "log", warning])
+
+    def _eval_statement(self, rule, line_num, message, exprs):
+        if self.trace.active:
+            self.trace.log("eval_statement(%s, %s, %s)", rule, message, exprs)
+        msg = "" if message == [] else " |" + "\n |".join(message)  # no ending LF
 
         if rule == "CONFLICT":  # takes any number of exprs
-            exprs = []
-            parse_logger.debug("before conflict parse_expr() expr=%s line=%s" % (expr, self.buffer))
-            (b, expr) = self._parse_expression()
-            parse_logger.debug("conflict parse_expr()1 bool=%s bool=%s" % (b, expr))
-            while b is not None:
-                if b:
-                    exprs.append(expr)
-                (b, expr) = self._parse_expression()
-                parse_logger.debug("conflict parse_expr()N bool=%s bool=%s" % ("True" if b else "False", expr))
+            exprs = [expr for expr in exprs if self.context.truth(expr)]
             if len(exprs) > 1:
+                exprs = [self.context.evaluate(expr)[1] for expr in exprs]
                 print("[CONFLICT]", file=self.out_stream)
                 for e in exprs:
                     if isinstance(e, list):
@@ -672,13 +1427,7 @@ class RuleParser:
                     print(msg, file=self.out_stream)
 
         elif rule == "NOTE":  # takes any number of exprs
-            parse_logger.debug("function NOTE: %s" % msg)
-            exprs = []
-            (b, expr) = self._parse_expression(prune=True)
-            while b is not None:
-                if b:
-                    exprs.append(expr)
-                (b, expr) = self._parse_expression(prune=True)
+            exprs = [self.context.evaluate(expr, prune=True)[1] for expr in exprs if self.context.truth(expr)]
             if len(exprs) > 0:
                 print("[NOTE]", file=self.out_stream)
                 for e in exprs:
@@ -687,16 +1436,17 @@ class RuleParser:
                     print(msg, file=self.out_stream)
 
         elif rule == "PATCH":  # takes 2 exprs
-            (bool1, expr1) = self._parse_expression()
-            if bool1 is None:
-                parse_logger.warning("%s: PATCH rule invalid first expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+            if len(exprs) < 1:
+                parse_logger.warning("%s: PATCH rule invalid first expression" % (self._where(line_num)))
                 return
-            (bool2, expr2) = self._parse_expression()
-            if bool2 is None:
-                parse_logger.warning("%s: PATCH rule invalid second expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+            bool1 = self.context.truth(exprs[0])
+            if len(exprs) < 2:
+                parse_logger.warning("%s: PATCH rule invalid second expression" % (self._where(line_num)))
                 return
+            bool2 = self.context.truth(exprs[1])
+            if bool1 != bool2:
+                expr1 = self.context.evaluate(exprs[0])[1]
+                expr2 = self.context.evaluate(exprs[1])[1]
             if bool1 and not bool2:
                 # case where the patch is present but the thing to be patched is missing
                 print("[PATCH]\n%s is missing some pre-requisites:\n%s\n" % (
@@ -724,17 +1474,16 @@ class RuleParser:
                     print(msg, file=self.out_stream)
 
         elif rule == "REQUIRES":  # takes 2 exprs
-            (bool1, expr1) = self._parse_expression(prune=True)
-            if bool1 is None:
-                parse_logger.warning("%s: REQUIRES rule invalid first expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+            if len(exprs) < 1:
+                parse_logger.warning("%s: REQUIRES rule invalid first expression" % (self._where(line_num)))
                 return
-            (bool2, expr2) = self._parse_expression()
-            if bool2 is None:
-                parse_logger.warning("%s: REQUIRES rule invalid second expression" % (self._where()))
-                self.parse_dbg_indent = self.parse_dbg_indent[:-2]
+            bool1 = self.context.truth(exprs[0])
+            if len(exprs) < 2:
+                parse_logger.warning("%s: REQUIRES rule invalid second expression" % (self._where(line_num)))
                 return
-            if bool1 and not bool2:
+            if bool1 and not self.context.truth(exprs[1]):
+                expr1 = self.context.evaluate(exprs[0], prune=True)[1]
+                expr2 = self.context.evaluate(exprs[1])[1]
                 expr2_str = self._pprint(expr2, " > ")
                 print("[REQUIRES]\n%s Requires:\n%s\n" % (self._pprint(expr1, " !!!"), expr2_str), file=self.out_stream)
 
@@ -752,60 +1501,177 @@ class RuleParser:
                         " | [Note that you may see this message if you have an older version of one of the pre-requisites. In that case, it is suggested that you upgrade to the newer version].",
                         file=self.out_stream)
 
-        self.parse_dbg_indent = self.parse_dbg_indent[:-2]
-        parse_logger.debug("parse_statement RETURNING")
+    def _relevant_statements(self, index):
+        """The positions of the statements that might fire for the plugins in self.plugin_list"""
+        relevant = set(index["always"])
+        for plugin in self.plugin_list:
+            relevant.update(index["names"].get(plugin.lower(), []))
+        for (stem, statements) in index["stems"].items():
+            if self.plugin_index.has_prefix(stem):
+                relevant.update(statements)
+        return relevant
+
+    def _graph_file(self, key):
+        """The file the graph snapshot for key is kept in"""
+        return os.path.join(self.cache_dir, "{0}.{1}.graph.json".format(os.path.basename(self.rule_file), key[:16]))
+
+    def _graph_key(self, compiled):
+        """
+        A hash of everything the graph built from the ordering rules in compiled depends on.
 
-    def read_rules(self, rule_file, progress=None):
-        """Read rules from rule files (e.g., mlox_user.txt or mlox_base.txt),
-        add order rules to graph, and print warnings."""
-        n_rules = 0
-        self.rule_file = rule_file
+        That is the rules themselves, the key of the graph from any earlier rules files, and what the filenames
+        with wildcards in them expand to for self.plugin_list.
+        :return: The key, or None if the graph from earlier rules files has no key
+        """
+        if self.graph_key is None:
+            return None
+        expansions = {}
+        for rule in compiled["rules"]:
+            if rule[0] in ("ORDER", "NEAREND", "NEARSTART"):
+                for (line_num, name) in rule[1]:
+                    name = self.name_converter.cname(name)
+                    if name not in expansions and filename_regex(name) is not None:
+                        expansions[name] = self.context.expand_filename(name)
+        key = [GRAPH_SNAPSHOT_FORMAT, self.rule_file, compiled["sha256"], self.graph_key, expansions]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def _load_graph(self, key):
+        """
+        Load the graph snapshot saved for key.
 
-        parse_logger.debug("Reading rules from: \"{0}\"".format(self.rule_file))
+        :return: The warnings given by the ordering rules, or None if there is no snapshot for key
+        """
+        if self.shared is not None:
+            if key not in self.shared.graphs:
+                return None
+            (graph, warnings) = self.shared.graphs[key]
+            self.graph = graph.copy()
+            return list(warnings)
+        graph_file = self._graph_file(key)
         try:
-            self.input_handle = open(self.rule_file, 'r', encoding="utf-8")
-            inputsize = os.path.getsize(self.rule_file)
-        except IOError:
-            parse_logger.error("Unable to open rules file:  {0}".format(self.rule_file))
-            return False
-
-        self.line_num = 0
-        while True:
-            if self.buffer == "":
-                if not self._readline():
-                    break
-
-            # Update the GUI progress bar
-            if progress is not None and inputsize > 0:
-                pct = int(100 * self.bytesread / inputsize)
-                if pct < 100:
-                    progress.update_value_and_label(pct, "Loading: {0}".format(self.rule_file))
+            with open(graph_file, 'r', encoding="utf-8") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if snapshot.get("key") != key:
+                return None
+            self.graph = pluggraph.pluggraph().from_map(snapshot["graph"])
+            os.utime(graph_file)  # the snapshots used least recently are the first to go
+        except (OSError, ValueError, KeyError):
+            return None
+        parse_logger.debug("Using graph snapshot from: \"{0}\"".format(graph_file))
+        return snapshot["warnings"]
+
+    def _save_graph(self, key):
+        """
+        Save a snapshot of the graph, and the warnings the ordering rules gave while building it.
 
-            self.parse_dbg_indent = ""
-            self.curr_rule = ""
-            new_rule = re_rule.match(self.buffer)
+        Only the GRAPH_SNAPSHOTS snapshots of self.rule_file used most recently are kept.
+        """
+        if self.shared is not None:
+            self.shared.add_graph(key, self.graph, self.ordering_warnings)
+            return
+        graph_file = self._graph_file(key)
+        try:
+            with open(graph_file, 'w', encoding="utf-8") as snapshot_file:
+                json.dump({"key": key, "graph": self.graph.to_map(), "warnings": self.ordering_warnings},
+                          snapshot_file, separators=(',', ':'))
+            prefix = os.path.basename(self.rule_file) + "."
+            snapshots = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir)
+                         if f.startswith(prefix) and f.endswith(".graph.json") and f.count(".") == prefix.count(".") + 2]
+            snapshots.sort(key=os.path.getmtime)
+            for old_file in snapshots[:-GRAPH_SNAPSHOTS]:
+                os.remove(old_file)
+        except OSError:
+            parse_logger.warning("Unable to save graph snapshot to:  {0}".format(graph_file))
+
+    def _repeat_warnings(self, warnings):
+        """Give the warnings recorded by _eval_ordering again"""
+        for warning in warnings:
+            if warning[1] == "cycle":
+                pluggraph.report_cycle(*warning[2:], out_stream=self.out_stream)
+            else:
+                parse_logger.warning(warning[2])
+        self.ordering_warnings += warnings
 
-            if new_rule:  # start a new rule
-                n_rules += 1
-                self.curr_rule = new_rule.group(1).upper()
-                self.message = []
+    def _eval_rules(self, compiled):
+        """
+        Evaluate compiled rules, adding order rules to the graph, and printing warnings.
 
-                if self.curr_rule == "VERSION":
-                    self.buffer = ""
-                    self.version = new_rule.group(2)
-                    parse_logger.info("\"{0}\" Version {1}".format(os.path.basename(self.rule_file), self.version))
-                elif self.curr_rule in ("ORDER", "NEAREND", "NEARSTART"):
-                    self._parse_ordering(self.curr_rule)
-                elif self.curr_rule in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
-                    self._parse_statement(self.curr_rule, new_rule.group(2), new_rule.group(3))
+        Statements that can't fire for the active plugins are skipped.
+        When the rules were read from the cache, the ordering rules are only evaluated if there is no
+        graph snapshot that matches the active plugins.
+        """
+        for name in compiled["spellings"]:
+            self.name_converter.cname(name)
+        key = None
+        with phase(self.timings, "graph build"):
+            if (self.cache_dir or self.shared is not None) and not self.trace.enabled:
+                key = self._graph_key(compiled)
+            warnings = self._load_graph(key) if key else None
+        if warnings is not None and self.timings is not None:
+            self.timings.count("graph snapshots used")
+        by_rule = {}
+        for warning in warnings or []:
+            by_rule.setdefault(warning[0], []).append(warning)
+        self.ordering_warnings = []
+        relevant = self._relevant_statements(compiled["index"])
+        parse_logger.debug("{0} statements may fire for the active plugins".format(len(relevant)))
+        for (i, rule) in enumerate(compiled["rules"]):
+            if self.timings is not None:
+                (start, checks) = (time.perf_counter(), self.context.predicate_checks)
+            if rule[0] == "VERSION":
+                self.version = rule[1]
+                parse_logger.info("\"{0}\" Version {1}".format(os.path.basename(self.rule_file), self.version))
+            elif rule[0] in ("ORDER", "NEAREND", "NEARSTART"):
+                if self.trace.enabled:
+                    self.trace.start(self.rule_file, self._trace_lines(rule), [name for (line_num, name) in rule[1]])
+                if warnings is None:
+                    self._eval_ordering(i, *rule)
                 else:
-                    # we should never reach here, since re_rule only matches known rules
-                    self._parse_error("read_rules failed sanity check, unknown rule")
+                    self._repeat_warnings(by_rule.get(i, []))
+            elif rule[0] in ("CONFLICT", "NOTE", "PATCH", "REQUIRES"):
+                if self.trace.enabled:
+                    self.trace.start(self.rule_file, self._trace_lines(rule), list(self._tree_names(rule[3])))
+                if i in relevant:
+                    self._eval_statement(*rule)
+                elif self.trace.active:
+                    self.trace.log("skipped, none of the plugins it needs are active")
+            elif rule[0] == "ERROR":
+                (line_num, curr_rule, what, buffer) = rule[1:]
+                msg = "%s: Parse Error(%s), %s [Buffer=%s]" % (self._where(line_num), curr_rule, what, buffer)
+                parse_logger.error(msg)
+                print(f"[ERROR] {msg}", file=self.out_stream)
+            if self.timings is not None:
+                seconds = time.perf_counter() - start
+                self._time_rule(rule, "eval", seconds, self.context.predicate_checks - checks)
+                self.timings.add_phase("graph build" if rule[0] in ("ORDER", "NEAREND", "NEARSTART") else "statements",
+                                       seconds)
+        self.trace.stop()
+        if key and warnings is None:
+            with phase(self.timings, "graph build"):
+                self._save_graph(key)
+        self.graph_key = key
+
+    def prefetch_headers(self):
+        """Read the headers of every plugin in the plugin list, so [DESC], [VER] and [SIZE] don't wait on the disk."""
+        if self.datadir is not None:
+            self.headers.prefetch([self.datadir.find_path(p) for p in self.plugin_list])
 
-            else:
-                self._parse_error("expected start of rule")
+    def read_rules(self, rule_file, progress=None):
+        """Read rules from rule files (e.g., mlox_user.txt or mlox_base.txt),
+        add order rules to graph, and print warnings."""
+        self.rule_file = rule_file
+
+        parse_logger.debug("Reading rules from: \"{0}\"".format(self.rule_file))
+        with phase(self.timings, "rules read"):
+            compiled = self._load_rules(progress)
+        if compiled is None:
+            return False
+        with phase(self.timings, "header reads"):
+            self.prefetch_headers()
+        # _eval_rules adds the time spent on ordering rules to "graph build", and on statements to "statements"
+        self._eval_rules(compiled)
 
-        parse_logger.info("Read {0} rules from: \"{1}\"".format(n_rules, self.rule_file))
+        parse_logger.info("Read {0} rules from: \"{1}\"".format(compiled["n_rules"], self.rule_file))
 
         return True
 
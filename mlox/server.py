@@ -0,0 +1,148 @@
+"""
+Keep the rules in memory, and answer load order requests from other programs.
+
+Requests and responses are JSON objects, sent either as the body of an HTTP POST to localhost,
+or one per line over a Unix socket.
+The rules are only read again when one of the rules files' hash changes.
+The plugin headers and the results of earlier sorts are kept in memory for as long as the server runs.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from mlox import ruleParser
+from mlox.loadOrder import Loadorder, ResultCache
+
+server_logger = logging.getLogger('mlox.server')
+
+DEFAULT_PORT = 8052
+
+
+def server_loadorder():
+    """
+    A Loadorder for answering requests, for as long as the server runs.
+
+    It keeps the rules, the plugin headers and the results of earlier sorts in memory,
+    and doesn't look for a game, as requests bring their own plugin list.
+    """
+    return Loadorder(ruleParser.RuleCache(), results=ResultCache(), find_dirs=False)
+
+
+def handle_request(a_loadorder, request):
+    """
+    Answer a request, using a_loadorder (see server_loadorder()).
+
+    A request has:
+      "command": "sort" (the default), "check" (only give the warnings), or "explain"
+      "plugins": the load order, as a list of plugin names
+      "plugin": the plugin to explain
+      "base_only" and "priority_sort": the same as the command line options
+    :returns: The response, which has an "error" if the request could not be answered
+    """
+    if not isinstance(request, dict):
+        return {"error": "The request must be a JSON object"}
+    command = request.get("command", "sort")
+    plugins = request.get("plugins")
+    if not isinstance(plugins, list) or not all(isinstance(p, str) for p in plugins):
+        return {"error": "\"plugins\" must be a list of plugin names"}
+    a_loadorder.read_from_list(plugins)
+    if command == "explain":
+        plugin = request.get("plugin")
+        if not isinstance(plugin, str):
+            return {"error": "\"plugin\" must be the name of the plugin to explain"}
+        return {"explanation": a_loadorder.explain(plugin, bool(request.get("base_only")))}
+    if command == "check":
+        return {"messages": a_loadorder.update(None, True)}
+    if command == "sort":
+        messages = a_loadorder.update(None, False, bool(request.get("priority_sort")))
+        return {"messages": messages, "new_order": a_loadorder.new_order, "is_sorted": a_loadorder.is_sorted,
+                "hints": a_loadorder.get_hints()}
+    return {"error": "Unknown command: {0}".format(command)}
+
+
+def _answer(a_loadorder, data):
+    """Answer a request that has not been decoded yet"""
+    try:
+        request = json.loads(data)
+    except ValueError as e:
+        return {"error": "Invalid JSON: {0}".format(e)}
+    try:
+        return handle_request(a_loadorder, request)
+    except Exception as e:
+        server_logger.exception("Unable to answer request")
+        return {"error": str(e)}
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """Answer requests POSTed to any path"""
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send(400, {"error": "Invalid Content-Length: {0}".format(self.headers.get("Content-Length"))})
+            return
+        self._send(200, _answer(self.server.loadorder, self.rfile.read(length)))
+
+    def _send(self, status, answer):
+        body = json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        server_logger.debug(format % args)
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    """Answer each line sent over the socket, until it is closed"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            self.wfile.write(json.dumps(_answer(self.server.loadorder, line)).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+def serve(port=DEFAULT_PORT, socket_path=None):
+    """
+    Answer requests until interrupted.
+
+    Listens on the Unix socket at socket_path if one is given, otherwise on localhost:port over HTTP.
+    """
+    if socket_path is not None:
+        if not hasattr(socket, "AF_UNIX"):
+            server_logger.error("Unix sockets are not supported here, use a port instead.")
+            return 1
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                server_logger.error("Not a socket: {0}".format(socket_path))
+                return 1
+            os.remove(socket_path)
+        server = socketserver.UnixStreamServer(socket_path, SocketHandler)
+        where = socket_path
+    else:
+        server = HTTPServer(("127.0.0.1", port), HTTPHandler)
+        where = "http://127.0.0.1:{0}/".format(port)
+    server.loadorder = server_loadorder()
+    # Read the rules now, instead of on the first request
+    handle_request(server.loadorder, {"command": "check", "plugins": []})
+    server_logger.info("Serving load order requests on: {0}".format(where))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
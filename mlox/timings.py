@@ -0,0 +1,83 @@
+"""
+Where a run spends its time.
+
+A Timings records the wall time of each phase of sorting a load order, and of compiling and evaluating each rule,
+along with how many predicates ([DESC], [VER], [SIZE] and [MWSE-LUA] on a plugin) each rule checked.
+"""
+import time
+from contextlib import contextmanager, nullcontext
+
+# The phases of a run, in the order they happen
+PHASES = ["discovery", "rules read", "header reads", "graph build", "statements", "current order", "sort", "write"]
+
+# How many of the slowest rules the report shows
+RULES_SHOWN = 20
+
+
+def phase(timings, name):
+    """A context timing the phase name in timings, or doing nothing if timings is None"""
+    return nullcontext() if timings is None else timings.phase(name)
+
+
+class Timings:
+    """The wall time of each phase and each rule, and counts of the things that cost time"""
+
+    def __init__(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)  # phase: seconds
+        self.rules = {}  # "rules file:line": {"rule": name, "parse": seconds, "eval": seconds, "checks": count}
+        self.counts = {}  # what: how many times it happened
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the with block to the phase name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        """Add seconds to the phase name"""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_rule(self, where, rule, what, seconds, checks=0):
+        """
+        Add the time spent on the rule at where ("rules file:line").
+
+        :param what: "parse" or "eval"
+        :param checks: The number of predicates the rule checked
+        """
+        entry = self.rules.setdefault(where, {"rule": rule, "parse": 0.0, "eval": 0.0, "checks": 0})
+        entry[what] += seconds
+        entry["checks"] += checks
+
+    def count(self, what, n=1):
+        self.counts[what] = self.counts.get(what, 0) + n
+
+    def slowest_rules(self, limit=RULES_SHOWN):
+        """The (where, entry) of the limit rules that took the longest, slowest first"""
+        by_time = sorted(self.rules.items(), key=lambda item: item[1]["parse"] + item[1]["eval"], reverse=True)
+        return by_time[:limit]
+
+    def to_json(self):
+        """The whole report, as something json.dump can write"""
+        return {"phases": self.phases, "rules": self.rules, "counts": self.counts}
+
+    def report(self, limit=RULES_SHOWN):
+        """A table of the phases, the counts, and the limit slowest rules"""
+        lines = ["{0:<40} {1:>10}".format("Phase", "ms")]
+        for (name, seconds) in self.phases.items():
+            lines.append("{0:<40} {1:>10.1f}".format(name, seconds * 1000))
+        lines.append("{0:<40} {1:>10.1f}".format("total", sum(self.phases.values()) * 1000))
+        if self.counts:
+            lines.append("")
+            lines.append("{0:<40} {1:>10}".format("Count", "n"))
+            for (what, n) in sorted(self.counts.items()):
+                lines.append("{0:<40} {1:>10}".format(what, n))
+        if self.rules:
+            lines.append("")
+            lines.append("{0:<40} {1:<10} {2:>10} {3:>10} {4:>6}".format("Rule", "", "parse ms", "eval ms", "checks"))
+            for (where, entry) in self.slowest_rules(limit):
+                lines.append("{0:<40} {1:<10} {2:>10.3f} {3:>10.3f} {4:>6}".format(
+                    where[-40:], entry["rule"], entry["parse"] * 1000, entry["eval"] * 1000, entry["checks"]))
+        return "\n".join(lines)
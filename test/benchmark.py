@@ -0,0 +1,271 @@
+#! /usr/bin/python3
+
+# Benchmarks for the rules parser, the plugin graph and load orders, on synthetic rules and plugins
+#
+# Run from the test directory:
+#   ./benchmark.py            compare against the baselines in benchmark_baseline.json
+#   ./benchmark.py --save     store the times of this run as the new baselines
+# Baselines are only compared when the sizes they were measured with are the same,
+# and they only mean something on the machine they were saved on.
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mlox import configHandler, fileFinder, pluggraph, ruleParser  # noqa: E402
+from mlox.loadOrder import Loadorder, ResultCache  # noqa: E402
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# The sizes of the synthetic rules and plugins
+DEFAULT_SIZES = {
+    "plugins": 5000,  # plugins in the fake Data Files directory
+    "chains": 500,  # [Order] rules
+    "chain_length": 8,  # plugins in each [Order] rule
+    "statements": 2000,  # [Note], [Conflict], [Requires] and [Patch] rules
+    "wildcards": 0.1,  # the fraction of plugin names in the rules written with * or <VER>
+    "depth": 3,  # how deeply [ALL], [ANY] and [NOT] are nested
+    "predicates": 0.3,  # the fraction of expressions that are [DESC] or [SIZE]
+    "edges": 20000,  # edges added to a plugin graph
+}
+
+WORDS = ["Armor", "Weapons", "Quest", "Town", "Creatures", "Patch", "Hair", "Books", "Ships", "Lights"]
+
+
+def plugin_names(n, seed):
+    """n plugin names, about one in ten of them masters, with a version number in most of them"""
+    rng = random.Random(seed)
+    names = []
+    for i in range(n):
+        ext = ".esm" if rng.random() < 0.1 else ".esp"
+        ver = " %d.%d" % (rng.randrange(1, 4), rng.randrange(0, 10)) if rng.random() < 0.7 else ""
+        names.append("Synth %s %04d%s%s" % (rng.choice(WORDS), i, ver, ext))
+    return names
+
+
+def tes3_plugin(description, masters=(), size=0):
+    """The bytes of a TES3 plugin with a real header (a TES3 record, with HEDR, MAST and DATA), padded to size"""
+    hedr = struct.pack("<fi32s256si", 1.3, 0, b"mlox benchmark", description.encode("utf-8")[:255], 0)
+    subrecords = b"HEDR" + struct.pack("<i", len(hedr)) + hedr
+    for (master, master_size) in masters:
+        name = master.encode("utf-8") + b"\x00"
+        subrecords += b"MAST" + struct.pack("<i", len(name)) + name
+        subrecords += b"DATA" + struct.pack("<iq", 8, master_size)
+    plugin = b"TES3" + struct.pack("<iii", len(subrecords), 0, 0) + subrecords
+    return plugin + b"\x00" * max(0, size - len(plugin))
+
+
+def make_data_dir(path, names, seed):
+    """
+    Write a fake Data Files directory, with a plugin for each of names.
+
+    Each plugin has a description with a version number and a few words in it, and some of the masters as its masters.
+    :returns: {plugin name: (description, size)}
+    """
+    rng = random.Random(seed)
+    masters = [name for name in names if name.endswith(".esm")]
+    info = {}
+    mtime = 1100000000
+    for name in names:
+        description = "Version %d.%d of the %s mod" % (rng.randrange(1, 4), rng.randrange(0, 10), rng.choice(WORDS))
+        size = rng.randrange(400, 4000)
+        plugin_masters = [(master, info[master][1]) for master in rng.sample(masters, min(2, len(masters)))
+                          if master in info]
+        with open(os.path.join(path, name), 'wb') as plugin:
+            plugin.write(tes3_plugin(description, plugin_masters, size))
+        mtime += 60
+        os.utime(os.path.join(path, name), (mtime, mtime))
+        info[name] = (description, size)
+    return info
+
+
+def rule_name(name, rng, wildcards):
+    """How a rule refers to a plugin: by its name, or (for a fraction of them) with a wildcard or <VER>"""
+    if rng.random() >= wildcards:
+        return name
+    (stem, ext) = os.path.splitext(name)
+    parts = stem.rsplit(" ", 1)
+    if len(parts) == 2 and parts[1][:1].isdigit() and "." in parts[1]:
+        return parts[0] + " <VER>" + ext
+    return stem[:-2] + "*" + ext
+
+
+def make_expression(names, info, rng, sizes, depth):
+    """A random expression, nested up to depth"""
+    roll = rng.random()
+    if depth > 0 and roll < 0.3:
+        fun = rng.choice(["ALL", "ANY", "NOT"])
+        exprs = [make_expression(names, info, rng, sizes, depth - 1) for _ in range(rng.randrange(1, 4))]
+        return "[%s %s]" % (fun, " ".join(exprs))
+    name = rng.choice(names)
+    if roll < 0.3 + sizes["predicates"] / 2:
+        word = rng.choice(WORDS)
+        return "[DESC %s/%s/ %s]" % (rng.choice(["", "!"]), word, name)
+    if roll < 0.3 + sizes["predicates"]:
+        size = info[name][1] if rng.random() < 0.5 else rng.randrange(400, 4000)
+        return "[SIZE %s%d %s]" % (rng.choice(["", "!"]), size, name)
+    return rule_name(name, rng, sizes["wildcards"])
+
+
+def make_rules(path, names, info, sizes, seed):
+    """Write a rules file, using the plugins in names"""
+    rng = random.Random(seed)
+    lines = ["[Version 2024.01.01]"]
+    for _ in range(sizes["chains"]):
+        chain = sorted(rng.sample(range(len(names)), sizes["chain_length"]))
+        if rng.random() < 0.02:
+            chain.reverse()  # some rules contradict others, like in real rules files
+        lines.append("[Order]")
+        lines += [rule_name(names[i], rng, sizes["wildcards"]) for i in chain]
+        lines.append("")
+    for i in range(sizes["statements"]):
+        rule = rng.choice(["Note", "Conflict", "Requires", "Patch"])
+        lines.append("[%s]" % rule)
+        lines.append(" Synthetic %s number %d" % (rule.lower(), i))
+        n_exprs = 2 if rule in ("Requires", "Patch") else rng.randrange(1, 4)
+        lines += [make_expression(names, info, rng, sizes, sizes["depth"]) for _ in range(n_exprs)]
+        lines.append("")
+    with open(path, 'w', encoding="utf-8") as rules:
+        rules.write("\n".join(lines) + "\n")
+
+
+def best_time(fn, repeat, setup=None):
+    """The shortest time fn() took, out of repeat runs (each after setup(), which isn't timed)"""
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def run_benchmarks(work_dir, sizes, repeat, seed):
+    """:returns: {benchmark name: seconds}"""
+    results = {}
+    caseless = fileFinder.caseless_filenames()
+    names = plugin_names(sizes["plugins"], seed)
+    data_dir = os.path.join(work_dir, "Data Files")
+    os.mkdir(data_dir)
+    info = make_data_dir(data_dir, names, seed)
+    rules_file = os.path.join(work_dir, "mlox_base.txt")
+    make_rules(rules_file, names, info, sizes, seed)
+    order = [caseless.cname(name) for name in names]
+
+    def read_rules():
+        parser = ruleParser.RuleParser(order, data_dir, caseless)
+        parser.read_rules(rules_file)
+        return parser
+    results["RuleParser.read_rules"] = best_time(read_rules, repeat)
+    rules_graph = read_rules().get_graph()
+
+    rng = random.Random(seed)
+    edges = []
+    for _ in range(sizes["edges"]):
+        (a, b) = sorted(rng.sample(range(len(order)), 2))
+        if rng.random() < 0.02:
+            (a, b) = (b, a)
+        edges.append((order[a], order[b]))
+
+    def add_edges():
+        graph = pluggraph.pluggraph()
+        for (a, b) in edges:
+            graph.add_edge("", a, b, io.StringIO())
+        return graph
+    results["pluggraph.add_edge"] = best_time(add_edges, repeat)
+    graph = add_edges()
+    results["pluggraph.topo_sort"] = best_time(graph.topo_sort, repeat)
+
+    # Like a user's load order, this mostly follows the rules already
+    current_order = list(order)
+    for _ in range(len(order) // 20):
+        (a, b) = rng.sample(range(len(order)), 2)
+        (current_order[a], current_order[b]) = (current_order[b], current_order[a])
+    loadorder = Loadorder(ruleParser.RuleCache(), results=ResultCache(), find_dirs=False)
+    (loadorder.order, loadorder.game_type) = (current_order, None)
+    graphs = []  # a fresh copy of the rules' graph for each run
+    results["Loadorder.add_current_order"] = best_time(lambda: loadorder.add_current_order(graphs[-1]), repeat,
+                                                       lambda: graphs.append(rules_graph.copy()))
+
+    results["dataDirHandler.read"] = best_time(lambda: configHandler.dataDirHandler(data_dir).read(), repeat)
+    orders = [list(names), list(names)]
+    random.Random(seed).shuffle(orders[0])
+    # Each run puts the plugins in the other order, so every run has to move them
+    results["dataDirHandler.write"] = best_time(
+        lambda: configHandler.dataDirHandler(data_dir).write(orders[0]), repeat, lambda: orders.reverse())
+    return results
+
+
+def compare(results, sizes, baseline, tolerance):
+    """Print the results next to the baseline. :returns: The names of the benchmarks that got slower"""
+    usable = baseline is not None and baseline.get("sizes") == sizes
+    if baseline is not None and not usable:
+        print("The baseline was measured with different sizes, not comparing.")
+    slower = []
+    print("{0:<32} {1:>12} {2:>12} {3:>8}".format("Benchmark", "ms", "baseline ms", "ratio"))
+    for (name, seconds) in results.items():
+        base = baseline["results"].get(name) if usable else None
+        if base:
+            ratio = seconds / base
+            flag = "  SLOWER" if ratio > tolerance else ""
+            if flag:
+                slower.append(name)
+            print("{0:<32} {1:>12.1f} {2:>12.1f} {3:>8.2f}{4}".format(name, seconds * 1000, base * 1000, ratio, flag))
+        else:
+            print("{0:<32} {1:>12.1f} {2:>12} {3:>8}".format(name, seconds * 1000, "-", "-"))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mlox on synthetic rules and plugins.")
+    parser.add_argument("--save", help="Save the times of this run as the new baselines.", action="store_true")
+    parser.add_argument("--baseline", help="The baseline file. Default is benchmark_baseline.json.",
+                        default=BASELINE_FILE)
+    parser.add_argument("--tolerance", help="How many times slower than its baseline a benchmark may be. "
+                                            "Default is 1.5.", type=float, default=1.5)
+    parser.add_argument("--repeat", help="Run each benchmark N times, and keep the best. Default is 3.",
+                        metavar="N", type=int, default=3)
+    parser.add_argument("--seed", help="Seed for the synthetic rules and plugins. Default is 0.", type=int, default=0)
+    for (size, default) in DEFAULT_SIZES.items():
+        parser.add_argument("--" + size.replace("_", "-"), help="Default is {0}.".format(default),
+                            type=type(default), default=default)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    sizes = {size: getattr(args, size) for size in DEFAULT_SIZES}
+    sizes["seed"] = args.seed
+
+    baseline = None
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r', encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(work_dir, sizes, args.repeat, args.seed)
+    finally:
+        shutil.rmtree(work_dir)
+
+    slower = compare(results, sizes, None if args.save else baseline, args.tolerance)
+    if args.save:
+        with open(args.baseline, 'w', encoding="utf-8") as baseline_file:
+            json.dump({"sizes": sizes, "results": results}, baseline_file, indent=2)
+        print("Saved the baselines to: {0}".format(args.baseline))
+    elif slower:
+        print("Slower than the baseline: {0}".format(", ".join(slower)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -45,6 +45,20 @@ class FileFinderTests(unittest.TestCase):
         # print(fileFinder.filter_dup_files(dir_list.filelist()))
 
 
+    def test_dir_snapshot(self):
+        import mlox.fileFinder as fileFinder
+        snapshot = fileFinder.dir_snapshot("./test1.data/")
+        path = os.path.join(os.path.abspath("./test1.data"), "Morrowind.esm")
+        stat = os.stat(path)
+        entry = snapshot.entry("MORROWIND.ESM")
+        self.assertEqual((entry.name, entry.st_size, entry.st_mtime_ns, entry.is_file),
+                         ("Morrowind.esm", stat.st_size, stat.st_mtime_ns, True))
+        self.assertEqual(snapshot.find_path("morrowind.esm"), path)
+        self.assertEqual(snapshot.path_entry(path), entry)
+        self.assertIsNone(snapshot.path_entry(os.path.abspath("module_test.py")))
+        self.assertEqual(sorted(e.name for e in snapshot.listing), sorted(os.listdir("./test1.data/")))
+
+
 class ConfigHandlerTest(unittest.TestCase):
     """ Test mlox.configHandler """
     import mlox.configHandler as configHandler
@@ -109,6 +123,13 @@ class ConfigHandlerTest(unittest.TestCase):
             self.assertEqual(self.configHandler.configHandler("./userfiles/zinx.txt","Invalid").read(),self.zinx_txt)
             self.assertEqual(l.output, ['WARNING:mlox.configHandler:"Invalid" is not a recognized file type!'])
 
+    def test_iter_plugins(self):
+        plugins = self.configHandler.configHandler("./userfiles/zinx.txt").iter_plugins()
+        self.assertEqual(next(plugins), self.zinx_txt[0])
+        self.assertEqual([self.zinx_txt[0]] + list(plugins), self.zinx_txt)
+        self.assertEqual(self.configHandler.caseless_uniq(["a.esp", "B.esp", "A.esp", "b.ESP", "c.esp"]),
+                         (["a.esp", "B.esp", "c.esp"], ["A.esp", "b.ESP"]))
+
     def test_Default(self):
         self.assertEqual(self.configHandler.configHandler("./userfiles/zinx.txt").read(),self.zinx_txt)
 
@@ -131,6 +152,24 @@ class ConfigHandlerTest(unittest.TestCase):
         self.assertEqual(dirHandler.read(),self.modified_plugins)
         dirHandler.write(self.test1_plugins)
 
+    def test_dirHandler_minimal_moves(self):
+        """Only the plugins that move get new times"""
+        import tempfile
+        import shutil
+        data_dir = tempfile.mkdtemp()
+        plugins = ["a.esp", "b.esp", "c.esp", "d.esp", "e.esp"]
+        for (i, plugin) in enumerate(plugins):
+            open(os.path.join(data_dir, plugin), 'w').close()
+            os.utime(os.path.join(data_dir, plugin), (1100000000, 1100000000 + 60 * i))
+        dirHandler = self.configHandler.dataDirHandler(data_dir)
+        new_order = ["a.esp", "d.esp", "b.esp", "c.esp", "e.esp"]
+        self.assertEqual(dirHandler._new_mtimes(new_order), {"d.esp": 1100000030})
+        self.assertTrue(dirHandler.write(new_order))
+        self.assertEqual(dirHandler.read(), new_order)
+        self.assertEqual(os.path.getmtime(os.path.join(data_dir, "e.esp")), 1100000240)
+        shutil.rmtree(data_dir)
+        self.assertEqual(self.configHandler.longest_increasing([3, 1, 2, 5, 4, 6]), {1, 2, 4, 5})
+
     def test_morrowind_ini_clearing_writing(self):
         """
         Test both clearing and writing to a morrowind.ini file at the same time
@@ -228,6 +267,297 @@ class ParserAndPluggraphTest(unittest.TestCase):
         graph=myParser.get_graph()
         self.assertEqual(graph.topo_sort(),self.test1_graph)
 
+    def test_parser_compiled_cache(self):
+        """Rules read from the compiled cache must give the same results as rules read from text"""
+        import tempfile
+        import shutil
+        cache_dir = tempfile.mkdtemp()
+        results = []
+        for i in range(2):
+            myParser = self.ruleParser.RuleParser([], "./test1.data/", self.file_names, cache_dir)
+            self.assertTrue(myParser.read_rules("./test1.data/mlox_base.txt"))
+            self.assertTrue(os.path.isfile(os.path.join(cache_dir, "mlox_base.txt.compiled.json")))
+            results.append((myParser.get_messages(), myParser.get_graph().topo_sort()))
+        shutil.rmtree(cache_dir)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1][1], self.test1_graph)
+
+    def test_header_cache(self):
+        import tempfile
+        import shutil
+        temp_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(temp_dir, "headers.json")
+        plugin = "./test1.data/BB_Clothiers_of_Vvardenfell_v1.1.esp"
+        headers = self.ruleParser.HeaderCache(cache_file)
+        self.assertEqual(headers.description(plugin), self.ruleParser.plugin_description(plugin))
+        self.assertTrue(headers.changed)
+        headers.save()
+        # A fresh cache should not need to read the plugin again
+        headers = self.ruleParser.HeaderCache(cache_file)
+        self.assertEqual(headers.version(plugin), None)
+        self.assertFalse(headers.changed)
+        # Prefetching reads all the headers up front
+        headers = self.ruleParser.HeaderCache()
+        headers.prefetch([plugin, "./test1.data/Morrowind.esm", None])
+        self.assertEqual(headers.checked, {plugin, "./test1.data/Morrowind.esm"})
+        self.assertEqual(headers.size(plugin), os.path.getsize(plugin))
+        self.assertEqual(headers.masters("./test8.data/one.esp"), ['Morrowind.esm', 'Tribunal.esm', 'Bloodmoon.esm'])
+        shutil.rmtree(temp_dir)
+
+    def test_header_cache_prune(self):
+        import tempfile
+        import shutil
+        import json
+        temp_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(temp_dir, "headers.json")
+        plugin = "./test1.data/Morrowind.esm"
+        gone = os.path.join(temp_dir, "gone.esp")
+        with open(cache_file, 'w', encoding="utf-8") as cache:
+            json.dump({gone: [0, 0, "", None, []], "./test8.data/one.esp": [0, 0, "", None, []]}, cache)
+        headers = self.ruleParser.HeaderCache(cache_file)
+        headers.description(plugin)
+        headers.changed = False
+        # Saving drops the plugins that no longer exist, and keeps the ones that do, checked or not
+        headers.save()
+        with open(cache_file, 'r', encoding="utf-8") as cache:
+            self.assertEqual(set(json.load(cache)), {plugin, "./test8.data/one.esp"})
+        self.assertFalse(headers.changed)
+        shutil.rmtree(temp_dir)
+
+    def test_read_header(self):
+        import struct
+        import tempfile
+        header = self.ruleParser.read_header("./test8.data/one.esp")
+        self.assertEqual(header.game, "TES3")
+        self.assertEqual(header.author, "john.moonsugar@gmail.com")
+        self.assertTrue(header.description.startswith("Workaround for dialogue problem with Agnette"))
+        self.assertEqual(header.records, 2)
+        self.assertEqual(header.masters, ['Morrowind.esm', 'Tribunal.esm', 'Bloodmoon.esm'])
+        self.assertEqual(self.ruleParser.plugin_description("./test8.data/one.esp"), header.description)
+        # Empty files aren't plugins
+        self.assertEqual(self.ruleParser.read_header("./test1.data/Morrowind.esm"), None)
+        # A Skyrim style TES4 header, with the longer record header
+        subrecords = b"HEDR" + struct.pack("<HfII", 12, 1.7, 42, 0x800)
+        for (sub, text) in [(b"CNAM", "Author"), (b"SNAM", "Café Version 2.0"), (b"MAST", "Skyrim.esm")]:
+            data = text.encode("cp1252") + b"\x00"
+            subrecords += sub + struct.pack("<H", len(data)) + data
+        subrecords += b"DATA" + struct.pack("<HQ", 8, 0)
+        with tempfile.NamedTemporaryFile(suffix='.esp', delete=False) as plugin:
+            plugin.write(b"TES4" + struct.pack("<IIIII", len(subrecords), 1, 0, 0, 44) + subrecords)
+        header = self.ruleParser.read_header(plugin.name)
+        os.remove(plugin.name)
+        self.assertEqual(header, self.ruleParser.PluginHeader("TES4", "Author", "Café Version 2.0", 42, ["Skyrim.esm"]))
+
+    def test_expand_filename(self):
+        plugins = ['foo 1.0.esp', 'bar.esp', 'foo.esp', 'foo 2.esp', 'Foo 3.esp']
+        myParser = self.ruleParser.RuleParser(plugins, "", self.file_names)
+        self.assertEqual(myParser._expand_filename("bar.esp"), ["bar.esp"])
+        self.assertEqual(myParser._expand_filename("baz.esp"), [])
+        self.assertEqual(myParser._expand_filename("Foo *.esp"), ['foo 1.0.esp', 'foo 2.esp', 'Foo 3.esp'])
+        self.assertEqual(myParser._expand_filename("foo <VER>.esp"), ['foo 1.0.esp', 'foo 2.esp', 'Foo 3.esp'])
+        self.assertEqual(myParser._expand_filename("?oo.esp"), ['foo.esp'])
+
+    def test_parser_prefilter(self):
+        """Statements are only evaluated when they can fire"""
+        import tempfile
+        rules = "[Note]\n Active\nfoo.esp\n[Note]\n Inactive\nbar.esp\n[Note]\n Not\n[NOT baz.esp]\n[Note]\n Wild\nfo?.esp\n"
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as rules_file:
+            rules_file.write(rules)
+        myParser = self.ruleParser.RuleParser(['foo.esp'], "", self.file_names)
+        myParser.read_rules(rules_file.name)
+        os.remove(rules_file.name)
+        index = myParser._index_rules(myParser.compiled)
+        self.assertEqual(index, {"always": [2], "names": {"foo.esp": [0], "bar.esp": [1]}, "stems": {"fo": [3]}})
+        self.assertEqual(myParser._relevant_statements(index), {0, 2, 3})
+        messages = myParser.get_messages()
+        self.assertTrue(" Active" in messages and " Not" in messages and " Wild" in messages)
+        self.assertFalse(" Inactive" in messages)
+
+    def test_rule_lexer(self):
+        import io
+        lexer = self.ruleParser.RuleLexer(io.StringIO("; comment\n\n[Patch] ; note\n[ALL foo.esp [SIZE 12 b.esp]] bar\n"))
+        self.assertTrue(lexer.next_line())
+        self.assertEqual((lexer.line_num, lexer.line), (3, "[Patch]"))
+        self.assertEqual(lexer.rule().groups, ("Patch", "", ""))
+        self.assertTrue(lexer.next_line())
+        self.assertEqual(lexer.expression().groups, ("ALL",))
+        self.assertIsNone(lexer.close())
+        self.assertEqual(lexer.expression().groups, ("foo.esp",))
+        self.assertEqual(lexer.expression().groups, ("SIZE", "", "12", "b.esp"))
+        self.assertEqual(lexer.close().kind, "CLOSE")
+        token = lexer.expression()
+        self.assertEqual((token.kind, lexer.rest()), ("ERROR", "bar"))
+        lexer.clear()
+        self.assertFalse(lexer.next_line())
+        self.assertEqual(lexer.line_num, 4)
+
+    def test_parse_trace(self):
+        import tempfile
+        rules = "[Order]\nfoo.esp\nbar.esp\n[Note]\n Foo\n[ALL foo.esp [SIZE 12 foo.esp]]\n[Note]\n Baz\nbaz.esp\n"
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as rules_file:
+            rules_file.write(rules)
+        by_plugin = self.ruleParser.ParseTrace(plugins=["Foo.esp"])
+        by_line = self.ruleParser.ParseTrace(lines=[(8, 9)], size=2)
+        for trace in (by_plugin, by_line):
+            myParser = self.ruleParser.RuleParser(['foo.esp'], "", self.file_names, trace=trace)
+            myParser.read_rules(rules_file.name)
+        os.remove(rules_file.name)
+        self.assertEqual({line_num for (rule_file, line_num, msg, args) in by_plugin.records}, {2, 7})
+        self.assertIn("%s:2: foo.esp before bar.esp" % rules_file.name, by_plugin.format())
+        # The NOTE about baz.esp can't fire, and only the last 2 records are kept
+        self.assertEqual(len(by_line.records), 2)
+        self.assertEqual(by_line.format()[-1],
+                         "%s:9: skipped, none of the plugins it needs are active" % rules_file.name)
+
+    def test_short_circuit(self):
+        rp = self.ruleParser
+        context = rp.RuleContext(['foo.esp'], None, self.file_names)
+        desc = rp.DescExpr("", "Armor", "foo.esp")
+        self.assertEqual(rp.to_expression(["ALL", [["PLUGIN", "bar.esp"], ["DESC", "", "Armor", "foo.esp"]]]),
+                         rp.AllExpr((rp.PluginExpr("bar.esp"), desc)))
+        self.assertFalse(context.truth(rp.AllExpr((rp.PluginExpr("bar.esp"), desc))))
+        self.assertTrue(context.truth(rp.AnyExpr((rp.PluginExpr("foo.esp"), desc))))
+        self.assertTrue(context.truth(rp.NotExpr((rp.PluginExpr("bar.esp"), desc))))
+        # [DESC] was never needed
+        self.assertNotIn((rp.DescExpr, desc), context.predicates)
+        self.assertEqual(context.evaluate(rp.AnyExpr((rp.PluginExpr("bar.esp"), desc))),
+                         (True, ["ANY", "MISSING(bar.esp)", "[DESC /Armor/ foo.esp]"]))
+
+    def test_graph_cycles(self):
+        graph = self.pluggraph.pluggraph()
+        self.assertTrue(graph.add_edge("", "c.esp", "d.esp"))
+        self.assertTrue(graph.add_edge("", "a.esp", "b.esp"))
+        # Goes against the order the graph has so far, but does not make a cycle
+        self.assertTrue(graph.add_edge("", "b.esp", "c.esp"))
+        self.assertTrue(graph.add_edge("", "b.esp", "c.esp"))
+        self.assertFalse(graph.add_edge("", "d.esp", "a.esp"))
+        self.assertFalse(graph.add_edge("", "a.esp", "a.esp"))
+        self.assertEqual(graph.topo_sort(), ['a.esp', 'b.esp', 'c.esp', 'd.esp'])
+
+    def test_compact_graph(self):
+        myParser = self.ruleParser.RuleParser([], "./test1.data/", self.file_names)
+        myParser.read_rules("./test1.data/mlox_base.txt")
+        graph = myParser.get_graph()
+        compact = graph.compact()
+        active = ['morrowind.esm', 'tribunal.esm']
+        self.assertEqual(compact.explain('Morrowind.esm', active), graph.explain('Morrowind.esm', active))
+        self.assertTrue(compact.can_reach('morrowind.esm', 'bloodmoon.esm'))
+        self.assertFalse(compact.can_reach('bloodmoon.esm', 'morrowind.esm'))
+        self.assertEqual(compact.topo_sort(), self.test1_graph)
+        # Sorting a compact graph can be repeated
+        self.assertEqual(compact.topo_sort(), self.test1_graph)
+        self.assertEqual(graph.topo_sort(), self.test1_graph)
+
+    def test_graph_copy(self):
+        myParser = self.ruleParser.RuleParser([], "./test1.data/", self.file_names)
+        myParser.read_rules("./test1.data/mlox_base.txt")
+        graph = myParser.get_graph()
+        self.assertEqual(graph.topo_sort(), self.test1_graph)
+        # Sorting does not change the graph
+        self.assertEqual(graph.topo_sort(), self.test1_graph)
+        copy = graph.copy()
+        self.assertTrue(copy.add_edge("", "new.esp", "morrowind.esm"))
+        self.assertEqual(copy.topo_sort(), ["new.esp"] + self.test1_graph)
+        self.assertEqual(graph.topo_sort(), self.test1_graph)
+
+    def test_graph_snapshot(self):
+        import tempfile
+        import shutil
+        import json
+        cache_dir = tempfile.mkdtemp()
+        results = []
+        for i in range(2):
+            myParser = self.ruleParser.RuleParser([], "./test1.data/", self.file_names, cache_dir)
+            self.assertTrue(myParser.read_rules("./test1.data/mlox_base.txt"))
+            results.append((myParser.get_messages(), myParser.get_graph().topo_sort()))
+        graph_file = myParser._graph_file(myParser.graph_key)
+        with open(graph_file) as snapshot_file:
+            graph = self.pluggraph.pluggraph().from_map(json.load(snapshot_file)["graph"])
+        # Load orders that give different graphs each keep a snapshot, up to GRAPH_SNAPSHOTS of them
+        rules_file = os.path.join(cache_dir, "wild.txt")
+        with open(rules_file, 'w') as rules:
+            rules.write("[Order]\nfoo*.esp\nbar.esp\n")
+        for i in range(self.ruleParser.GRAPH_SNAPSHOTS + 1):
+            wildParser = self.ruleParser.RuleParser(["foo%d.esp" % i, "bar.esp"], "", self.file_names, cache_dir)
+            self.assertTrue(wildParser.read_rules(rules_file))
+        snapshots = [f for f in os.listdir(cache_dir) if f.startswith("wild.txt.") and f.endswith(".graph.json")]
+        shutil.rmtree(cache_dir)
+        self.assertEqual(len(snapshots), self.ruleParser.GRAPH_SNAPSHOTS)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(graph.topo_sort(), self.test1_graph)
+        self.assertEqual(graph.to_map(), myParser.get_graph().to_map())
+        self.assertEqual(graph.where["morrowind.esm"], {"tribunal.esm": "./test1.data/mlox_base.txt:11"})
+
+    def test_rule_cache(self):
+        shared = self.ruleParser.RuleCache()
+        parsers = []
+        for i in range(2):
+            myParser = self.ruleParser.RuleParser([], "./test1.data/", self.file_names, None, None, shared)
+            self.assertTrue(myParser.read_rules("./test1.data/mlox_base.txt"))
+            parsers.append(myParser)
+        self.assertEqual(len(shared.compiled), 1)
+        self.assertEqual(len(shared.graphs), 1)
+        self.assertEqual(parsers[0].get_messages(), parsers[1].get_messages())
+        # Each parser gets its own copy of the graph, so adding to one doesn't change the others
+        self.assertIsNot(parsers[0].get_graph(), parsers[1].get_graph())
+        self.assertEqual(parsers[1].get_graph().topo_sort(), self.test1_graph)
+
+    def test_nearstart_roots(self):
+        graph = self.pluggraph.pluggraph()
+        for (plug1, plug2) in [("a.esp", "b.esp"), ("c.esp", "d.esp"), ("e.esp", "d.esp"), ("f.esp", "g.esp")]:
+            graph.add_edge("", plug1, plug2)
+        graph.nodes.setdefault("h.esp", [])
+        graph.nearstart = ["g.esp", "d.esp", "h.esp"]
+        expected = ['f.esp', 'g.esp', 'c.esp', 'e.esp', 'd.esp', 'h.esp', 'a.esp', 'b.esp']
+        self.assertEqual(graph.topo_sort(), expected)
+        self.assertEqual(graph.compact().topo_sort(), expected)
+
+    def test_nearend_constraints(self):
+        def build():
+            graph = self.pluggraph.pluggraph()
+            for (plug1, plug2) in [("a.esp", "b.esp"), ("e.esp", "c.esp"), ("f.esp", "e.esp")]:
+                graph.add_edge("", plug1, plug2)
+            graph.nearend = ["e.esp", "f.esp"]
+            return graph
+        active = ["a.esp", "b.esp", "c.esp", "d.esp", "e.esp", "f.esp"]
+        # The same graph, with an edge from every active plugin to each [NearEnd] plugin
+        expected = build()
+        for end in expected.nearend:
+            for p in active:
+                if p != end:
+                    expected.add_edge("", p, end)
+        graph = build()
+        graph.add_nearend_constraints(active)
+        self.assertEqual(sum(map(len, graph.nodes.values())), 3)
+        self.assertEqual(graph.topo_sort(), expected.topo_sort())
+        # Each end plugin's sink has a place in the topological order, after the plugins with end edges to it
+        for end in graph.end_plugins:
+            sink = self.pluggraph._sink(end)
+            self.assertLess(graph.topo_index[sink], graph.topo_index[end])
+            for p in graph.end_parents[sink]:
+                self.assertLess(graph.topo_index[p], graph.topo_index[sink])
+        # c.esp has to follow e.esp, so d.esp can't come after c.esp
+        self.assertFalse(graph.add_edge("", "c.esp", "d.esp"))
+        self.assertFalse(expected.add_edge("", "c.esp", "d.esp"))
+        self.assertTrue(graph.add_edge("", "a.esp", "d.esp"))
+        self.assertTrue(expected.add_edge("", "a.esp", "d.esp"))
+        self.assertEqual(graph.topo_sort(), expected.topo_sort())
+        self.assertEqual(graph.explain("a.esp", active), expected.explain("a.esp", active))
+
+    def test_priority_sort(self):
+        from mlox.pluggraph import pluggraph
+        order = ["a.esp", "b.esp", "c.esp", "d.esp", "e.esp"]
+        graph = pluggraph()
+        for p in order:
+            graph.nodes.setdefault(p, [])
+        graph.add_edge("", "d.esp", "b.esp")
+        graph.nearstart.append("e.esp")
+        # Only d.esp has to move (ahead of b.esp), and e.esp goes first
+        self.assertEqual(graph.compact().priority_sort(order),
+                         ["e.esp", "a.esp", "d.esp", "b.esp", "c.esp"])
+        # Without a load order, only the graph decides
+        self.assertEqual(graph.compact().priority_sort([]), ["e.esp", "a.esp", "c.esp", "d.esp", "b.esp"])
+
     # TODO:  d_ver doesn't seem correct
     def test_plugin_version(self):
         # Multi-line check here
@@ -244,6 +574,97 @@ class LoadOrderTest(unittest.TestCase):
     from mlox.loadOrder import Loadorder
     import mlox.fileFinder as fileFinder
 
+    def test_result_cache(self):
+        import tempfile
+        import shutil
+        from mlox.loadOrder import ResultCache, RESULT_CACHE_SIZE
+        cache_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(cache_dir, "results.json")
+        results = ResultCache(cache_file)
+        for i in range(RESULT_CACHE_SIZE + 1):
+            results.put(str(i), {"messages": str(i)})
+        # A new cache reads what the first one saved, less the oldest result
+        results = ResultCache(cache_file)
+        self.assertIsNone(results.get("0"))
+        self.assertEqual(results.get("1"), {"messages": "1"})
+        # Without autosaving, results are only saved (once) when save is called
+        os.remove(cache_file)
+        results = ResultCache(cache_file, autosave=False)
+        results.put("a", {"messages": "a"})
+        results.put("b", {"messages": "b"})
+        self.assertFalse(os.path.exists(cache_file))
+        self.assertEqual(list(results.added), ["a", "b"])
+        results.save()
+        self.assertEqual(results.added, {})
+        self.assertEqual(ResultCache(cache_file).get("b"), {"messages": "b"})
+        shutil.rmtree(cache_dir)
+
+    def test_result_replay(self):
+        import tempfile
+        import shutil
+        from mlox.loadOrder import ResultCache
+        mods_dir = tempfile.mkdtemp()
+        main_lua = os.path.join(mods_dir, "main.lua")
+        result = {"messages": "", "hints": {}, "mwse_mods": {main_lua: False},
+                  "logs": [["mlox.parser", logging.WARNING, "a warning"]]}
+        results = ResultCache()
+        results.put("key", result)
+        self.assertEqual(results.get("key"), result)
+        # Adding an [MWSE-LUA] mod the result depended on makes it stale
+        open(main_lua, 'w').close()
+        self.assertIsNone(results.get("key"))
+        shutil.rmtree(mods_dir)
+        # Using a result gives its log messages again
+        a_loadorder = self.Loadorder(results=results, find_dirs=False)
+        with self.assertLogs("mlox.parser", logging.WARNING) as logs:
+            a_loadorder._use_result(result, True)
+        self.assertEqual(logs.output, ["WARNING:mlox.parser:a warning"])
+
+    def test_batch_worker(self):
+        import tempfile
+        import shutil
+        import mlox.resources as resources
+        import pickle
+        from mlox.loadOrder import _start_worker, _update_file, _updated_loadorder
+        user_path = resources.get_user_path()
+        level = logging.getLogger().level
+        worker_path = tempfile.mkdtemp()
+        # A worker takes the user path and logging level of the process that started it
+        _start_worker(worker_path, logging.ERROR)
+        self.assertEqual(resources.get_user_path(), worker_path)
+        self.assertEqual(logging.getLogger().level, logging.ERROR)
+        with open(os.path.join(worker_path, "mlox_base.txt"), 'w') as base:
+            base.write("[Order]\nb.esp\na.esp\n")
+        fromfile = os.path.join(worker_path, "plugins.txt")
+        with open(fromfile, 'w') as plugins:
+            plugins.write("a.esp\nb.esp\n")
+        # It only gives back what the output needs, which pickles
+        updated = _update_file(fromfile, False, False)
+        self.assertEqual(updated, pickle.loads(pickle.dumps(updated)))
+        self.assertEqual(updated["new_order"], ["b.esp", "a.esp"])
+        self.assertEqual(_updated_loadorder(fromfile, updated).get_new_order(), ["*002* b.esp", "_001_ a.esp"])
+        resources.set_user_path(user_path)
+        logging.getLogger().setLevel(level)
+        shutil.rmtree(worker_path)
+
+    def test_process_load_order(self):
+        import contextlib
+        import io
+        from argparse import Namespace
+        from mlox.__main__ import process_load_order
+        from mlox.loadOrder import ResultCache
+        args = Namespace(explain=None, base_only=False, quiet=True, warningsonly=False, priority_sort=False,
+                         update=False)
+        # A load order that can't be sorted still ends with the footer, but fails
+        for args.update in [False, True]:
+            a_loadorder = self.Loadorder(results=ResultCache(), find_dirs=False)
+            a_loadorder.read_from_list([])
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(process_load_order(a_loadorder, args), 1)
+            self.assertEqual(output.getvalue().splitlines(),
+                             ["{0:-^80}".format('[New Load Order]'), "{0:-^80}".format('[END PROPOSED LOAD ORDER]')])
+
     @mark.skip('Unimplemented')
     def test_File_and_Dir(self):
         l1 = self.Loadorder()
@@ -270,6 +691,80 @@ class LoadOrderTest(unittest.TestCase):
         print(l3.explain("Morrowind.esm", True))
 
 
+class ServerTest(unittest.TestCase):
+    """ Test mlox.server """
+    import mlox.server as server
+    import mlox.ruleParser as ruleParser
+
+    def test_bad_requests(self):
+        shared = self.server.server_loadorder()
+        self.assertIn("error", self.server.handle_request(shared, ["Morrowind.esm"]))
+        self.assertIn("error", self.server.handle_request(shared, {"plugins": "Morrowind.esm"}))
+        self.assertIn("error", self.server.handle_request(shared, {"command": "explain", "plugins": []}))
+        self.assertEqual(self.server.handle_request(shared, {"command": "nope", "plugins": []}),
+                         {"error": "Unknown command: nope"})
+        self.assertTrue(self.server._answer(shared, b"{bad")["error"].startswith("Invalid JSON"))
+
+    def test_bad_content_length(self):
+        import http.client
+        import json
+        import threading
+        server = self.server.HTTPServer(("127.0.0.1", 0), self.server.HTTPHandler)
+        server.loadorder = self.server.server_loadorder()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        for length in ["abc", "-1"]:
+            connection = http.client.HTTPConnection(*server.server_address)
+            connection.putrequest("POST", "/")
+            connection.putheader("Content-Length", length)
+            connection.endheaders()
+            response = connection.getresponse()
+            self.assertEqual(response.status, 400)
+            self.assertEqual(json.loads(response.read()), {"error": "Invalid Content-Length: " + length})
+            connection.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_duplicate_plugins(self):
+        a_loadorder = self.server.server_loadorder()
+        self.assertEqual(a_loadorder.datadir, None)
+        a_loadorder.read_from_list(["a.esp", "A.ESP", "Morrowind.esm"])
+        self.assertEqual(a_loadorder.order, ["a.esp", "morrowind.esm"])
+
+
+class TimingsTest(unittest.TestCase):
+    """ Test mlox.timings """
+    import mlox.timings as timings
+    import mlox.ruleParser as ruleParser
+    import mlox.fileFinder as fileFinder
+
+    def test_timings(self):
+        timings = self.timings.Timings()
+        myParser = self.ruleParser.RuleParser([], "./test1.data/", self.fileFinder.caseless_filenames(),
+                                              timings=timings)
+        self.assertTrue(myParser.read_rules("./test1.data/mlox_base.txt"))
+        self.assertGreater(timings.phases["rules read"], 0)
+        self.assertGreater(timings.phases["graph build"], 0)
+        # test1 has no statements, only ordering rules
+        self.assertEqual(timings.phases["statements"], 0)
+        self.assertIn("header reads", timings.phases)
+        self.assertEqual(timings.phases["sort"], 0)
+        # Every ordering rule and statement was timed, by the line it is reported at
+        self.assertEqual(len(timings.rules), len([r for r in myParser.compiled if r[0] != "VERSION"]))
+        (where, entry) = timings.slowest_rules(1)[0]
+        self.assertTrue(where.startswith("./test1.data/mlox_base.txt:"))
+        self.assertEqual(set(entry), {"rule", "parse", "eval", "checks"})
+        self.assertEqual(set(timings.to_json()), {"phases", "rules", "counts"})
+        self.assertIn("graph build", timings.report())
+
+    def test_timings_sort_again(self):
+        from mlox.loadOrder import Loadorder, ResultCache
+        results = ResultCache()
+        results.get = lambda key: self.fail("A timed sort used the result of an earlier one")
+        a_loadorder = Loadorder(timings=self.timings.Timings(), results=results, find_dirs=False)
+        a_loadorder.read_from_list(["Morrowind.esm"])
+        a_loadorder.update()
+
+
 class VersionTest(unittest.TestCase):
     import mlox.version as version
 